@@ -1,20 +1,41 @@
 #!/usr/bin/env python
+from collections import OrderedDict
+from dateutil.relativedelta import relativedelta as relativedelta
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+
+from LEUtils import LifeExpectancy
 
 class LECache( object ):
+   '''
+   LRU cache of LifeExpectancy objects keyed on LifeExpectancy.key().
+   The entries are kept in an OrderedDict from the least to the most
+   recently used one, so get, put and evictions are constant time.
+   If ttl ( seconds ) is set, entries older than ttl are treated as misses.
+   getKey and putKey cache any value under an explicit hashable key.
+   The cache can be shared by threads.
+   The LifeExpectancy entries can be saved to a file and loaded back in
+   the same recency order, or warmed up from a data store.
+   '''
 
-   def __init__( self, maxsize ):
+   def __init__( self, maxsize, ttl=None, clock=time.time ):
       self.maxsize_ = maxsize
-      self.cache_ = [ None ] * maxsize
+      self.ttl_ = ttl
+      self.clock_ = clock
+      # key -> ( value, expiry time )
+      self.cache_ = OrderedDict()
+      self.lock_ = threading.Lock()
+      self.hits_ = 0
+      self.misses_ = 0
+      self.evictions_ = 0
+      self.expirations_ = 0
 
    def put( self, lifeExpectancy ):
-      if lifeExpectancy in self.cache_:
-         self.cache_.remove( lifeExpectancy )
-      # add the lifeExpectancy to front of the list
-      self.cache_.insert( 0, lifeExpectancy )
-      # if the length of the cache exceeds the max size
-      # remove the last lifeExpectancy
-      if len( self.cache_ ) > self.maxsize_:
-         self.cache_.pop()
+      self.putKey( lifeExpectancy.key(), lifeExpectancy )
 
    def get( self, lifeExpectancy ):
       '''
@@ -22,11 +43,157 @@ class LECache( object ):
       there is one equal to lifeExpectancy,
       None otherwise
       '''
-      result = None
-      for le in self.cache_:
-         if lifeExpectancy == le:
-            result = le
-            # update the priority on the result
-            self.put( result )
-            break
-      return result
+      return self.getKey( lifeExpectancy.key() )
+
+   def putKey( self, key, value ):
+      expiry = self.clock_() + self.ttl_ if self.ttl_ is not None else None
+      with self.lock_:
+         if key in self.cache_:
+            del self.cache_[ key ]
+         # add the value as the most recently used entry
+         self.cache_[ key ] = ( value, expiry )
+         # if the length of the cache exceeds the max size
+         # remove the least recently used value
+         while len( self.cache_ ) > self.maxsize_:
+            self.cache_.popitem( last=False )
+            self.evictions_ += 1
+
+   def getKey( self, key ):
+      '''
+      Returns the value cached under key, None otherwise
+      '''
+      with self.lock_:
+         entry = self.cache_.pop( key, None )
+         if entry is None:
+            self.misses_ += 1
+            return None
+
+         ( result, expiry ) = entry
+         if expiry is not None and expiry <= self.clock_():
+            # the entry is stale, leave it out of the cache
+            self.expirations_ += 1
+            self.misses_ += 1
+            return None
+
+         # reinsert the result to update its priority
+         self.cache_[ key ] = entry
+         self.hits_ += 1
+         return result
+
+   def entries( self ):
+      '''
+      Returns the cached values,
+      from the most to the least recently used
+      '''
+      with self.lock_:
+         return [ value for ( value, _ ) in reversed( self.cache_.values() ) ]
+
+   def save( self, path ):
+      '''
+      Atomically writes the LifeExpectancy entries to path, one JSON line
+      per entry from the least to the most recently used.
+      Returns the number of saved entries
+      '''
+
+      saved = 0
+      ( fd, tmpPath ) = tempfile.mkstemp( dir=os.path.dirname( os.path.abspath( path ) ) )
+      with self.lock_:
+         values = self.cache_.values()
+      with os.fdopen( fd, 'w' ) as tmp:
+         for ( value, expiry ) in values:
+            if not isinstance( value, LifeExpectancy ) or not value.lifeExpectancy():
+               continue
+            entry = value.lifeExpectancyJson()
+            entry.update( country=value.country(), dob=value.dob().isoformat(),
+                          gender=value.gender(), date=value.date().isoformat(),
+                          expiry=expiry )
+            tmp.write( json.dumps( entry ) + "\n" )
+            saved += 1
+      os.rename( tmpPath, path )
+      return saved
+
+   def load( self, path, date=None ):
+      '''
+      Puts the entries saved in path in the cache, keeping their recency
+      order. If date is set, only the life expectancies of that reference
+      date are loaded. Expired and invalid entries are skipped, returns
+      the number of loaded entries
+      '''
+
+      if not os.path.exists( path ):
+         return 0
+      entries = []
+      now = self.clock_()
+      with open( path, 'r' ) as fd:
+         for line in fd:
+            try:
+               entry = json.loads( line )
+               if entry[ 'expiry' ] is not None and entry[ 'expiry' ] <= now:
+                  continue
+               le = LifeExpectancy( entry[ 'country' ].encode( 'utf-8' ),
+                                    entry[ 'dob' ].encode( 'utf-8' ),
+                                    entry[ 'gender' ].encode( 'utf-8' ),
+                                    entry[ 'date' ].encode( 'utf-8' ) )
+               if date is not None and le.date() != date:
+                  continue
+               le.setLifeExp( relativedelta( years=entry[ 'years' ],
+                                             months=entry[ 'months' ],
+                                             days=entry[ 'days' ] ) )
+               entries.append( ( le, entry[ 'expiry' ] ) )
+            except Exception:
+               # truncated or corrupted entry
+               continue
+      # only the most recently used entries fit
+      entries = entries[ -self.maxsize_: ] if self.maxsize_ else []
+      with self.lock_:
+         for ( le, expiry ) in entries:
+            self.cache_.pop( le.key(), None )
+            self.cache_[ le.key() ] = ( le, expiry )
+         while len( self.cache_ ) > self.maxsize_:
+            self.cache_.popitem( last=False )
+      return len( entries )
+
+   def warm( self, dataStore, date=None ):
+      '''
+      Puts the most recently written life expectancies of the reference
+      date ( today by default ) of dataStore in the cache, as many as fit.
+      Returns the number of added entries
+      '''
+
+      date = date or datetime.date.today()
+      added = 0
+      for ( _, country, dob, gender, years, months, days ) in reversed(
+            dataStore.recent( date, self.maxsize_ ) ):
+         le = LifeExpectancy( country, dob, gender, date )
+         if le.key() in self.cache_:
+            continue
+         le.setLifeExp( relativedelta( years=years, months=months, days=days ) )
+         self.put( le )
+         added += 1
+      return added
+
+   def maxsize( self ):
+      return self.maxsize_
+
+   def hits( self ):
+      return self.hits_
+
+   def misses( self ):
+      return self.misses_
+
+   def evictions( self ):
+      return self.evictions_
+
+   def expirations( self ):
+      return self.expirations_
+
+   def stats( self ):
+      return { 'size': len( self ),
+               'maxsize': self.maxsize_,
+               'hits': self.hits_,
+               'misses': self.misses_,
+               'evictions': self.evictions_,
+               'expirations': self.expirations_ }
+
+   def __len__( self ):
+      return len( self.cache_ )
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+import threading
+import time
+
+class LECircuitBreaker( object ):
+   '''
+   Circuit breaker of a provider. The circuit is closed while the provider
+   answers: after failureThreshold consecutive failures it opens and allow()
+   refuses every call for resetTimeout seconds, so an outage costs a lookup
+   nothing instead of the timeouts and retries of every request. Then it is
+   half open: a single trial call is allowed, the circuit closes if it
+   succeeds and opens again if it fails.
+   A success slower than latencyBudget seconds counts as a failure, so a
+   provider that answers too slowly opens the circuit too
+   '''
+
+   closed = 'closed'
+   open = 'open'
+   halfOpen = 'half-open'
+
+   def __init__( self, failureThreshold=5, resetTimeout=30.0, latencyBudget=None,
+                 clock=time.time ):
+      self.failureThreshold_ = failureThreshold
+      self.resetTimeout_ = resetTimeout
+      self.latencyBudget_ = latencyBudget
+      self.clock_ = clock
+      self.lock_ = threading.Lock()
+      self.state_ = self.closed
+      self.failures_ = 0
+      self.openedAt_ = None
+      self.trial_ = False
+      self.counts_ = { 'successes': 0, 'failures': 0, 'slow': 0,
+                       'rejected': 0, 'opened': 0 }
+
+   def failureThreshold( self ):
+      return self.failureThreshold_
+
+   def resetTimeout( self ):
+      return self.resetTimeout_
+
+   def latencyBudget( self ):
+      return self.latencyBudget_
+
+   def state( self ):
+      '''
+      Returns closed, open or half-open
+      '''
+
+      with self.lock_:
+         self._update()
+         return self.state_
+
+   def _update( self ):
+      '''
+      Helper method. Half opens the circuit once resetTimeout has elapsed,
+      the lock has to be held
+      '''
+
+      if self.state_ == self.open and \
+         self.clock_() - self.openedAt_ >= self.resetTimeout_:
+         self.state_ = self.halfOpen
+         self.trial_ = False
+
+   def allow( self ):
+      '''
+      Returns True if a call to the provider can be made
+      '''
+
+      with self.lock_:
+         self._update()
+         if self.state_ == self.closed:
+            return True
+         if self.state_ == self.halfOpen and not self.trial_:
+            self.trial_ = True
+            return True
+         self.counts_[ 'rejected' ] += 1
+         return False
+
+   def success( self, latency=None ):
+      '''
+      Records a call answered in latency seconds
+      '''
+
+      if self.latencyBudget_ is not None and latency is not None and \
+         latency > self.latencyBudget_:
+         with self.lock_:
+            self.counts_[ 'slow' ] += 1
+         self.failure()
+         return
+      with self.lock_:
+         self.counts_[ 'successes' ] += 1
+         self.failures_ = 0
+         self.state_ = self.closed
+         self.trial_ = False
+
+   def failure( self ):
+      '''
+      Records a call that failed
+      '''
+
+      with self.lock_:
+         self.counts_[ 'failures' ] += 1
+         self.failures_ += 1
+         if self.state_ == self.halfOpen or \
+            ( self.state_ == self.closed and self.failures_ >= self.failureThreshold_ ):
+            self.state_ = self.open
+            self.openedAt_ = self.clock_()
+            self.counts_[ 'opened' ] += 1
+
+   def stats( self ):
+      with self.lock_:
+         self._update()
+         stats = dict( self.counts_ )
+         stats.update( { 'state': self.state_,
+                         'consecutiveFailures': self.failures_,
+                         'failureThreshold': self.failureThreshold_,
+                         'resetTimeout': self.resetTimeout_,
+                         'latencyBudget': self.latencyBudget_ } )
+         if self.state_ == self.open:
+            stats[ 'retryIn' ] = max( 0.0, self.openedAt_ + self.resetTimeout_ - self.clock_() )
+      return stats
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+import difflib
+import json
+import os
+import tempfile
+import threading
+import time
+
+class LECountries( object ):
+   '''
+   List of the countries supported by the provider.
+   The list returned by fetch() is persisted as JSON in path together with
+   the time it was fetched, so that it is only fetched again once it is
+   older than ttl seconds. A stale list is still used while a background
+   thread refreshes it, so only the very first run depends on the network.
+   If that first fetch fails the empty list is refreshed in the background
+   too, so a long running process recovers once the provider is back.
+   After a failed refresh the next one waits retryInterval seconds, so
+   lookups don't start a refresh each while the provider is unavailable.
+   Countries are indexed case insensitively.
+   '''
+
+   def __init__( self, fetch, path=None, ttl=24 * 3600, retryInterval=60,
+                 clock=time.time ):
+      self.fetch_ = fetch
+      self.path_ = path
+      self.ttl_ = ttl
+      self.retryInterval_ = retryInterval
+      self.clock_ = clock
+      self.lock_ = threading.Lock()
+      self.refreshThread_ = None
+      self.fetched_ = None
+      # time the last background refresh started
+      self.started_ = None
+      # lowercase name -> name
+      self.index_ = {}
+
+      if path and os.path.exists( path ):
+         try:
+            with open( path, 'r' ) as fd:
+               data = json.load( fd )
+            self._setCountries( data[ 'countries' ], data[ 'fetched' ] )
+         except ( ValueError, KeyError, TypeError ):
+            # corrupted file, fetch the list again
+            pass
+
+      if self.fetched_ is None:
+         self.started_ = self.clock_()
+         self.refresh()
+      elif self.stale():
+         self.refreshInBackground()
+
+   def _setCountries( self, countries, fetched ):
+      index = {}
+      for country in countries:
+         if isinstance( country, unicode ):
+            country = country.encode( 'utf-8' )
+         index[ country.lower() ] = country
+      with self.lock_:
+         self.index_ = index
+         self.fetched_ = fetched
+
+   def path( self ):
+      return self.path_
+
+   def fetched( self ):
+      return self.fetched_
+
+   def stale( self ):
+      return self.fetched_ is None or self.clock_() - self.fetched_ >= self.ttl_
+
+   def refresh( self ):
+      '''
+      Fetches the countries and persists them.
+      Keeps the current list if the fetch fails, returns True on success
+      '''
+
+      countries = self.fetch_()
+      if not countries:
+         return False
+      fetched = self.clock_()
+      self._setCountries( countries, fetched )
+      if self.path_:
+         # write to a temporary file first so that readers never see
+         # a partially written list
+         ( fd, tmpPath ) = tempfile.mkstemp( dir=os.path.dirname( self.path_ ) )
+         with os.fdopen( fd, 'w' ) as tmp:
+            json.dump( { 'fetched': fetched, 'countries': self.names() }, tmp )
+         os.rename( tmpPath, self.path_ )
+      return True
+
+   def refreshInBackground( self ):
+      '''
+      Starts a refresh thread unless the list is fresh, one is running or
+      the last refresh started less than retryInterval seconds ago and
+      failed, returns the last thread started
+      '''
+
+      with self.lock_:
+         if ( not self.stale() or
+              ( self.refreshThread_ and self.refreshThread_.is_alive() ) or
+              ( self.started_ is not None and
+                self.clock_() - self.started_ < self.retryInterval_ ) ):
+            return self.refreshThread_
+         self.started_ = self.clock_()
+         self.refreshThread_ = threading.Thread( target=self.refresh )
+         self.refreshThread_.daemon = True
+         self.refreshThread_.start()
+         return self.refreshThread_
+
+   def ensureFresh( self ):
+      '''
+      Refreshes the list in the background if it is empty or stale
+      '''
+
+      if self.stale():
+         self.refreshInBackground()
+
+   def lookup( self, country ):
+      '''
+      Returns the country as spelled by the provider, None if it doesn't exist
+      '''
+
+      self.ensureFresh()
+      return self.index_.get( country.lower() )
+
+   def suggestions( self, country, n=3 ):
+      '''
+      Returns up to n existing countries with a name close to country
+      '''
+
+      index = self.index_
+      matches = difflib.get_close_matches( country.lower(), index.keys(), n=n )
+      return [ index[ match ] for match in matches ]
+
+   def names( self ):
+      return sorted( self.index_.values() )
+
+   def __contains__( self, country ):
+      return self.lookup( country ) is not None
+
+   def __len__( self ):
+      # callers skip the lookups while the list is empty, refresh it here
+      self.ensureFresh()
+      return len( self.index_ )
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 from dateutil.relativedelta import relativedelta as relativedelta
+import datetime
+import errno
+import heapq
 import json
 import os
+import shutil
+import sys
 import tempfile
+import threading
 
 from LEUtils import isDate
 
@@ -20,6 +26,10 @@ class LEDataStore( object ):
 
    The hierarchy for a a path to a file is:
    /rootdir/date.year/date.month/date.day/country/dob.year/dob.month/dob.day/
+
+   Several processes can share the same root: files are written to a
+   temporary file and renamed in place, so a reader or a crash never
+   leaves a partially written life expectancy behind.
    '''
 
    def __init__( self, root=tempfile.gettempdir(), directory='lifeExpectancy' ):
@@ -39,11 +49,11 @@ class LEDataStore( object ):
       return self.dir_
 
 
-   def _lifeExpPath( self, lifeExp ):
+   def _lifeExpPath( self, lifeExp, date=None ):
 
-      dateDir = "%s/%s/%s" % ( lifeExp.date().year,
-                               lifeExp.date().month,
-                               lifeExp.date().day )
+      if date is None:
+         date = lifeExp.date()
+      dateDir = "%s/%s/%s" % ( date.year, date.month, date.day )
       dob = lifeExp.dob()
       dobDir = "%s/%s/%s/%s" % ( lifeExp.country(), dob.year, dob.month,
                                  dob.day )
@@ -59,14 +69,54 @@ class LEDataStore( object ):
       to retrieve the dod
       '''
 
-      lifeExpFile = os.path.join( self._lifeExpPath( lifeExp ), lifeExp.gender() )
-      if not os.path.exists( lifeExpFile ):
-         return None
+      return self._read( os.path.join( self._lifeExpPath( lifeExp ), lifeExp.gender() ) )
 
-      with open( lifeExpFile, 'r' ) as fd:
-         lifeExpJson = json.load( fd )
+   def _read( self, lifeExpFile ):
+      '''
+      Helper method. Returns the life expectancy stored in lifeExpFile,
+      None if there is none
+      '''
+
+      try:
+         with open( lifeExpFile, 'r' ) as fd:
+            lifeExpJson = json.load( fd )
          return relativedelta( **lifeExpJson )
-      
+      except IOError as e:
+         if e.errno != errno.ENOENT:
+            raise
+         return None
+      except ( ValueError, TypeError ):
+         # truncated file written before writes were atomic, drop it
+         # so that the life expectancy is fetched and stored again
+         self._remove( lifeExpFile )
+         return None
+
+   def fetchEarlier( self, lifeExp, maxAge ):
+      '''
+      Returns ( date, life expectancy ) of the person of lifeExp for the
+      latest reference date before the date of lifeExp and at most maxAge
+      days before it, None if there is none
+      '''
+
+      oldest = lifeExp.date() - datetime.timedelta( days=maxAge )
+      for date in reversed( self.dates() ):
+         if date >= lifeExp.date():
+            continue
+         if date < oldest:
+            break
+         delta = self._read( os.path.join( self._lifeExpPath( lifeExp, date ),
+                                           lifeExp.gender() ) )
+         if delta is not None:
+            return ( date, delta )
+      return None
+
+   @staticmethod
+   def _remove( path ):
+      try:
+         os.remove( path )
+      except OSError:
+         pass
+
    def addLifeExpectancy( self, lifeExp ):
 
       # if life expectancy isnt set in lifeExp,
@@ -75,11 +125,204 @@ class LEDataStore( object ):
          raise LEDataStoreException( "life expectancy in %s is not set" % lifeExp )
 
       lifeExpPath = self._lifeExpPath( lifeExp )
-      if not os.path.exists( lifeExpPath ):
+      lifeExpFile = os.path.join( lifeExpPath, lifeExp.gender() )
+      if os.path.exists( lifeExpFile ):
+         return
+
+      try:
          os.makedirs( lifeExpPath )
+      except OSError as e:
+         # another process created it first
+         if e.errno != errno.EEXIST:
+            raise
 
-      lifeExpFile = os.path.join( lifeExpPath, lifeExp.gender() )
-      if not os.path.exists( lifeExpFile ):
-         with open( lifeExpFile, 'w' ) as fd:
-            json.dump( lifeExp.lifeExpectancyJson(), fd )
+      # temporary files start with a dot so that they are never taken
+      # for a gender, rename() atomically replaces a concurrent write
+      # of the same life expectancy
+      ( fd, tmpPath ) = tempfile.mkstemp( dir=lifeExpPath,
+                                          prefix='.%s.' % lifeExp.gender() )
+      try:
+         with os.fdopen( fd, 'w' ) as tmp:
+            json.dump( lifeExp.lifeExpectancyJson(), tmp )
+         os.rename( tmpPath, lifeExpFile )
+      except:
+         self._remove( tmpPath )
+         raise
+
+   def _dateDirs( self, path ):
+      '''
+      Helper method. Returns ( int, path ) for the numeric subdirectories of path
+      '''
+      result = []
+      for name in os.listdir( path ):
+         if name.isdigit() and os.path.isdir( os.path.join( path, name ) ):
+            result.append( ( int( name ), os.path.join( path, name ) ) )
+      return sorted( result )
+
+   def dates( self ):
+      '''
+      Returns the sorted list of reference dates with stored life expectancies
+      '''
+
+      result = []
+      for ( year, yearPath ) in self._dateDirs( self.dir_ ):
+         for ( month, monthPath ) in self._dateDirs( yearPath ):
+            for ( day, _ ) in self._dateDirs( monthPath ):
+               result.append( datetime.date( year, month, day ) )
+      return result
+
+   def _files( self, date=None ):
+      '''
+      Helper method. Yields ( path, ( date, country, dob, gender, years,
+      months, days ) ) for every stored life expectancy ( of the reference
+      date if set ), skipping temporary and truncated files
+      '''
+
+      top = self.dir_
+      if date is not None:
+         top = os.path.join( self.dir_, "%s/%s/%s" % ( date.year, date.month, date.day ) )
+      for ( dirpath, _, filenames ) in os.walk( top ):
+         parts = os.path.relpath( dirpath, self.dir_ ).split( os.sep )
+         if len( parts ) != 7:
+            continue
+         try:
+            lifeExpDate = datetime.date( *[ int( x ) for x in parts[ 0:3 ] ] )
+            dob = datetime.date( *[ int( x ) for x in parts[ 4:7 ] ] )
+         except ValueError:
+            continue
+         for gender in filenames:
+            if gender.startswith( '.' ):
+               continue
+            path = os.path.join( dirpath, gender )
+            try:
+               with open( path, 'r' ) as fd:
+                  lifeExpJson = json.load( fd )
+            except ( IOError, ValueError ):
+               continue
+            yield ( path, ( lifeExpDate, parts[ 3 ], dob, gender, lifeExpJson[ 'years' ],
+                            lifeExpJson[ 'months' ], lifeExpJson[ 'days' ] ) )
+
+   def rows( self ):
+      '''
+      Yields ( date, country, dob, gender, years, months, days ) for every
+      stored life expectancy
+      '''
+
+      for ( _, row ) in self._files():
+         yield row
+
+   def recent( self, date, n ):
+      '''
+      Returns the rows ( see rows() ) of the n most recently written
+      life expectancies of the reference date, the most recent first
+      '''
+
+      def written():
+         for ( path, row ) in self._files( date ):
+            try:
+               yield ( os.path.getmtime( path ), row )
+            except OSError:
+               pass
+      return [ row for ( _, row ) in heapq.nlargest( n, written() ) ]
+
+   def compact( self, olderThan=None ):
+      '''
+      Removes the life expectancies of the reference dates before olderThan
+      ( today by default ). Whole year and month subtrees are removed at once
+      when they are entirely before olderThan, so the files of a date
+      are never visited. Returns the number of removed year, month
+      and day directories
+      '''
+
+      ( v, olderThan ) = isDate( olderThan or datetime.date.today() )
+      if not v:
+         raise LEDataStoreException( olderThan )
+
+      removed = 0
+      for ( year, yearPath ) in self._dateDirs( self.dir_ ):
+         if year < olderThan.year:
+            shutil.rmtree( yearPath, ignore_errors=True )
+            removed += 1
+            continue
+         if year > olderThan.year:
+            continue
+         for ( month, monthPath ) in self._dateDirs( yearPath ):
+            if month < olderThan.month:
+               shutil.rmtree( monthPath, ignore_errors=True )
+               removed += 1
+               continue
+            if month > olderThan.month:
+               continue
+            for ( day, dayPath ) in self._dateDirs( monthPath ):
+               if day < olderThan.day:
+                  shutil.rmtree( dayPath, ignore_errors=True )
+                  removed += 1
+      return removed
+
+   def usage( self ):
+      '''
+      Returns the number of reference dates, stored life expectancies
+      and bytes used by the data store
+      '''
+
+      entries = 0
+      size = 0
+      for ( dirpath, _, filenames ) in os.walk( self.dir_ ):
+         for filename in filenames:
+            if filename.startswith( '.' ):
+               # being written
+               continue
+            try:
+               size += os.path.getsize( os.path.join( dirpath, filename ) )
+               entries += 1
+            except OSError:
+               # removed while walking
+               pass
+      return { 'dates': len( self.dates() ), 'entries': entries, 'bytes': size }
+
+class LEDataStoreSweeper( object ):
+   '''
+   Background thread that periodically compacts a data store,
+   keeping the reference dates of the last retention days.
+   A sweep that fails is reported and retried at the next interval
+   '''
+
+   def __init__( self, dataStore, retention=0, interval=3600 ):
+      self.dataStore_ = dataStore
+      self.retention_ = retention
+      self.interval_ = interval
+      self.removed_ = 0
+      self.errors_ = 0
+      self.stop_ = threading.Event()
+      self.thread_ = threading.Thread( target=self._run )
+      self.thread_.daemon = True
+
+   def start( self ):
+      self.thread_.start()
+      return self
+
+   def stop( self ):
+      self.stop_.set()
+      self.thread_.join()
+
+   def removed( self ):
+      return self.removed_
+
+   def errors( self ):
+      return self.errors_
+
+   def sweep( self ):
+      olderThan = datetime.date.today() - datetime.timedelta( days=self.retention_ )
+      removed = self.dataStore_.compact( olderThan )
+      self.removed_ += removed
+      return removed
 
+   def _run( self ):
+      while not self.stop_.is_set():
+         try:
+            self.sweep()
+         except Exception as e:
+            self.errors_ += 1
+            sys.stderr.write( "LEDataStoreSweeper: failed to compact the data "
+                              "store: %s\n" % e )
+         self.stop_.wait( self.interval_ )
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+import atexit
+import binascii
+import errno
+import fcntl
+import hashlib
+import math
+import os
+import struct
+import tempfile
+import threading
+
+from LEDataStore import LEDataStoreException
+
+class LEBloomFilter( object ):
+   '''
+   Scalable Bloom filter of strings: a string that was added is always
+   in the filter, a string that wasn't is in it with a probability of at
+   most errorRate. The filter starts with a stage sized for capacity
+   strings, when a stage is full a stage twice as large with half the
+   error rate is added, so the error rate stays below errorRate however
+   many strings are added.
+   Stages of filters with the same capacity and errorRate have the same
+   size, so two filters can be merged by or-ing their bits.
+
+   File layout: magic, error rate, capacity, number of stages, then for
+   every stage its number of bits, hashes and strings followed by its bits
+   '''
+
+   magic = 'LEBLOOM1'
+   header = struct.Struct( '>8sdQI' )
+   stageHeader = struct.Struct( '>QIQ' )
+   digest = struct.Struct( '>QQ' )
+
+   def __init__( self, capacity=100000, errorRate=0.001 ):
+      self.capacity_ = capacity
+      self.errorRate_ = errorRate
+      # [ bits, number of bits, hashes, capacity, strings ]
+      self.stages_ = []
+      self.lock_ = threading.Lock()
+      self._addStage()
+
+   def _addStage( self ):
+      i = len( self.stages_ )
+      capacity = self.capacity_ * 2 ** i
+      # the error rates of the stages add up to less than errorRate
+      p = self.errorRate_ * 0.5 ** ( i + 1 )
+      m = int( math.ceil( -capacity * math.log( p ) / math.log( 2 ) ** 2 / 8 ) ) * 8
+      k = max( 1, int( round( float( m ) / capacity * math.log( 2 ) ) ) )
+      self.stages_.append( [ bytearray( m // 8 ), m, k, capacity, 0 ] )
+
+   def _hashes( self, s ):
+      '''
+      Helper method. Returns the two hashes of s the positions of its
+      bits are derived from ( double hashing )
+      '''
+
+      return self.digest.unpack( hashlib.md5( s ).digest() )
+
+   def add( self, s ):
+      '''
+      Adds s, returns False if it was already in the filter
+      '''
+
+      ( h1, h2 ) = self._hashes( s )
+      with self.lock_:
+         if self._contains( h1, h2 ):
+            return False
+         stage = self.stages_[ -1 ]
+         if stage[ 4 ] >= stage[ 3 ]:
+            self._addStage()
+            stage = self.stages_[ -1 ]
+         ( bits, m, k ) = stage[ :3 ]
+         for i in xrange( k ):
+            bit = ( h1 + i * h2 ) % m
+            bits[ bit >> 3 ] |= 1 << ( bit & 7 )
+         stage[ 4 ] += 1
+      return True
+
+   def _contains( self, h1, h2 ):
+      for ( bits, m, k, _, _ ) in self.stages_:
+         for i in xrange( k ):
+            bit = ( h1 + i * h2 ) % m
+            if not bits[ bit >> 3 ] & ( 1 << ( bit & 7 ) ):
+               break
+         else:
+            return True
+      return False
+
+   def __contains__( self, s ):
+      ( h1, h2 ) = self._hashes( s )
+      return self._contains( h1, h2 )
+
+   def __len__( self ):
+      return sum( stage[ 4 ] for stage in self.stages_ )
+
+   def capacity( self ):
+      return self.capacity_
+
+   def errorRate( self ):
+      return self.errorRate_
+
+   def stages( self ):
+      return len( self.stages_ )
+
+   def nbytes( self ):
+      return sum( len( stage[ 0 ] ) for stage in self.stages_ )
+
+   def falsePositiveRate( self ):
+      '''
+      Returns the probability that a string that wasn't added is in the
+      filter, estimated from the number of strings in every stage
+      '''
+
+      miss = 1.0
+      for ( _, m, k, _, n ) in self.stages_:
+         miss *= 1 - ( 1 - math.exp( -float( k ) * n / m ) ) ** k
+      return 1 - miss
+
+   def update( self, other ):
+      '''
+      Adds the strings of other, a filter with the same capacity and error rate
+      '''
+
+      if ( other.capacity_, other.errorRate_ ) != ( self.capacity_, self.errorRate_ ):
+         raise ValueError( "can't merge Bloom filters of different sizes" )
+      with self.lock_:
+         while len( self.stages_ ) < len( other.stages_ ):
+            self._addStage()
+         for ( stage, otherStage ) in zip( self.stages_, other.stages_ ):
+            if not otherStage[ 4 ]:
+               continue
+            bits = stage[ 0 ]
+            merged = int( binascii.hexlify( bits ), 16 ) | \
+                     int( binascii.hexlify( otherStage[ 0 ] ), 16 )
+            bits[ : ] = binascii.unhexlify( '%0*x' % ( 2 * len( bits ), merged ) )
+            # the strings of both filters can overlap, so neither the sum nor
+            # the max of their counts is the number of strings in the stage:
+            # estimate it from the bits that are set, so that an overfull
+            # stage stops taking strings
+            ( m, k ) = stage[ 1:3 ]
+            ones = bin( merged ).count( '1' )
+            estimate = stage[ 3 ] if ones >= m else \
+                       int( math.ceil( -float( m ) / k * math.log( 1 - float( ones ) / m ) ) )
+            stage[ 4 ] = max( stage[ 4 ], otherStage[ 4 ], estimate )
+
+   def save( self, path ):
+      '''
+      Atomically writes the filter to path
+      '''
+
+      ( fd, tmpPath ) = tempfile.mkstemp( dir=os.path.dirname( os.path.abspath( path ) ) )
+      try:
+         with os.fdopen( fd, 'wb' ) as tmp:
+            with self.lock_:
+               tmp.write( self.header.pack( self.magic, self.errorRate_, self.capacity_,
+                                            len( self.stages_ ) ) )
+               for ( bits, m, k, _, n ) in self.stages_:
+                  tmp.write( self.stageHeader.pack( m, k, n ) )
+                  tmp.write( bits )
+         os.rename( tmpPath, path )
+      except:
+         try:
+            os.remove( tmpPath )
+         except OSError:
+            pass
+         raise
+
+   @classmethod
+   def load( cls, path ):
+      '''
+      Returns the filter saved in path, raises LEDataStoreException if
+      path isn't a valid filter
+      '''
+
+      with open( path, 'rb' ) as fd:
+         data = fd.read()
+      try:
+         ( magic, errorRate, capacity, nstages ) = cls.header.unpack_from( data, 0 )
+         if magic != cls.magic:
+            raise ValueError( magic )
+         bloom = cls( capacity, errorRate )
+         offset = cls.header.size
+         for i in xrange( nstages ):
+            if i:
+               bloom._addStage()
+            stage = bloom.stages_[ i ]
+            ( m, k, n ) = cls.stageHeader.unpack_from( data, offset )
+            offset += cls.stageHeader.size
+            if ( m, k ) != tuple( stage[ 1:3 ] ) or offset + m // 8 > len( data ):
+               raise ValueError( "stage %s" % i )
+            stage[ 0 ] = bytearray( data[ offset:offset + m // 8 ] )
+            stage[ 4 ] = n
+            offset += m // 8
+      except ( struct.error, ValueError ):
+         raise LEDataStoreException( "%s is not a valid Bloom filter" % path )
+      return bloom
+
+class LEFilteredDataStore( object ):
+   '''
+   Wraps a data store ( LEDataStore, LEIndexedDataStore or any data store
+   wrapper ) with a LEBloomFilter of the stored life expectancies, so that
+   fetchLifeExpectancy() answers most misses without touching the data
+   store: no path is built and no file is opened. Only the life
+   expectancies the filter may have ( every stored one and a fraction
+   errorRate of the others ) are fetched from the data store.
+
+   The filter is built from dataStore.rows() the first time and kept
+   current by addLifeExpectancy(). It is saved to path, if set, when the
+   process exits or flush() is called, merged with the filter other
+   processes saved there, and loaded from it instead of being built again.
+   Life expectancies written to the data store by other means aren't in
+   the filter until rebuild() is called, life expectancies removed from
+   it only cost a fetch.
+   Every other method is the one of the wrapped data store.
+   '''
+
+   def __init__( self, dataStore, path=None, capacity=100000, errorRate=0.001 ):
+      self.dataStore_ = dataStore
+      self.path_ = path
+      self.capacity_ = capacity
+      self.errorRate_ = errorRate
+      self.lookups_ = 0
+      self.filtered_ = 0
+      self.falsePositives_ = 0
+      self.bloom_ = None
+      if path and os.path.exists( path ):
+         try:
+            self.bloom_ = LEBloomFilter.load( path )
+         except LEDataStoreException:
+            pass
+      if self.bloom_ is None or \
+         ( self.bloom_.capacity(), self.bloom_.errorRate() ) != ( capacity, errorRate ):
+         self.rebuild()
+      if path:
+         atexit.register( self._saveAtExit )
+
+   def __getattr__( self, name ):
+      return getattr( self.dataStore_, name )
+
+   def dataStore( self ):
+      return self.dataStore_
+
+   def bloomFilter( self ):
+      return self.bloom_
+
+   def path( self ):
+      return self.path_
+
+   @staticmethod
+   def _key( date, country, dob, gender ):
+      return "%s|%s|%s|%s" % ( date.toordinal(), country, dob.toordinal(), gender )
+
+   @classmethod
+   def _lifeExpKey( cls, lifeExp ):
+      return cls._key( lifeExp.date(), lifeExp.country(), lifeExp.dob(), lifeExp.gender() )
+
+   def rebuild( self ):
+      '''
+      Builds the filter again from the rows of the data store
+      '''
+
+      bloom = LEBloomFilter( self.capacity_, self.errorRate_ )
+      for row in self.dataStore_.rows():
+         bloom.add( self._key( *row[ :4 ] ) )
+      self.bloom_ = bloom
+
+   def fetchLifeExpectancy( self, lifeExp ):
+      self.lookups_ += 1
+      if self._lifeExpKey( lifeExp ) not in self.bloom_:
+         self.filtered_ += 1
+         return None
+      delta = self.dataStore_.fetchLifeExpectancy( lifeExp )
+      if delta is None:
+         self.falsePositives_ += 1
+      return delta
+
+   def fetchMany( self, lifeExps ):
+      self.lookups_ += len( lifeExps )
+      maybe = [ self._lifeExpKey( le ) in self.bloom_ for le in lifeExps ]
+      candidates = [ le for ( le, m ) in zip( lifeExps, maybe ) if m ]
+      self.filtered_ += len( lifeExps ) - len( candidates )
+      if not candidates:
+         return [ None ] * len( lifeExps )
+      if hasattr( self.dataStore_, 'fetchMany' ):
+         fetched = self.dataStore_.fetchMany( candidates )
+      else:
+         fetched = [ self.dataStore_.fetchLifeExpectancy( le ) for le in candidates ]
+      self.falsePositives_ += fetched.count( None )
+      fetched = iter( fetched )
+      return [ next( fetched ) if m else None for m in maybe ]
+
+   def addLifeExpectancy( self, lifeExp ):
+      self.dataStore_.addLifeExpectancy( lifeExp )
+      self.bloom_.add( self._lifeExpKey( lifeExp ) )
+
+   def addMany( self, lifeExps ):
+      if hasattr( self.dataStore_, 'addMany' ):
+         self.dataStore_.addMany( lifeExps )
+      else:
+         for lifeExp in lifeExps:
+            self.dataStore_.addLifeExpectancy( lifeExp )
+      for lifeExp in lifeExps:
+         self.bloom_.add( self._lifeExpKey( lifeExp ) )
+
+   def save( self ):
+      '''
+      Merges the filter saved in path by other processes into the filter
+      and saves it to path
+      '''
+
+      if not self.path_:
+         return
+      with open( self.path_ + '.lock', 'a' ) as lock:
+         fcntl.flock( lock, fcntl.LOCK_EX )
+         try:
+            saved = LEBloomFilter.load( self.path_ )
+            self.bloom_.update( saved )
+         except ( IOError, LEDataStoreException, ValueError ):
+            # not saved yet, or by a filter of a different size
+            pass
+         self.bloom_.save( self.path_ )
+
+   def _saveAtExit( self ):
+      try:
+         self.save()
+      except EnvironmentError as e:
+         # the directory of path was removed
+         if e.errno != errno.ENOENT:
+            raise
+
+   def flush( self ):
+      '''
+      Flushes the wrapped data store if it can be flushed and saves the filter
+      '''
+
+      if hasattr( self.dataStore_, 'flush' ):
+         self.dataStore_.flush()
+      self.save()
+
+   def stats( self ):
+      '''
+      Returns the size of the filter, its estimated false positive rate and
+      the one measured on the lookups of the life expectancies the data
+      store didn't have
+      '''
+
+      misses = self.filtered_ + self.falsePositives_
+      return { 'entries': len( self.bloom_ ), 'stages': self.bloom_.stages(),
+               'bytes': self.bloom_.nbytes(), 'lookups': self.lookups_,
+               'filtered': self.filtered_, 'falsePositives': self.falsePositives_,
+               'falsePositiveRate': float( self.falsePositives_ ) / misses if misses else 0.0,
+               'estimatedFalsePositiveRate': self.bloom_.falsePositiveRate() }
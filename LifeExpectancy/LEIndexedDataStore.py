@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+from dateutil.relativedelta import relativedelta as relativedelta
+import argparse
+import datetime
+import os
+import sqlite3
+import tempfile
+import threading
+
+from LEDataStore import LEDataStore, LEDataStoreException
+from LEUtils import isDate
+
+class LEIndexedDataStore( object ):
+   '''
+   Stores life expectancies in a single sqlite file instead of
+   a hierarchy of directories. Every life expectancy is a row
+   indexed on ( date, country, dob, gender ), so a lookup is a
+   single index probe and a write never touches the directory tree.
+   '''
+
+   schema = ( "CREATE TABLE IF NOT EXISTS lifeExpectancy ("
+              " date TEXT NOT NULL, country TEXT NOT NULL,"
+              " dob TEXT NOT NULL, gender TEXT NOT NULL,"
+              " years INTEGER NOT NULL, months INTEGER NOT NULL,"
+              " days INTEGER NOT NULL,"
+              " PRIMARY KEY ( date, country, dob, gender ) )" )
+   # fetchEarlier() looks the dates of a person up
+   personIndex = ( "CREATE INDEX IF NOT EXISTS lifeExpectancyPerson ON"
+                   " lifeExpectancy ( country, dob, gender, date )" )
+
+   def __init__( self, root=tempfile.gettempdir(), filename='lifeExpectancy.db' ):
+
+      if not os.path.exists( root ):
+         raise LEDataStoreException( "Directory %s does not exist, "
+            " pick an existing root directory" % root )
+      self.root_ = os.path.abspath( root )
+      self.path_ = os.path.join( self.root_, filename )
+      self.lock_ = threading.Lock()
+      self.conn_ = sqlite3.connect( self.path_, check_same_thread=False )
+      with self.conn_:
+         self.conn_.execute( self.schema )
+         self.conn_.execute( self.personIndex )
+
+   def root( self ):
+      return self.root_
+
+   def path( self ):
+      return self.path_
+
+   def close( self ):
+      with self.lock_:
+         self.conn_.close()
+
+   @staticmethod
+   def _key( lifeExp ):
+      return ( lifeExp.date().isoformat(), lifeExp.country(),
+               lifeExp.dob().isoformat(), lifeExp.gender() )
+
+   @staticmethod
+   def _row( lifeExp ):
+      if not lifeExp.lifeExpectancy():
+         raise LEDataStoreException( "life expectancy in %s is not set" % lifeExp )
+      delta = lifeExp.lifeExpectancy()
+      return LEIndexedDataStore._key( lifeExp ) + ( delta.years, delta.months,
+                                                    delta.days )
+
+   def fetchLifeExpectancy( self, lifeExp ):
+      '''
+      Given a life expectancy object, use the date, country, dob and gender
+      to retrieve the life expectancy
+      '''
+
+      with self.lock_:
+         row = self.conn_.execute(
+            "SELECT years, months, days FROM lifeExpectancy WHERE"
+            " date = ? AND country = ? AND dob = ? AND gender = ?",
+            self._key( lifeExp ) ).fetchone()
+      if row is None:
+         return None
+      return relativedelta( years=row[ 0 ], months=row[ 1 ], days=row[ 2 ] )
+
+   def fetchEarlier( self, lifeExp, maxAge ):
+      '''
+      Returns ( date, life expectancy ) of the person of lifeExp for the
+      latest reference date before the date of lifeExp and at most maxAge
+      days before it, None if there is none
+      '''
+
+      oldest = lifeExp.date() - datetime.timedelta( days=maxAge )
+      with self.lock_:
+         row = self.conn_.execute(
+            "SELECT date, years, months, days FROM lifeExpectancy WHERE"
+            " country = ? AND dob = ? AND gender = ? AND date < ? AND date >= ?"
+            " ORDER BY date DESC LIMIT 1",
+            ( lifeExp.country(), lifeExp.dob().isoformat(), lifeExp.gender(),
+              lifeExp.date().isoformat(), oldest.isoformat() ) ).fetchone()
+      if row is None:
+         return None
+      return ( datetime.datetime.strptime( row[ 0 ], '%Y-%m-%d' ).date(),
+               relativedelta( years=row[ 1 ], months=row[ 2 ], days=row[ 3 ] ) )
+
+   def addLifeExpectancy( self, lifeExp ):
+      self.addMany( [ lifeExp ] )
+
+   def fetchMany( self, lifeExps ):
+      '''
+      Returns a list with the life expectancy ( or None ) of each
+      element of lifeExps, in the same order, using a single query
+      '''
+
+      keys = [ ( i, ) + self._key( le ) for ( i, le ) in enumerate( lifeExps ) ]
+      result = [ None ] * len( keys )
+      with self.lock_:
+         with self.conn_:
+            self.conn_.execute( "CREATE TEMP TABLE IF NOT EXISTS pending ("
+                                " idx INTEGER PRIMARY KEY, date TEXT,"
+                                " country TEXT, dob TEXT, gender TEXT )" )
+            self.conn_.execute( "DELETE FROM pending" )
+            self.conn_.executemany( "INSERT INTO pending VALUES ( ?, ?, ?, ?, ? )",
+                                    keys )
+            rows = self.conn_.execute(
+               "SELECT p.idx, l.years, l.months, l.days FROM pending p"
+               " JOIN lifeExpectancy l ON l.date = p.date AND"
+               " l.country = p.country AND l.dob = p.dob AND"
+               " l.gender = p.gender" ).fetchall()
+            self.conn_.execute( "DELETE FROM pending" )
+      for ( i, years, months, days ) in rows:
+         result[ i ] = relativedelta( years=years, months=months, days=days )
+      return result
+
+   def addMany( self, lifeExps ):
+      '''
+      Adds all the life expectancies in a single transaction.
+      Like LEDataStore, a life expectancy that is already stored
+      is not overwritten.
+      '''
+
+      rows = [ self._row( le ) for le in lifeExps ]
+      with self.lock_:
+         with self.conn_:
+            self.conn_.executemany( "INSERT OR IGNORE INTO lifeExpectancy"
+                                    " VALUES ( ?, ?, ?, ?, ?, ?, ? )", rows )
+
+   def dates( self ):
+      '''
+      Returns the sorted list of reference dates with stored life expectancies
+      '''
+
+      with self.lock_:
+         rows = self.conn_.execute( "SELECT DISTINCT date FROM lifeExpectancy"
+                                    " ORDER BY date" ).fetchall()
+      return [ datetime.datetime.strptime( row[ 0 ], '%Y-%m-%d' ).date()
+               for row in rows ]
+
+   @staticmethod
+   def _toRows( rows ):
+      toDate = lambda d: datetime.datetime.strptime( d, '%Y-%m-%d' ).date()
+      return [ ( toDate( date ), country.encode( 'utf-8' ), toDate( dob ),
+                 gender.encode( 'utf-8' ), years, months, days )
+               for ( date, country, dob, gender, years, months, days ) in rows ]
+
+   def rows( self ):
+      '''
+      Returns ( date, country, dob, gender, years, months, days ) for every
+      stored life expectancy, like LEDataStore.rows()
+      '''
+
+      with self.lock_:
+         rows = self.conn_.execute( "SELECT * FROM lifeExpectancy" ).fetchall()
+      return self._toRows( rows )
+
+   def recent( self, date, n ):
+      '''
+      Returns the rows of the n most recently written life expectancies
+      of the reference date, the most recent first
+      '''
+
+      with self.lock_:
+         rows = self.conn_.execute( "SELECT * FROM lifeExpectancy WHERE date = ?"
+                                    " ORDER BY rowid DESC LIMIT ?",
+                                    ( date.isoformat(), n ) ).fetchall()
+      return self._toRows( rows )
+
+   def compact( self, olderThan=None ):
+      '''
+      Removes the life expectancies of the reference dates before olderThan
+      ( today by default ), returns the number of removed life expectancies
+      '''
+
+      ( v, olderThan ) = isDate( olderThan or datetime.date.today() )
+      if not v:
+         raise LEDataStoreException( olderThan )
+      with self.lock_:
+         with self.conn_:
+            cursor = self.conn_.execute( "DELETE FROM lifeExpectancy WHERE date < ?",
+                                         ( olderThan.isoformat(), ) )
+         self.conn_.execute( "VACUUM" )
+      return cursor.rowcount
+
+   def usage( self ):
+      '''
+      Returns the number of reference dates, stored life expectancies
+      and bytes used by the data store
+      '''
+
+      with self.lock_:
+         ( dates, entries ) = self.conn_.execute(
+            "SELECT COUNT( DISTINCT date ), COUNT( * ) FROM lifeExpectancy" ).fetchone()
+      return { 'dates': dates, 'entries': entries,
+               'bytes': os.path.getsize( self.path_ ) }
+
+   def importDirectory( self, directory ):
+      '''
+      Imports the life expectancies of a LEDataStore directory tree:
+      /directory/date.year/date.month/date.day/country/dob.year/dob.month/dob.day/gender
+      Returns the number of imported files
+      Raises LEDataStoreException if directory doesn't exist
+      '''
+
+      directory = os.path.abspath( directory )
+      # LEDataStore creates its directory, a mistyped path would import nothing
+      if not os.path.isdir( directory ):
+         raise LEDataStoreException( "Directory %s does not exist" % directory )
+      dataStore = LEDataStore( root=os.path.dirname( directory ),
+                               directory=os.path.basename( directory ) )
+      rows = ( ( row[ 0 ].isoformat(), row[ 1 ], row[ 2 ].isoformat() ) + row[ 3: ]
+               for row in dataStore.rows() )
+
+      with self.lock_:
+         with self.conn_:
+            before = self.conn_.total_changes
+            self.conn_.executemany( "INSERT OR IGNORE INTO lifeExpectancy"
+                                    " VALUES ( ?, ?, ?, ?, ?, ?, ? )", rows )
+            return self.conn_.total_changes - before
+
+def main():
+   parser = argparse.ArgumentParser(
+      description="Import a LEDataStore directory tree into a LEIndexedDataStore" )
+   parser.add_argument( 'directory', help="LEDataStore directory, e.g. /tmp/lifeExpectancy" )
+   parser.add_argument( 'database', help="sqlite file to import into" )
+   args = parser.parse_args()
+
+   database = os.path.abspath( args.database )
+   store = LEIndexedDataStore( root=os.path.dirname( database ),
+                               filename=os.path.basename( database ) )
+   try:
+      imported = store.importDirectory( args.directory )
+   except LEDataStoreException as e:
+      parser.error( str( e ) )
+   finally:
+      store.close()
+   print "Imported %s life expectancies into %s" % ( imported, database )
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+import csv
+import datetime
+
+class LELifeTableException( Exception ):
+   pass
+
+class LELifeTable( object ):
+   '''
+   Offline replacement for WPA based on a life table.
+   The life table is a CSV file with a header and one row per
+   country, gender and age ( in whole years, starting from 0 ):
+
+   country,gender,age,qx
+
+   where qx is the probability that a person of that age dies
+   within a year. The last age of each country and gender is
+   treated as the end of the table ( qx = 1 ).
+
+   For every country and gender the survival curve lx and the
+   person-years lived after each age Tx are precomputed, assuming
+   deaths are uniformly distributed within each year of age, so that
+   the remaining life expectancy at any fractional age is computed in
+   constant time.
+   It exposes the same interface as LEWPAFetcher so the frontend can use
+   either one as provider.
+   '''
+
+   def __init__( self, path ):
+      self.path_ = path
+      # ( country, gender ) -> ( qx, lx, Tx )
+      self.tables_ = {}
+      self.queries_ = 0
+
+      rows = {}
+      with open( path, 'r' ) as fd:
+         for row in csv.DictReader( fd ):
+            try:
+               key = ( row[ 'country' ], row[ 'gender' ].lower() )
+               rows.setdefault( key, {} )[ int( row[ 'age' ] ) ] = float( row[ 'qx' ] )
+            except ( KeyError, TypeError, ValueError ):
+               raise LELifeTableException( "invalid life table row %s in %s" %
+                                           ( row, path ) )
+
+      for ( key, ages ) in rows.iteritems():
+         if sorted( ages ) != range( len( ages ) ):
+            raise LELifeTableException( "life table for %s %s has missing ages" % key )
+         qx = [ ages[ age ] for age in xrange( len( ages ) ) ]
+         qx[ -1 ] = 1.0
+         lx = [ 1.0 ]
+         for q in qx:
+            lx.append( lx[ -1 ] * ( 1 - q ) )
+         # person-years lived between age x and x + 1, then after age x
+         Lx = [ ( lx[ x ] + lx[ x + 1 ] ) / 2 for x in xrange( len( qx ) ) ]
+         Tx = [ 0.0 ] * ( len( qx ) + 1 )
+         for x in reversed( xrange( len( qx ) ) ):
+            Tx[ x ] = Tx[ x + 1 ] + Lx[ x ]
+         self.tables_[ key ] = ( qx, lx, Tx )
+
+      self.countries_ = sorted( set( country for ( country, _ ) in self.tables_ ) )
+
+   def path( self ):
+      return self.path_
+
+   def queries( self ):
+      return self.queries_
+
+   def stats( self ):
+      return { 'queries': self.queries_ }
+
+   def close( self ):
+      pass
+
+   def expectancy( self, country, gender, age ):
+      '''
+      Returns a tuple with a verification boolean + the remaining life
+      expectancy in years at age ( a float number of years ) or an error message
+      '''
+
+      self.queries_ += 1
+      table = self.tables_.get( ( country, gender ) )
+      if not table:
+         return ( False, "%s %s is not in the life table" % ( country, gender ) )
+      ( qx, lx, Tx ) = table
+      x = int( age )
+      if x >= len( qx ):
+         return ( True, 0.0 )
+      if lx[ x ] == 0:
+         return ( True, 0.0 )
+      f = age - x
+      # uniform distribution of deaths between x and x + 1
+      lxf = lx[ x ] * ( 1 - f * qx[ x ] )
+      if lxf <= 0:
+         return ( True, 0.0 )
+      Txf = Tx[ x ] - lx[ x ] * ( f - qx[ x ] * f * f / 2 )
+      return ( True, Txf / lxf )
+
+   def remaining( self, lifeExp ):
+      '''
+      Returns the remaining life expectancy of an object of class LifeExpectancy
+      '''
+
+      age = ( lifeExp.date() - lifeExp.dob() ).days / 365.25
+      return self.expectancy( lifeExp.country(), lifeExp.gender(), max( age, 0.0 ) )
+
+   def total( self, lifeExp ):
+      '''
+      Returns the total life expectancy of an object of class LifeExpectancy
+      based solely on its date of birth
+      '''
+
+      return self.expectancy( lifeExp.country(), lifeExp.gender(), 0.0 )
+
+   def countries( self ):
+      return self.countries_
+
+   def fetch( self, lifeExp ):
+      '''
+      Same as LEWPAFetcher.fetch()
+      '''
+
+      if lifeExp.dob() > datetime.date.today():
+         # set the date as the date of birth so that we will not recalculate
+         # it until the dob has passed
+         lifeExp.setDate( lifeExp.dob() )
+         return self.total( lifeExp )
+      return self.remaining( lifeExp )
+
+   def fetchMany( self, lifeExps ):
+      return [ self.fetch( le ) for le in lifeExps ]
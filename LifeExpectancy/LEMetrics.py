@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import bisect
+import json
+import os
+import tempfile
+import threading
+import timeit
+
+class _Timer( object ):
+   def __init__( self, metrics, stage ):
+      self.metrics_ = metrics
+      self.stage_ = stage
+
+   def __enter__( self ):
+      self.start_ = timeit.default_timer()
+      return self
+
+   def __exit__( self, *exc ):
+      self.metrics_.observe( self.stage_, timeit.default_timer() - self.start_ )
+      return False
+
+class LEMetrics( object ):
+   '''
+   Latency histograms per stage of the request pipeline and counters.
+   Recording a value is a lock, a bisect and a few additions so it can
+   always be left on. The metrics are exported either as a JSON
+   snapshot or in the Prometheus text format.
+   '''
+
+   # upper bounds in seconds of the latency buckets
+   buckets = [ 0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0 ]
+
+   def __init__( self, prefix='lifeexpectancy' ):
+      self.prefix_ = prefix
+      self.lock_ = threading.Lock()
+      # stage -> [ count per bucket ( last one is +Inf ), sum, count ]
+      self.stages_ = {}
+      self.counters_ = {}
+
+   def timer( self, stage ):
+      '''
+      Context manager recording the time spent in its block under stage
+      '''
+      return _Timer( self, stage )
+
+   def observe( self, stage, seconds ):
+      with self.lock_:
+         hist = self.stages_.get( stage )
+         if hist is None:
+            hist = self.stages_[ stage ] = [ [ 0 ] * ( len( self.buckets ) + 1 ), 0.0, 0 ]
+         hist[ 0 ][ bisect.bisect_left( self.buckets, seconds ) ] += 1
+         hist[ 1 ] += seconds
+         hist[ 2 ] += 1
+
+   def incr( self, counter, n=1 ):
+      with self.lock_:
+         self.counters_[ counter ] = self.counters_.get( counter, 0 ) + n
+
+   def counter( self, counter ):
+      return self.counters_.get( counter, 0 )
+
+   def reset( self ):
+      with self.lock_:
+         self.stages_ = {}
+         self.counters_ = {}
+
+   def data( self ):
+      '''
+      Returns the histograms and counters in a picklable form for merge(),
+      e.g. to send the metrics of a batch worker to the main process
+      '''
+
+      with self.lock_:
+         return ( dict( ( stage, [ list( counts ), total, count ] )
+                        for ( stage, ( counts, total, count ) ) in self.stages_.iteritems() ),
+                  dict( self.counters_ ) )
+
+   def merge( self, data ):
+      '''
+      Adds the histograms and counters returned by data() of other metrics
+      '''
+
+      ( stages, counters ) = data
+      with self.lock_:
+         for ( stage, ( counts, total, count ) ) in stages.iteritems():
+            hist = self.stages_.get( stage )
+            if hist is None:
+               hist = self.stages_[ stage ] = [ [ 0 ] * ( len( self.buckets ) + 1 ), 0.0, 0 ]
+            hist[ 0 ] = [ a + b for ( a, b ) in zip( hist[ 0 ], counts ) ]
+            hist[ 1 ] += total
+            hist[ 2 ] += count
+         for ( counter, n ) in counters.iteritems():
+            self.counters_[ counter ] = self.counters_.get( counter, 0 ) + n
+
+   def snapshot( self ):
+      '''
+      Returns the current metrics as a dict
+      '''
+
+      with self.lock_:
+         stages = {}
+         for ( stage, ( counts, total, count ) ) in self.stages_.iteritems():
+            stages[ stage ] = { 'count': count,
+                                'sum': total,
+                                'mean': total / count if count else 0.0,
+                                'buckets': dict( zip( [ str( b ) for b in self.buckets ] +
+                                                      [ '+Inf' ], counts ) ) }
+         return { 'stages': stages, 'counters': dict( self.counters_ ) }
+
+   def prometheus( self ):
+      '''
+      Returns the current metrics in the Prometheus text format
+      '''
+
+      lines = []
+      with self.lock_:
+         name = "%s_stage_seconds" % self.prefix_
+         lines.append( "# TYPE %s histogram" % name )
+         for stage in sorted( self.stages_ ):
+            ( counts, total, count ) = self.stages_[ stage ]
+            cumulative = 0
+            for ( bound, n ) in zip( [ repr( b ) for b in self.buckets ] + [ '+Inf' ],
+                                     counts ):
+               cumulative += n
+               lines.append( '%s_bucket{stage="%s",le="%s"} %s' %
+                             ( name, stage, bound, cumulative ) )
+            lines.append( '%s_sum{stage="%s"} %r' % ( name, stage, total ) )
+            lines.append( '%s_count{stage="%s"} %s' % ( name, stage, count ) )
+         for counter in sorted( self.counters_ ):
+            name = "%s_%s_total" % ( self.prefix_, counter )
+            lines.append( "# TYPE %s counter" % name )
+            lines.append( "%s %s" % ( name, self.counters_[ counter ] ) )
+      return "\n".join( lines ) + "\n"
+
+   def export( self, path ):
+      '''
+      Atomically writes the metrics to path, in the Prometheus text format
+      if path ends with .prom, as a JSON snapshot otherwise
+      '''
+
+      if path.endswith( '.prom' ):
+         data = self.prometheus()
+      else:
+         data = json.dumps( self.snapshot(), indent=1, sort_keys=True )
+      ( fd, tmpPath ) = tempfile.mkstemp( dir=os.path.dirname( os.path.abspath( path ) ) )
+      with os.fdopen( fd, 'w' ) as tmp:
+         tmp.write( data )
+      os.rename( tmpPath, path )
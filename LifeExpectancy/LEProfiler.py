@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+import StringIO
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+class _Stats( object ):
+   '''
+   Helper class. Raw cProfile stats in the form pstats.Stats loads
+   from a profiler
+   '''
+
+   def __init__( self, stats ):
+      self.stats = stats
+
+   def create_stats( self ):
+      pass
+
+class LEProfiler( object ):
+   '''
+   Opt-in profiler of the entry points.
+   A sampler thread records the stack of every thread every interval
+   seconds of wall clock, so the time spent waiting on WPA or the disk
+   shows up next to the time spent computing. With deterministic set
+   cProfile also records every call of the threads started after start(),
+   with exact call counts and times.
+   The profiles of several processes are aggregated with data() and
+   merge(). report() writes the functions ranked by their own time and
+   collapsed() the stacks in the folded format of flamegraph.pl and
+   speedscope ( "frame;frame;frame count" per line, root first )
+   '''
+
+   # a sampled stack ending in these modules is a thread waiting for work,
+   # a lock or a socket rather than running
+   idleModules = ( 'threading.py', 'Queue.py', 'queues.py', 'socket.py',
+                   'SocketServer.py', 'connection.py' )
+
+   def __init__( self, deterministic=True, interval=0.005 ):
+      self.deterministic_ = deterministic
+      self.interval_ = interval
+      self.lock_ = threading.Lock()
+      # thread ident -> cProfile.Profile
+      self.profiles_ = {}
+      # merged raw cProfile stats of stopped profiles and other processes
+      self.stats_ = None
+      # stack ( tuple of frames, root first ) -> samples
+      self.stacks_ = {}
+      self.processes_ = 1
+      self.stop_ = threading.Event()
+      self.sampler_ = None
+
+   def deterministic( self ):
+      return self.deterministic_
+
+   def interval( self ):
+      return self.interval_
+
+   def processes( self ):
+      return self.processes_
+
+   def stats( self ):
+      '''
+      Returns the pstats.Stats of the deterministic profile, None if there isn't one
+      '''
+      return self.stats_
+
+   def samples( self ):
+      return sum( self.stacks_.itervalues() )
+
+   def __enter__( self ):
+      return self.start()
+
+   def __exit__( self, *exc ):
+      self.stop()
+      return False
+
+   def start( self ):
+      self.stop_.clear()
+      self.sampler_ = threading.Thread( target=self._sample )
+      self.sampler_.daemon = True
+      self.sampler_.start()
+      if self.deterministic_:
+         threading.setprofile( self._enableThread )
+         self._enable()
+      return self
+
+   def _enable( self ):
+      profile = cProfile.Profile()
+      with self.lock_:
+         self.profiles_[ threading.current_thread().ident ] = profile
+      profile.enable()
+
+   def _enableThread( self, *args ):
+      # first event of a new thread, cProfile replaces this function
+      sys.setprofile( None )
+      if not self.stop_.is_set() and threading.current_thread() is not self.sampler_:
+         self._enable()
+
+   def stop( self ):
+      if self.sampler_ is None:
+         return
+      self.stop_.set()
+      self.sampler_.join()
+      self.sampler_ = None
+      if not self.deterministic_:
+         return
+      threading.setprofile( None )
+      with self.lock_:
+         profiles = self.profiles_.values()
+         self.profiles_ = {}
+      for profile in profiles:
+         # disable() only stops the current thread, the others stop
+         # recording when they exit
+         profile.disable()
+         profile.create_stats()
+         self._mergeStats( profile )
+
+   def _mergeStats( self, stats ):
+      if self.stats_ is None:
+         self.stats_ = pstats.Stats( stats )
+      else:
+         self.stats_.add( stats )
+
+   @staticmethod
+   def _frame( frame ):
+      code = frame.f_code
+      return "%s (%s:%s)" % ( code.co_name, os.path.basename( code.co_filename ),
+                              code.co_firstlineno )
+
+   def _sample( self ):
+      me = threading.current_thread().ident
+      while not self.stop_.wait( self.interval_ ):
+         for ( ident, frame ) in sys._current_frames().items():
+            if ident == me:
+               continue
+            stack = []
+            while frame is not None:
+               stack.append( self._frame( frame ) )
+               frame = frame.f_back
+            stack = tuple( reversed( stack ) )
+            self.stacks_[ stack ] = self.stacks_.get( stack, 0 ) + 1
+
+   def data( self ):
+      '''
+      Returns the profile of a stopped profiler in a form that can be
+      pickled and sent to another process to merge()
+      '''
+
+      return { 'stats': self.stats_.stats if self.stats_ is not None else None,
+               'stacks': self.stacks_, 'processes': self.processes_ }
+
+   def merge( self, data ):
+      '''
+      Adds the profile returned by data() of another profiler
+      '''
+
+      if data[ 'stats' ] is not None:
+         self._mergeStats( _Stats( data[ 'stats' ] ) )
+      for ( stack, samples ) in data[ 'stacks' ].iteritems():
+         self.stacks_[ stack ] = self.stacks_.get( stack, 0 ) + samples
+      self.processes_ += data[ 'processes' ]
+
+   def _idle( self, stack ):
+      return stack[ -1 ].rpartition( '(' )[ 2 ].partition( ':' )[ 0 ] in self.idleModules
+
+   def idleSamples( self ):
+      return sum( samples for ( stack, samples ) in self.stacks_.iteritems()
+                  if stack and self._idle( stack ) )
+
+   def hotFunctions( self ):
+      '''
+      Returns ( function, own samples, total samples ) of the functions
+      sampled while running ( see idleModules ), the most own samples first
+      '''
+
+      own = {}
+      total = {}
+      for ( stack, samples ) in self.stacks_.iteritems():
+         if not stack or self._idle( stack ):
+            continue
+         own[ stack[ -1 ] ] = own.get( stack[ -1 ], 0 ) + samples
+         for frame in set( stack ):
+            total[ frame ] = total.get( frame, 0 ) + samples
+      return sorted( ( ( frame, own.get( frame, 0 ), samples )
+                       for ( frame, samples ) in total.iteritems() ),
+                     key=lambda f: ( -f[ 1 ], -f[ 2 ], f[ 0 ] ) )
+
+   def report( self, fd, limit=40 ):
+      '''
+      Writes the limit hottest functions to fd: by own and total samples
+      of the running threads, then by own time in the deterministic profile
+      '''
+
+      idle = self.idleSamples()
+      samples = self.samples() - idle
+      fd.write( "%s samples every %sms in %s processes, %s more of waiting threads\n\n" %
+                ( samples, self.interval_ * 1000, self.processes_, idle ) )
+      fd.write( "%7s %7s  %s\n" % ( 'own %', 'total %', 'function' ) )
+      for ( frame, own, total ) in self.hotFunctions()[ :limit ]:
+         fd.write( "%7.2f %7.2f  %s\n" % ( 100.0 * own / samples, 100.0 * total / samples,
+                                           frame ) )
+      if self.stats_ is not None:
+         fd.write( "\nDeterministic profile:\n" )
+         out = StringIO.StringIO()
+         self.stats_.stream = out
+         self.stats_.sort_stats( 'tottime' ).print_stats( limit )
+         fd.write( out.getvalue() )
+
+   def collapsed( self, fd ):
+      '''
+      Writes the sampled stacks to fd in the folded stack format
+      '''
+
+      for ( stack, samples ) in sorted( self.stacks_.iteritems() ):
+         if stack:
+            fd.write( "%s %s\n" % ( ";".join( stack ), samples ) )
+
+   def save( self, path ):
+      '''
+      Writes the report to path, the collapsed stacks to path.collapsed
+      and the deterministic profile, if any, to path.pstats ( for
+      pstats, snakeviz, gprof2dot... )
+      '''
+
+      with open( path, 'w' ) as fd:
+         self.report( fd )
+      with open( path + '.collapsed', 'w' ) as fd:
+         self.collapsed( fd )
+      if self.stats_ is not None:
+         self.stats_.dump_stats( path + '.pstats' )
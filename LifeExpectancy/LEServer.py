@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import urlparse
+
+class LERequestHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+   '''
+   HTTP/JSON API of LEServer:
+   GET /lifeExpectancy?country=..&dob=..&gender=..[&name=..] scores a person
+   POST /lifeExpectancy with a JSON object scores a person, with a JSON
+   list scores every person of the list and returns the list of results
+   GET /stats returns the stats of the server as JSON
+   GET /metrics returns the metrics in the Prometheus text format
+   A request that fails unexpectedly is answered with a 500, unless its
+   response was already started, in which case the connection is closed
+   '''
+
+   protocol_version = 'HTTP/1.1'
+   # write the headers and the body of a response in a single packet,
+   # otherwise keep-alive clients wait for the delayed ACK of the headers
+   wbufsize = -1
+   disable_nagle_algorithm = True
+
+   def do_GET( self ):
+      self.guard( self.get )
+
+   def do_POST( self ):
+      self.guard( self.post )
+
+   def guard( self, handler ):
+      '''
+      Runs handler, replies 500 if it raises before starting its response
+      '''
+
+      self.responded_ = False
+      try:
+         handler()
+      except Exception as e:
+         # the request may be half read, the connection can't be reused
+         self.close_connection = True
+         if not self.responded_:
+            self.reply( 500, { 'error': "internal error: %s" % e } )
+
+   def send_response( self, code, message=None ):
+      self.responded_ = True
+      BaseHTTPServer.BaseHTTPRequestHandler.send_response( self, code, message )
+
+   def get( self ):
+      url = urlparse.urlparse( self.path )
+      if url.path == '/lifeExpectancy':
+         query = urlparse.parse_qs( url.query )
+         record = dict( ( k, v[ 0 ] ) for ( k, v ) in query.iteritems() )
+         self.scoreOne( record )
+      elif url.path == '/stats':
+         self.reply( 200, self.server.stats() )
+      elif url.path == '/metrics' and self.server.metrics():
+         self.reply( 200, self.server.metrics().prometheus(), 'text/plain; version=0.0.4' )
+      else:
+         self.reply( 404, { 'error': "%s not found" % url.path } )
+
+   def post( self ):
+      if urlparse.urlparse( self.path ).path != '/lifeExpectancy':
+         self.reply( 404, { 'error': "%s not found" % self.path } )
+         return
+      try:
+         length = int( self.headers.get( 'Content-Length', 0 ) )
+      except ValueError:
+         length = -1
+      if length < 0:
+         # the end of the body is unknown, the connection can't be reused
+         self.close_connection = True
+         self.reply( 400, { 'error': "invalid Content-Length %s" %
+                            self.headers.get( 'Content-Length' ) } )
+         return
+      if length > self.server.maxBody():
+         # the body isn't read, the connection can't be reused
+         self.close_connection = True
+         self.reply( 413, { 'error': "request larger than %s bytes" % self.server.maxBody() } )
+         return
+      try:
+         body = json.loads( self.rfile.read( length ) )
+      except ValueError as e:
+         self.reply( 400, { 'error': "invalid JSON: %s" % e } )
+         return
+      if isinstance( body, dict ):
+         self.scoreOne( self.toStr( body ) )
+      elif isinstance( body, list ):
+         results = self.server.score( [ self.toStr( r ) if isinstance( r, dict ) else
+                                        "record has to be a JSON object" for r in body ] )
+         self.reply( 200, [ result if v else { 'error': result }
+                            for ( v, result ) in results ] )
+      else:
+         self.reply( 400, { 'error': "body has to be a JSON object or list" } )
+
+   @staticmethod
+   def toStr( record ):
+      # json returns unicode, LifeExpectancy works with str
+      return dict( ( k, v.encode( 'utf-8' ) if isinstance( v, unicode ) else v )
+                   for ( k, v ) in record.iteritems() )
+
+   def scoreOne( self, record ):
+      ( v, result ) = self.server.score( [ record ] )[ 0 ]
+      if v:
+         self.reply( 200, result )
+      else:
+         self.reply( 400, { 'error': result } )
+
+   def reply( self, status, body, contentType='application/json' ):
+      data = body if isinstance( body, str ) else json.dumps( body )
+      self.send_response( status )
+      self.send_header( 'Content-Type', contentType )
+      self.send_header( 'Content-Length', str( len( data ) ) )
+      self.end_headers()
+      self.wfile.write( data )
+
+   def log_message( self, *args ):
+      pass
+
+class LEServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+   '''
+   Long running lookup service. Every client connection is served by its
+   own thread, so a client waiting on a slow provider doesn't block the
+   others, and the state behind score ( cache, data storage, request cache )
+   stays warm across requests.
+   score takes a list of batch records and returns a tuple with a
+   verification boolean + a result or an error message for each of them,
+   stats returns a JSON serializable dict
+   '''
+
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__( self, address, score, stats=None, metrics=None, maxBody=16 * 1024 * 1024 ):
+      BaseHTTPServer.HTTPServer.__init__( self, address, LERequestHandler )
+      self.score_ = score
+      self.stats_ = stats
+      self.metrics_ = metrics
+      self.maxBody_ = maxBody
+      self.thread_ = None
+
+   def score( self, records ):
+      if self.metrics_ is None:
+         return self.score_( records )
+      self.metrics_.incr( 'server_requests' )
+      self.metrics_.incr( 'server_records', len( records ) )
+      with self.metrics_.timer( 'server_score' ):
+         return self.score_( records )
+
+   def stats( self ):
+      return self.stats_() if self.stats_ else {}
+
+   def metrics( self ):
+      return self.metrics_
+
+   def maxBody( self ):
+      return self.maxBody_
+
+   def url( self ):
+      return "http://%s:%s" % self.server_address[ :2 ]
+
+   def start( self ):
+      '''
+      Serves in a background thread
+      '''
+
+      self.thread_ = threading.Thread( target=self.serve_forever )
+      self.thread_.daemon = True
+      self.thread_.start()
+      return self
+
+   def stop( self ):
+      self.shutdown()
+      self.server_close()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import threading
+
+class _Call( object ):
+   def __init__( self ):
+      self.done_ = threading.Event()
+      self.result_ = None
+      self.error_ = None
+
+class LESingleFlight( object ):
+   '''
+   Coalesces concurrent calls for the same key: the first caller of do()
+   runs the function, the callers arriving while it is still running wait
+   for it and share its result ( or exception ) instead of running it again.
+   '''
+
+   def __init__( self ):
+      self.lock_ = threading.Lock()
+      self.calls_ = {}
+      self.executed_ = 0
+      self.coalesced_ = 0
+
+   def do( self, key, fn, *args ):
+      with self.lock_:
+         call = self.calls_.get( key )
+         leader = call is None
+         if leader:
+            call = _Call()
+            self.calls_[ key ] = call
+            self.executed_ += 1
+         else:
+            self.coalesced_ += 1
+
+      if not leader:
+         call.done_.wait()
+         if call.error_:
+            raise call.error_
+         return call.result_
+
+      try:
+         call.result_ = fn( *args )
+      except Exception as e:
+         call.error_ = e
+         raise
+      finally:
+         with self.lock_:
+            del self.calls_[ key ]
+         call.done_.set()
+      return call.result_
+
+   def executed( self ):
+      return self.executed_
+
+   def coalesced( self ):
+      return self.coalesced_
+
+   def inFlight( self ):
+      return len( self.calls_ )
+
+   def stats( self ):
+      return { 'executed': self.executed_,
+               'coalesced': self.coalesced_,
+               'inFlight': self.inFlight() }
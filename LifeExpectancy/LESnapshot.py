@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+from dateutil.relativedelta import relativedelta as relativedelta
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+
+from LEDataStore import LEDataStore, LEDataStoreException
+from LEIndexedDataStore import LEIndexedDataStore
+
+class LESnapshot( object ):
+   '''
+   Read-only snapshot of a data store in a single binary file.
+   The file is memory mapped, so every process opening the same snapshot
+   shares one copy in the page cache, and a lookup is a binary search
+   over fixed width records that never calls the operating system.
+
+   File layout:
+   - header: magic, number of records, number of countries
+   - countries: length and utf-8 name of each country, sorted
+   - records sorted by key: date ordinal, country index, dob ordinal,
+     gender ( 0 male, 1 female ), then years, months and days, 15 bytes.
+     Everything is big endian so that comparing the bytes of two keys
+     compares the keys: the binary search compares 11 byte slices of the
+     keys, which is faster than unpacking them.
+
+   A miss in the snapshot is looked up in dataStore if set, and
+   addLifeExpectancy() goes to dataStore: the snapshot never changes.
+   '''
+
+   magic = 'LESNAP01'
+   header = struct.Struct( '>8sIH' )
+   length = struct.Struct( '>H' )
+   record = struct.Struct( '>IHIBHBB' )
+   key = struct.Struct( '>IHIB' )
+   value = struct.Struct( '>HBB' )
+
+   def __init__( self, path, dataStore=None ):
+      self.path_ = path
+      self.dataStore_ = dataStore
+      with open( path, 'rb' ) as fd:
+         self.mmap_ = mmap.mmap( fd.fileno(), 0, access=mmap.ACCESS_READ )
+      ( magic, self.size_, ncountries ) = self.header.unpack_from( self.mmap_, 0 )
+      if magic != self.magic:
+         self.mmap_.close()
+         raise LEDataStoreException( "%s is not a life expectancy snapshot" % path )
+      offset = self.header.size
+      # country -> index in the snapshot
+      self.countries_ = {}
+      for i in xrange( ncountries ):
+         ( n, ) = self.length.unpack_from( self.mmap_, offset )
+         offset += self.length.size
+         self.countries_[ self.mmap_[ offset:offset + n ] ] = i
+         offset += n
+      self.offset_ = offset
+
+   def __getattr__( self, name ):
+      if self.dataStore_ is None:
+         raise AttributeError( name )
+      return getattr( self.dataStore_, name )
+
+   def __len__( self ):
+      return self.size_
+
+   def path( self ):
+      return self.path_
+
+   def dataStore( self ):
+      return self.dataStore_
+
+   def close( self ):
+      self.mmap_.close()
+
+   def _search( self, lifeExp ):
+      '''
+      Returns the life expectancy of lifeExp in the snapshot, None if
+      it is not there
+      '''
+
+      country = self.countries_.get( lifeExp.country() )
+      if country is None:
+         return None
+      key = self.key.pack( lifeExp.date().toordinal(), country,
+                           lifeExp.dob().toordinal(),
+                           1 if lifeExp.gender() == 'female' else 0 )
+      ( lo, hi ) = ( 0, self.size_ )
+      ( mm, offset, size, n ) = ( self.mmap_, self.offset_, self.record.size,
+                                  self.key.size )
+      while lo < hi:
+         mid = ( lo + hi ) // 2
+         start = offset + mid * size
+         if mm[ start:start + n ] < key:
+            lo = mid + 1
+         else:
+            hi = mid
+      start = offset + lo * size
+      if lo == self.size_ or mm[ start:start + n ] != key:
+         return None
+      ( years, months, days ) = self.value.unpack_from( mm, start + n )
+      return relativedelta( years=years, months=months, days=days )
+
+   def fetchLifeExpectancy( self, lifeExp ):
+      delta = self._search( lifeExp )
+      if delta is None and self.dataStore_ is not None:
+         return self.dataStore_.fetchLifeExpectancy( lifeExp )
+      return delta
+
+   def fetchMany( self, lifeExps ):
+      return [ self.fetchLifeExpectancy( le ) for le in lifeExps ]
+
+   def addLifeExpectancy( self, lifeExp ):
+      if self.dataStore_ is None:
+         raise LEDataStoreException( "snapshot %s is read only" % self.path_ )
+      self.dataStore_.addLifeExpectancy( lifeExp )
+
+   @classmethod
+   def export( cls, dataStore, path ):
+      '''
+      Atomically writes a snapshot of the life expectancies returned by
+      dataStore.rows() to path, returns the number of records
+      '''
+
+      rows = list( dataStore.rows() )
+      countries = sorted( set( row[ 1 ] for row in rows ) )
+      index = dict( ( country, i ) for ( i, country ) in enumerate( countries ) )
+      records = sorted( ( date.toordinal(), index[ country ], dob.toordinal(),
+                          1 if gender == 'female' else 0, years, months, days )
+                        for ( date, country, dob, gender, years, months, days ) in rows )
+      # a key appears once, keys must be unique for the binary search
+      records = [ r for ( i, r ) in enumerate( records )
+                  if i == 0 or r[ :4 ] != records[ i - 1 ][ :4 ] ]
+
+      ( fd, tmpPath ) = tempfile.mkstemp( dir=os.path.dirname( os.path.abspath( path ) ) )
+      with os.fdopen( fd, 'wb' ) as tmp:
+         tmp.write( cls.header.pack( cls.magic, len( records ), len( countries ) ) )
+         for country in countries:
+            tmp.write( cls.length.pack( len( country ) ) + country )
+         for record in records:
+            tmp.write( cls.record.pack( *record ) )
+      os.rename( tmpPath, path )
+      return len( records )
+
+def main():
+   parser = argparse.ArgumentParser(
+      description="Export a data store to a read-only LESnapshot file" )
+   parser.add_argument( 'store', help="LEDataStore directory, e.g. /tmp/lifeExpectancy,"
+                        " or LEIndexedDataStore sqlite file" )
+   parser.add_argument( 'snapshot', help="snapshot file to write" )
+   args = parser.parse_args()
+
+   store = os.path.abspath( args.store )
+   if os.path.isdir( store ):
+      dataStore = LEDataStore( root=os.path.dirname( store ),
+                               directory=os.path.basename( store ) )
+   else:
+      dataStore = LEIndexedDataStore( root=os.path.dirname( store ),
+                                      filename=os.path.basename( store ) )
+   exported = LESnapshot.export( dataStore, args.snapshot )
+   print "Exported %s life expectancies to %s" % ( exported, args.snapshot )
+
+if __name__ == "__main__":
+   main()
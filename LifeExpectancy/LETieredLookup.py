@@ -0,0 +1,679 @@
+#!/usr/bin/env python
+from collections import OrderedDict
+from dateutil.relativedelta import relativedelta as relativedelta
+import Queue
+import array
+import calendar
+import datetime
+import math
+import threading
+import time
+
+from LECache import LECache
+from LEMetrics import LEMetrics
+from LEUtils import LifeExpectancy
+
+def providerRequestKey( lifeExp ):
+   '''
+   Returns the parameters of the provider request for lifeExp:
+   the /total/ API ones if the dob is in the future, in which case
+   the date of lifeExp is set to its dob like provider.fetch() does,
+   the /remaining/ API ones otherwise
+   '''
+
+   if lifeExp.dob() > datetime.date.today():
+      lifeExp.setDate( lifeExp.dob() )
+      return ( 'total', lifeExp.gender(), lifeExp.country(), lifeExp.dob() )
+   return ( 'remaining', lifeExp.gender(), lifeExp.country(), lifeExp.date(),
+            str( lifeExp.age() ) )
+
+class LETier( object ):
+   '''
+   A level of LETieredLookup. get() returns None if the life expectancy
+   of a LifeExpectancy isn't in the tier, otherwise a tuple with a
+   verification boolean + the life expectancy ( a relativedelta ) or an
+   error message. put() stores a LifeExpectancy found in a lower tier.
+   Tiers override get() or getMany(), each defaults to the other.
+   The metrics of get() are recorded under stage, the ones of put()
+   under putStage
+   '''
+
+   name = None
+   stage = None
+   putStage = None
+
+   def get( self, lifeExp ):
+      return self.getMany( [ lifeExp ] )[ 0 ]
+
+   def getMany( self, lifeExps ):
+      return [ self.get( le ) for le in lifeExps ]
+
+   def put( self, lifeExp ):
+      pass
+
+   def putMany( self, lifeExps ):
+      for le in lifeExps:
+         self.put( le )
+
+class LECacheTier( LETier ):
+   '''
+   Tier of a LECache
+   '''
+
+   name = 'cache'
+   stage = 'cache'
+
+   def __init__( self, cache ):
+      self.cache_ = cache
+
+   def get( self, lifeExp ):
+      cached = self.cache_.get( lifeExp )
+      if cached is None:
+         return None
+      return ( True, cached.lifeExpectancy() )
+
+   def put( self, lifeExp ):
+      self.cache_.put( lifeExp )
+
+class LEDataStoreTier( LETier ):
+   '''
+   Tier of a data store, uses its fetchMany() and addMany() if it has them
+   '''
+
+   name = 'datastore'
+   stage = 'datastore_fetch'
+   putStage = 'datastore_add'
+
+   def __init__( self, dataStore ):
+      self.dataStore_ = dataStore
+
+   def get( self, lifeExp ):
+      delta = self.dataStore_.fetchLifeExpectancy( lifeExp )
+      if delta is None:
+         return None
+      return ( True, delta )
+
+   def getMany( self, lifeExps ):
+      if not hasattr( self.dataStore_, 'fetchMany' ):
+         return LETier.getMany( self, lifeExps )
+      return [ ( True, delta ) if delta is not None else None
+               for delta in self.dataStore_.fetchMany( lifeExps ) ]
+
+   def put( self, lifeExp ):
+      self.dataStore_.addLifeExpectancy( lifeExp )
+
+   def putMany( self, lifeExps ):
+      if not hasattr( self.dataStore_, 'addMany' ):
+         return LETier.putMany( self, lifeExps )
+      self.dataStore_.addMany( lifeExps )
+
+class LEProviderTier( LETier ):
+   '''
+   Tier of a provider ( LEWPAFetcher or LELifeTable ), the last one.
+   The floats returned by the provider are kept in requestCache
+   ( a LECache ) keyed on providerRequestKey(), so people with the same age
+   share them, and getMany() sends every distinct request once
+   '''
+
+   name = 'provider'
+   stage = 'provider'
+
+   def __init__( self, provider, requestCache, metrics=None ):
+      self.provider_ = provider
+      self.requestCache_ = requestCache
+      self.metrics_ = metrics if metrics is not None else LEMetrics()
+
+   def provider( self ):
+      return self.provider_
+
+   def fetch( self, lifeExps ):
+      '''
+      Returns a tuple with a verification boolean + the life expectancy
+      float or an error message for every element of lifeExps, without
+      calculating their life expectancy
+      '''
+
+      # provider request key -> ( verification boolean, float or error message )
+      results = {}
+      pending = OrderedDict()
+      keys = []
+      for le in lifeExps:
+         key = providerRequestKey( le )
+         keys.append( key )
+         if key in results or key in pending:
+            continue
+         lifeExpFloat = self.requestCache_.getKey( key )
+         if lifeExpFloat is None:
+            pending[ key ] = le
+         else:
+            self.metrics_.incr( 'request_cache_hits' )
+            results[ key ] = ( True, lifeExpFloat )
+
+      if pending:
+         self.metrics_.incr( 'provider_requests', len( pending ) )
+         if len( pending ) == 1:
+            fetched = [ self.provider_.fetch( pending.values()[ 0 ] ) ]
+         else:
+            fetched = self.provider_.fetchMany( pending.values() )
+         for ( key, result ) in zip( pending.keys(), fetched ):
+            results[ key ] = result
+            if result[ 0 ]:
+               self.requestCache_.putKey( key, result[ 1 ] )
+      return [ results[ key ] for key in keys ]
+
+   def getMany( self, lifeExps ):
+      lifeExpectancies = []
+      for ( le, ( v, lifeExpFloat ) ) in zip( lifeExps, self.fetch( lifeExps ) ):
+         if not v:
+            lifeExpectancies.append( ( False, lifeExpFloat ) )
+            continue
+         with self.metrics_.timer( 'calculate' ):
+            le.calculateLifeExp( lifeExpFloat )
+         lifeExpectancies.append( ( True, le.lifeExpectancy() ) )
+      return lifeExpectancies
+
+def _curveIndex( date, dob, step ):
+   '''
+   Helper method. Returns the index i of the point of a curve sampled
+   every step months of age such that the dob of the point i is on or
+   after dob and the dob of the point i + 1 is before it
+   '''
+
+   # whole months of age, like relativedelta( date, dob ) without building it
+   months = ( date.year - dob.year ) * 12 + date.month - dob.month
+   if date.day < dob.day:
+      months -= 1
+   return months // step
+
+def _curveDob( date, i, step ):
+   '''
+   Helper method. Returns the date of birth of the point i of a curve
+   sampled every step months of age, like date - relativedelta( months=i * step )
+   '''
+
+   ( year, month ) = divmod( date.year * 12 + date.month - 1 - i * step, 12 )
+   month += 1
+   return datetime.date( year, month, min( date.day, calendar.monthrange( year, month )[ 1 ] ) )
+
+class LECurve( object ):
+   '''
+   Remaining life expectancy curve of a country, gender and reference date
+   sampled every step months of age. The point i is the life expectancy
+   float at the age of i * step months, the points from first to last are
+   kept in an array of doubles, NaN where the provider failed, next to the
+   ordinals of their dates of birth
+   '''
+
+   __slots__ = ( 'date_', 'step_', 'first_', 'values_', 'dobs_' )
+
+   def __init__( self, date, step, first, values ):
+      self.date_ = date
+      self.step_ = step
+      self.first_ = first
+      self.values_ = values
+      self.dobs_ = array.array( 'l', [ _curveDob( date, i, step ).toordinal()
+                                       for i in xrange( first, first + len( values ) ) ] )
+
+   def first( self ):
+      return self.first_
+
+   def last( self ):
+      return self.first_ + len( self.values_ ) - 1
+
+   def values( self ):
+      return self.values_
+
+   def value( self, i ):
+      if i < self.first_ or i > self.last():
+         return None
+      value = self.values_[ i - self.first_ ]
+      return None if math.isnan( value ) else value
+
+   def dob( self, i ):
+      '''
+      Returns the date of birth of the point i
+      '''
+
+      return _curveDob( self.date_, i, self.step_ )
+
+   def at( self, dob ):
+      '''
+      Returns the life expectancy float of the people born on dob
+      interpolated linearly between the two points around it,
+      None if the curve doesn't cover dob
+      '''
+
+      i = _curveIndex( self.date_, dob, self.step_ )
+      v0 = self.value( i )
+      if v0 is None:
+         return None
+      ( dob0, ordinal ) = ( self.dobs_[ i - self.first_ ], dob.toordinal() )
+      if ordinal == dob0:
+         return v0
+      v1 = self.value( i + 1 )
+      if v1 is None:
+         return None
+      dob1 = self.dobs_[ i + 1 - self.first_ ]
+      return v0 + ( v1 - v0 ) * ( dob0 - ordinal ) / float( dob0 - dob1 )
+
+class LECurveTier( LETier ):
+   '''
+   Tier answering every person of a ( country, gender, reference date )
+   group from the remaining life expectancy curve of the group: the curve
+   is sampled through providerTier every step months of age over the ages
+   of the group, once, and interpolated linearly for each person.
+   Sampling a curve is worth it only for groups with many distinct ages,
+   like renting skis until buying them is cheaper: the distinct ages of a
+   group the tier leaves to the provider tier are counted, and a group is
+   answered from its curve once sampling the points the curve is missing
+   takes fewer provider requests than the ages counted so far, so the tier
+   costs at most about twice the requests of the provider tier alone.
+   A batch of thousands of people of the same group costs about one
+   request per step months of their age range instead of one per age,
+   whatever the size of its chunks.
+   The curves are kept in a LECache of maxsize curves
+   '''
+
+   name = 'curve'
+   stage = 'curve'
+
+   def __init__( self, providerTier, step=1, maxsize=1000, metrics=None ):
+      self.providerTier_ = providerTier
+      self.step_ = step
+      self.curves_ = LECache( maxsize )
+      # ( country, gender, date ) -> distinct ages left to the provider tier
+      self.demand_ = LECache( maxsize )
+      self.metrics_ = metrics if metrics is not None else LEMetrics()
+
+   def step( self ):
+      return self.step_
+
+   def curves( self ):
+      return self.curves_
+
+   def getMany( self, lifeExps ):
+      today = datetime.date.today()
+      # ( country, gender, date ) -> indexes in lifeExps
+      groups = OrderedDict()
+      for ( j, le ) in enumerate( lifeExps ):
+         # people not born yet use the /total/ API
+         if le.dob() <= le.date() <= today:
+            groups.setdefault( ( le.country(), le.gender(), le.date() ), [] ).append( j )
+
+      results = [ None ] * len( lifeExps )
+      for ( key, members ) in groups.iteritems():
+         curve = self.curve( key, [ lifeExps[ j ] for j in members ] )
+         if curve is None:
+            continue
+         for j in members:
+            lifeExpFloat = curve.at( lifeExps[ j ].dob() )
+            if lifeExpFloat is None:
+               continue
+            lifeExps[ j ].calculateLifeExp( lifeExpFloat )
+            results[ j ] = ( True, lifeExps[ j ].lifeExpectancy() )
+      return results
+
+   def curve( self, key, lifeExps ):
+      '''
+      Returns the curve of key ( country, gender, date ) covering the
+      ages of lifeExps, sampling the points it is missing, None if that
+      takes as many provider requests as the distinct ages of lifeExps
+      and of the previous groups of key left to the provider tier
+      '''
+
+      ( country, gender, date ) = key
+      indexes = [ _curveIndex( date, le.dob(), self.step_ ) for le in lifeExps ]
+      ( lo, hi ) = ( min( indexes ), max( indexes ) + 1 )
+      cached = self.curves_.getKey( key )
+      if cached is not None and cached.first() <= lo and hi <= cached.last():
+         return cached
+
+      ages = len( set( str( le.age() ) for le in lifeExps ) ) + \
+             ( self.demand_.getKey( key ) or 0 )
+      if cached is not None:
+         ( first, last ) = ( min( lo, cached.first() ), max( hi, cached.last() ) )
+         if last - first + 1 - len( cached.values() ) >= ages:
+            # too far from the cached points, start a new curve
+            cached = None
+      if cached is None:
+         ( first, last ) = ( lo, hi )
+         if hi - lo + 1 >= ages:
+            self.demand_.putKey( key, ages )
+            return None
+
+      values = array.array( 'd', [ float( 'nan' ) ] * ( last - first + 1 ) )
+      if cached is not None:
+         offset = cached.first() - first
+         values[ offset:offset + len( cached.values() ) ] = cached.values()
+      curve = LECurve( date, self.step_, first, values )
+      missing = [ i for i in xrange( first, last + 1 )
+                  if cached is None or not cached.first() <= i <= cached.last() ]
+      self.metrics_.incr( 'curve_points', len( missing ) )
+      points = [ LifeExpectancy( country, curve.dob( i ), gender, date ) for i in missing ]
+      for ( i, ( v, lifeExpFloat ) ) in zip( missing, self.providerTier_.fetch( points ) ):
+         if v:
+            values[ i - first ] = lifeExpFloat
+      self.curves_.putKey( key, curve )
+      self.demand_.putKey( key, 0 )
+      return curve
+
+class LEStaleTier( LETier ):
+   '''
+   Degraded mode of providerTier. While the provider is unavailable, that
+   is it fails with one of its outageErrors ( e.g. because the circuit of
+   its LECircuitBreaker is open ) or doesn't answer within latencyBudget
+   seconds, a person is answered from the life expectancy dataStore has for
+   the latest reference date at most maxAge days earlier, shortened by the
+   days elapsed since then and flagged as stale ( see LifeExpectancy.stale() ).
+   Stale life expectancies aren't put in the tiers above, they are fetched
+   again by a background thread that stores them in dataStore once the
+   provider is back. People without an earlier life expectancy wait for
+   the provider
+   '''
+
+   name = 'provider'
+   stage = 'provider'
+
+   def __init__( self, providerTier, dataStore, maxAge=30, latencyBudget=None,
+                 retryDelay=1.0, metrics=None ):
+      self.providerTier_ = providerTier
+      self.dataStore_ = dataStore
+      self.fetchEarlier_ = getattr( dataStore, 'fetchEarlier', None )
+      self.maxAge_ = maxAge
+      self.latencyBudget_ = latencyBudget
+      self.retryDelay_ = retryDelay
+      self.outageErrors_ = getattr( providerTier.provider(), 'outageErrors', () )
+      self.metrics_ = metrics if metrics is not None else LEMetrics()
+      self.refreshes_ = Queue.Queue()
+      # keys of the life expectancies being refreshed
+      self.pending_ = set()
+      self.lock_ = threading.Lock()
+      self.thread_ = None
+
+   def providerTier( self ):
+      return self.providerTier_
+
+   def provider( self ):
+      return self.providerTier_.provider()
+
+   def maxAge( self ):
+      return self.maxAge_
+
+   def latencyBudget( self ):
+      return self.latencyBudget_
+
+   def getMany( self, lifeExps ):
+      call = self._fetch( lifeExps )
+      results = call( self.latencyBudget_ )
+      if results is None:
+         self.metrics_.incr( 'provider_over_budget' )
+         results = [ None ] * len( lifeExps )
+
+      stale = []
+      for ( j, ( le, result ) ) in enumerate( zip( lifeExps, results ) ):
+         if result is not None and ( result[ 0 ] or result[ 1 ] not in self.outageErrors_ ):
+            continue
+         delta = self.stale( le )
+         if delta is None:
+            continue
+         le.setLifeExp( delta, stale=True )
+         results[ j ] = ( True, delta )
+         stale.append( le )
+
+      if None in results:
+         # somebody has no earlier life expectancy, wait for the provider
+         # and answer everybody with it
+         results = call( None )
+         stale = [ le for le in stale if le.stale() ]
+      if stale:
+         self.metrics_.incr( 'stale_served', len( stale ) )
+         self._refresh( stale )
+      return results
+
+   def _fetch( self, lifeExps ):
+      '''
+      Helper method. Starts looking lifeExps up in the provider tier, returns
+      a function of a timeout returning the results, or None if they aren't
+      there after timeout seconds. Without a latency budget the lookup is done
+      right away, otherwise it runs on copies of lifeExps in a thread, so
+      it can be abandoned, and its results are copied back once it is done
+      '''
+
+      if self.latencyBudget_ is None:
+         results = self.providerTier_.getMany( lifeExps )
+         return lambda timeout: results
+
+      copies = [ LifeExpectancy( le.country(), le.dob(), le.gender(), le.date() )
+                 for le in lifeExps ]
+      done = threading.Event()
+      answer = []
+      def fetch():
+         try:
+            answer.append( self.providerTier_.getMany( copies ) )
+         except Exception as e:
+            answer.append( e )
+         finally:
+            done.set()
+      thread = threading.Thread( target=fetch )
+      thread.daemon = True
+      thread.start()
+
+      def result( timeout ):
+         if not done.wait( timeout ):
+            return None
+         if isinstance( answer[ 0 ], Exception ):
+            raise answer[ 0 ]
+         results = list( answer[ 0 ] )
+         for ( j, ( le, copy ) ) in enumerate( zip( lifeExps, copies ) ):
+            if le.stale():
+               if not results[ j ][ 0 ]:
+                  # keep the stale life expectancy set meanwhile
+                  results[ j ] = ( True, le.lifeExpectancy() )
+                  continue
+            elif le.date() != copy.date():
+               # the provider moved the date of an unborn person to the dob
+               le.setDate( copy.date() )
+            if results[ j ][ 0 ]:
+               le.setLifeExp( copy.lifeExpectancy() )
+         return results
+      return result
+
+   def stale( self, lifeExp ):
+      '''
+      Returns the life expectancy of lifeExp derived from the latest one
+      stored for an earlier reference date, None if there is none or if
+      the person has outlived it
+      '''
+
+      if self.fetchEarlier_ is None or lifeExp.dob() > lifeExp.date():
+         return None
+      earlier = self.fetchEarlier_( lifeExp, self.maxAge_ )
+      if earlier is None:
+         return None
+      ( date, delta ) = earlier
+      dod = date + delta
+      if dod <= lifeExp.date():
+         return None
+      return relativedelta( dod, lifeExp.date() )
+
+   def _refresh( self, lifeExps ):
+      '''
+      Helper method. Queues the refresh of the stale lifeExps
+      '''
+
+      with self.lock_:
+         for le in lifeExps:
+            if le.key() in self.pending_:
+               continue
+            self.pending_.add( le.key() )
+            self.refreshes_.put( LifeExpectancy( le.country(), le.dob(),
+                                                 le.gender(), le.date() ) )
+         if self.thread_ is None:
+            self.thread_ = threading.Thread( target=self._run )
+            self.thread_.daemon = True
+            self.thread_.start()
+
+   def pending( self ):
+      '''
+      Returns the number of stale life expectancies waiting to be refreshed
+      '''
+
+      with self.lock_:
+         return len( self.pending_ )
+
+   def wait( self ):
+      '''
+      Blocks until every queued refresh is done, they are retried
+      every retryDelay seconds while the provider is unavailable
+      '''
+
+      self.refreshes_.join()
+
+   def _run( self ):
+      while True:
+         batch = [ self.refreshes_.get() ]
+         while True:
+            try:
+               batch.append( self.refreshes_.get_nowait() )
+            except Queue.Empty:
+               break
+         results = self.providerTier_.getMany( batch )
+         fetched = [ le for ( le, ( v, _ ) ) in zip( batch, results ) if v ]
+         retry = [ le for ( le, ( v, message ) ) in zip( batch, results )
+                   if not v and message in self.outageErrors_ ]
+         if fetched:
+            if hasattr( self.dataStore_, 'addMany' ):
+               self.dataStore_.addMany( fetched )
+            else:
+               for le in fetched:
+                  self.dataStore_.addLifeExpectancy( le )
+            self.metrics_.incr( 'stale_refreshed', len( fetched ) )
+         retried = set( le.key() for le in retry )
+         with self.lock_:
+            for le in batch:
+               if le.key() not in retried:
+                  self.pending_.discard( le.key() )
+         if retry:
+            time.sleep( self.retryDelay_ )
+            for le in retry:
+               self.refreshes_.put( le )
+         for _ in batch:
+            self.refreshes_.task_done()
+
+class LETieredLookup( object ):
+   '''
+   Looks life expectancies up in an ordered list of tiers ( see LETier ),
+   e.g. memory LRU -> data store -> provider. A LifeExpectancy goes to the
+   next tier only if it isn't in the previous one, and a life expectancy
+   found in a tier is put in all the tiers above it, unless it is stale
+   ( see LEStaleTier ).
+   getMany() sends every tier only the LifeExpectancy objects the
+   previous tiers didn't have. Hits, misses and errors are counted per tier
+   and recorded in metrics as <tier>_hits, <tier>_misses and <tier>_errors
+   '''
+
+   def __init__( self, tiers, metrics=None ):
+      self.tiers_ = list( tiers )
+      self.metrics_ = metrics if metrics is not None else LEMetrics()
+      # tier -> [ hits, misses, errors ]
+      self.counts_ = [ [ 0, 0, 0 ] for _ in self.tiers_ ]
+      self.lock_ = threading.Lock()
+
+   def tiers( self ):
+      return self.tiers_
+
+   def get( self, lifeExp ):
+      '''
+      Sets the life expectancy of lifeExp.
+      Returns a tuple with a verification boolean + the life expectancy
+      ( a relativedelta ) or an error message
+      '''
+
+      for ( i, tier ) in enumerate( self.tiers_ ):
+         with self.metrics_.timer( tier.stage ):
+            result = tier.get( lifeExp )
+         if not self._count( i, result ):
+            continue
+         if result[ 0 ] and not lifeExp.stale():
+            lifeExp.setLifeExp( result[ 1 ] )
+            for upper in self.tiers_[ :i ]:
+               self._put( upper, lifeExp )
+         return result
+      return ( False, "life expectancy of %s not found" % lifeExp )
+
+   def getMany( self, lifeExps ):
+      '''
+      get() for every element of lifeExps, returns the list of results
+      in the same order
+      '''
+
+      results = [ None ] * len( lifeExps )
+      missing = range( len( lifeExps ) )
+      for ( i, tier ) in enumerate( self.tiers_ ):
+         if not missing:
+            break
+         with self.metrics_.timer( tier.stage + '_batch' ):
+            found = tier.getMany( [ lifeExps[ j ] for j in missing ] )
+         hits = []
+         stillMissing = []
+         for ( j, result ) in zip( missing, found ):
+            if not self._count( i, result ):
+               stillMissing.append( j )
+               continue
+            results[ j ] = result
+            if result[ 0 ] and not lifeExps[ j ].stale():
+               lifeExps[ j ].setLifeExp( result[ 1 ] )
+               hits.append( lifeExps[ j ] )
+         if hits:
+            for upper in self.tiers_[ :i ]:
+               self._putMany( upper, hits )
+         missing = stillMissing
+      for j in missing:
+         results[ j ] = ( False, "life expectancy of %s not found" % lifeExps[ j ] )
+      return results
+
+   def _count( self, i, result ):
+      '''
+      Helper method. Counts result in the tier i, returns False on a miss
+      '''
+
+      name = self.tiers_[ i ].name
+      if result is None:
+         ( count, counter ) = ( 1, name + '_misses' )
+      elif result[ 0 ]:
+         ( count, counter ) = ( 0, name + '_hits' )
+      else:
+         ( count, counter ) = ( 2, name + '_errors' )
+      with self.lock_:
+         self.counts_[ i ][ count ] += 1
+      self.metrics_.incr( counter )
+      return result is not None
+
+   def _put( self, tier, lifeExp ):
+      if tier.putStage is None:
+         tier.put( lifeExp )
+         return
+      with self.metrics_.timer( tier.putStage ):
+         tier.put( lifeExp )
+
+   def _putMany( self, tier, lifeExps ):
+      if tier.putStage is None:
+         tier.putMany( lifeExps )
+         return
+      with self.metrics_.timer( tier.putStage + '_batch' ):
+         tier.putMany( lifeExps )
+
+   def stats( self ):
+      '''
+      Returns the hits, misses, errors and hit ratio of every tier,
+      the hit ratio of a tier is over the lookups that reached it
+      '''
+
+      stats = OrderedDict()
+      with self.lock_:
+         counts = [ list( c ) for c in self.counts_ ]
+      for ( tier, ( hits, misses, errors ) ) in zip( self.tiers_, counts ):
+         total = hits + misses + errors
+         stats[ tier.name ] = { 'hits': hits, 'misses': misses, 'errors': errors,
+                                'hitRatio': float( hits ) / total if total else 0.0 }
+      return stats
@@ -1,11 +1,45 @@
 #!/usr/bin/env python
+import array
 import datetime
 from dateutil.relativedelta import relativedelta as relativedelta
 
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
 class LifeExpectancyException( Exception ):
    pass
 
 
+# results of isDate for the strings parsed so far, dates are immutable
+# so they can be shared by every LifeExpectancy
+_parsedDates = {}
+_parsedDatesMaxsize = 100000
+
+# lowercase gender -> interned gender
+_genders = { 'male': 'male', 'female': 'female' }
+
+def _intern( s ):
+   return intern( s ) if type( s ) is str else s
+
+def _parseDate( d ):
+   '''
+   Helper method. Parses a YYYY-MM-DD string, returns tuple with
+   verification boolean + date/string like isDate.
+   Strings in that exact format are parsed by hand, anything else
+   goes through strptime which also accepts non padded months and days
+   '''
+   try:
+      if ( len( d ) == 10 and d[ 4 ] == '-' and d[ 7 ] == '-' and
+           d[ 0:4 ].isdigit() and d[ 5:7 ].isdigit() and d[ 8:10 ].isdigit() ):
+         return ( True, datetime.date( int( d[ 0:4 ] ), int( d[ 5:7 ] ),
+                                       int( d[ 8:10 ] ) ) )
+      d = datetime.datetime.strptime( d, '%Y-%m-%d' )
+      return ( True, datetime.date( d.year, d.month, d.day ) )
+   except Exception:
+      return ( False, "date is invalid" )
+
 def isDate( d ):
    '''
    Helper method. Verifies d can be turned into a date,
@@ -14,11 +48,13 @@ def isDate( d ):
    
    # d has to be a datetime or a string in ISO format
    if isinstance( d, str ):
-      try:
-         d = datetime.datetime.strptime( d, '%Y-%m-%d' )
-         d = datetime.date( d.year, d.month, d.day )
-      except Exception:
-         return ( False, "date is invalid" )
+      result = _parsedDates.get( d )
+      if result is None:
+         result = _parseDate( d )
+         if len( _parsedDates ) >= _parsedDatesMaxsize:
+            _parsedDates.clear()
+         _parsedDates[ d ] = result
+      return result
    elif not isinstance( d, datetime.date ):
       return ( False, "date %s is incorrect type %s"
                % ( d, d.__class__ ) )
@@ -27,6 +63,8 @@ def isDate( d ):
 
 
 class Person( object ):
+   __slots__ = ( 'name_', 'lifeExp_' )
+
    def __init__( self, name, lifeExp ):
       self.name_ = name
       self.lifeExp_ = lifeExp
@@ -38,6 +76,8 @@ class Person( object ):
       return self.lifeExp_
 
 class Age( object ):
+   __slots__ = ( 'y_', 'm_', 'd_' )
+
    def __init__( self, years, months, days ):
       self.y_ = years if years > 0 else 0
       self.m_ = months if months > 0 else 0
@@ -47,24 +87,28 @@ class Age( object ):
       return "%sy%sm%sd" % ( self.y_, self.m_, self.d_ )
 
 class LifeExpectancy( object ):
+   __slots__ = ( 'country_', 'dob_', 'gender_', 'date_', 'age_', 'lifeExp_', 'stale_' )
 
    def __init__( self, country, dob, gender, date=None ):
       # country is just a string, no verificaiton
       if not isinstance( country, str ):
          raise LifeExpectancyException( "country has to be a string" )
 
-      self.country_ = country
+      self.country_ = _intern( country )
       ( v, dob ) = isDate( dob )
       if not v:
          raise LifeExpectancyException( dob )
       self.dob_ = dob
       if not isinstance( gender, str ):
          raise LifeExpectancyException( "gender has to be a string of value 'male|female'' " )
-      gender = gender.lower()
-      if gender not in [ 'male', 'female' ]:
+      gender = _genders.get( gender.lower() )
+      if gender is None:
          raise LifeExpectancyException( "gender has to be male or female " )
       self.gender_ = gender
+      self.date_ = None
+      self.age_ = None
       self.lifeExp_ = None
+      self.stale_ = False
       if date:
          self.setDate( date )
 
@@ -77,6 +121,14 @@ class LifeExpectancy( object ):
    def gender( self ):
       return self.gender_
 
+   def setCountry( self, country ):
+      if self.lifeExp_:
+         raise LifeExpectancyException( "Changing country when "
+            "life expectancy has already been calculated isn't allowed" )
+      if not isinstance( country, str ):
+         raise LifeExpectancyException( "country has to be a string" )
+      self.country_ = _intern( country )
+
    def setDate( self, date ):
       if self.lifeExp_:
          raise LifeExpectancyException( "Changing date when "
@@ -106,10 +158,20 @@ class LifeExpectancy( object ):
       dod = self.date_ + relativedelta( days=( lifeExp * 365.25 ) )
       # do this so that we have days, months, and years
       self.lifeExp_ = relativedelta( dod, self.date_ )
+      self.stale_ = False
+
+   def setLifeExp( self, delta, stale=False ):
+      '''
+      Sets the life expectancy, stale if it was derived from the life
+      expectancy of an earlier date because the provider was unavailable
+      '''
 
-   def setLifeExp( self, delta ):
       self.lifeExp_ = delta
-      
+      self.stale_ = stale
+
+   def stale( self ):
+      return self.stale_
+
    def lifeExpectancy( self ):
       return self.lifeExp_
 
@@ -119,15 +181,27 @@ class LifeExpectancy( object ):
                'months': self.lifeExp_.months,
                'days': self.lifeExp_.days }
 
+   def key( self ):
+      '''
+      Canonical hashable key of a life expectancy query:
+      ( country, dob, gender, date )
+      '''
+      return ( self.country_, self.dob_, self.gender_, self.date_ )
+
    def __eq__( self, other ):
       '''
-      Two life expectancies are the same if the country, dob and gender is the same
+      Two life expectancies are the same if the country, dob, gender and date is the same
       '''
 
       if not isinstance( other, self.__class__ ):
          return False
-      return ( other.country() == self.country_ and other.dob() == self.dob_
-               and other.gender() == self.gender() and self.date() == other.date() )
+      return self.key() == other.key()
+
+   def __ne__( self, other ):
+      return not self == other
+
+   def __hash__( self ):
+      return hash( self.key() )
 
 
    def __str__( self ):
@@ -135,5 +209,183 @@ class LifeExpectancy( object ):
                ( self.country_, self.dob_.isoformat(),
                  self.gender_, self.date_ ) )
 
+class LifeExpectancyArray( object ):
+   '''
+   Compact struct-of-arrays container of LifeExpectancy objects.
+   Each record takes 13 bytes:
+   - dob and date as date ordinals ( 4 bytes each, 0 if date isn't set )
+   - gender as a bit of a flags byte
+   - country as an index in the list of countries ( 2 bytes )
+   - life expectancy packed as years << 9 | months << 5 | days ( 2 bytes,
+     0xFFFF if it isn't set )
+   Records are converted back to LifeExpectancy objects equal to the
+   original ones, with the same age and life expectancy.
+   '''
+
+   female = 1
+   unset = 0xFFFF
+
+   def __init__( self, lifeExps=() ):
+      self.dobs_ = array.array( 'i' )
+      self.dates_ = array.array( 'i' )
+      self.flags_ = array.array( 'B' )
+      self.countries_ = array.array( 'H' )
+      self.lifeExps_ = array.array( 'H' )
+      # country -> index in countryNames_
+      self.countryIndex_ = {}
+      self.countryNames_ = []
+      self.extend( lifeExps )
+
+   def append( self, lifeExp ):
+      country = self.countryIndex_.get( lifeExp.country() )
+      if country is None:
+         country = len( self.countryNames_ )
+         if country > 0xFFFF:
+            raise LifeExpectancyException( "too many countries" )
+         self.countryIndex_[ lifeExp.country() ] = country
+         self.countryNames_.append( lifeExp.country() )
+
+      delta = lifeExp.lifeExpectancy()
+      if delta is None:
+         packed = self.unset
+      else:
+         if not ( 0 <= delta.years < 128 and 0 <= delta.months < 12 and
+                  0 <= delta.days < 32 ):
+            raise LifeExpectancyException( "life expectancy in %s can't be packed"
+                                           % lifeExp )
+         packed = delta.years << 9 | delta.months << 5 | delta.days
+
+      self.dobs_.append( lifeExp.dob().toordinal() )
+      self.dates_.append( lifeExp.date().toordinal() if lifeExp.date() else 0 )
+      self.flags_.append( self.female if lifeExp.gender() == 'female' else 0 )
+      self.countries_.append( country )
+      self.lifeExps_.append( packed )
+
+   def extend( self, lifeExps ):
+      for lifeExp in lifeExps:
+         self.append( lifeExp )
+
+   def __len__( self ):
+      return len( self.dobs_ )
+
+   def __getitem__( self, i ):
+      date = self.dates_[ i ]
+      lifeExp = LifeExpectancy( self.countryNames_[ self.countries_[ i ] ],
+                                datetime.date.fromordinal( self.dobs_[ i ] ),
+                                'female' if self.flags_[ i ] & self.female else 'male',
+                                datetime.date.fromordinal( date ) if date else None )
+      packed = self.lifeExps_[ i ]
+      if packed != self.unset:
+         lifeExp.setLifeExp( relativedelta( years=packed >> 9,
+                                            months=( packed >> 5 ) & 0xF,
+                                            days=packed & 0x1F ) )
+      return lifeExp
+
+   def __iter__( self ):
+      for i in xrange( len( self ) ):
+         yield self[ i ]
+
+   def countries( self ):
+      return self.countryNames_
+
+   def nbytes( self ):
+      '''
+      Returns the bytes used by the records, not counting the country names
+      '''
+      return sum( a.itemsize * len( a ) for a in [ self.dobs_, self.dates_, self.flags_,
+                                                   self.countries_, self.lifeExps_ ] )
+
+
+def _splitDates( dates ):
+   '''
+   Helper method. Splits a datetime64[D] array into year, month, day arrays
+   '''
+   months = dates.astype( 'datetime64[M]' )
+   years = dates.astype( 'datetime64[Y]' ).astype( numpy.int64 ) + 1970
+   days = ( dates - months.astype( 'datetime64[D]' ) ).astype( numpy.int64 ) + 1
+   return ( years, months.astype( numpy.int64 ) % 12 + 1, days )
+
+def _addMonths( dates, days, months ):
+   '''
+   Helper method. Vectorized dates + relativedelta( months=months ),
+   days past the end of the resulting month are clipped like relativedelta does
+   '''
+   month = dates.astype( 'datetime64[M]' ) + months
+   monthStart = month.astype( 'datetime64[D]' )
+   monthDays = ( ( month + 1 ).astype( 'datetime64[D]' ) - monthStart ).astype( numpy.int64 )
+   return monthStart + ( numpy.minimum( days, monthDays ) - 1 )
+
+def _relativeDeltas( later, earlier ):
+   '''
+   Helper method. Vectorized relativedelta( later, earlier ) for later >= earlier,
+   returns the years, months and days arrays
+   '''
+   ( ly, lm, _ ) = _splitDates( later )
+   ( ey, em, ed ) = _splitDates( earlier )
+   months = ( ly - ey ) * 12 + ( lm - em )
+   shifted = _addMonths( earlier, ed, months )
+   # same as relativedelta, step back one month if we overshot later
+   over = shifted > later
+   months = months - over
+   shifted = numpy.where( over, _addMonths( earlier, ed, months ), shifted )
+   days = ( later - shifted ).astype( numpy.int64 )
+   return ( months // 12, months % 12, days )
+
+def _toDates( dates, size ):
+   try:
+      result = numpy.asarray( dates, dtype='datetime64[D]' )
+   except ( ValueError, TypeError ):
+      raise LifeExpectancyException( "date is invalid" )
+   if numpy.isnat( result ).any():
+      raise LifeExpectancyException( "date is invalid" )
+   return numpy.broadcast_to( result, ( size, ) )
+
+def batchLifeExpectancy( dobs, genders, countries, lifeExps, date=None ):
+   '''
+   Vectorized LifeExpectancy.setDate + calculateLifeExp over many people.
+   dobs, genders, countries and lifeExps are equally sized columns,
+   lifeExps being the non negative floats returned by WPA.
+   date is the reference date, either one date for everyone or a column,
+   today if not set.
+   Returns a dict of numpy arrays with the age ( ageYears, ageMonths, ageDays )
+   and the life expectancy ( years, months, days ) of each person, equal to
+   what LifeExpectancy.age() and LifeExpectancy.lifeExpectancy() return.
+   '''
+
+   if numpy is None:
+      raise LifeExpectancyException( "batchLifeExpectancy requires numpy" )
+
+   lifeExps = numpy.asarray( lifeExps, dtype=numpy.float64 )
+   size = len( lifeExps )
+   if not ( len( dobs ) == len( genders ) == len( countries ) == size ):
+      raise LifeExpectancyException( "dobs, genders, countries and lifeExps "
+                                     "have to be the same length" )
+   if ( lifeExps < 0 ).any():
+      raise LifeExpectancyException( "life expectancy has to be positive" )
+   for country in countries:
+      if not isinstance( country, str ):
+         raise LifeExpectancyException( "country has to be a string" )
+   genders = numpy.char.lower( numpy.asarray( genders, dtype=str ) )
+   if not numpy.isin( genders, [ 'male', 'female' ] ).all():
+      raise LifeExpectancyException( "gender has to be male or female " )
+
+   dobs = _toDates( dobs, size )
+   dates = _toDates( date if date is not None else datetime.date.today(), size )
+
+   # Age clamps negative components to 0, which is the case for any dob after date
+   ( ageYears, ageMonths, ageDays ) = _relativeDeltas( numpy.maximum( dates, dobs ),
+                                                       dobs )
 
+   # date + relativedelta( days=float ) only adds the whole days of the
+   # timedelta, which rounds the remainder to microseconds first
+   days = lifeExps * 365.25
+   wholeDays = numpy.floor( days )
+   seconds = ( days - wholeDays ) * 86400.0
+   wholeSeconds = numpy.floor( seconds )
+   carry = ( wholeSeconds == 86399 ) & ( numpy.round( ( seconds - wholeSeconds ) * 1e6 ) >= 1e6 )
+   dods = dates + ( wholeDays.astype( numpy.int64 ) + carry )
+   ( years, months, days ) = _relativeDeltas( dods, dates )
 
+   return { 'dobs': dobs, 'dates': dates, 'genders': genders,
+            'ageYears': ageYears, 'ageMonths': ageMonths, 'ageDays': ageDays,
+            'years': years, 'months': months, 'days': days }
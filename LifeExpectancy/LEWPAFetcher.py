@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+from multiprocessing.pool import ThreadPool
+import datetime
+from requests.adapters import HTTPAdapter
+import requests
+import threading
+import time
+
+from LESingleFlight import LESingleFlight
+
+class LEWPAFetcher( object ):
+   '''
+   Queries the World Population API through a single connection pooled
+   requests.Session. Every request has a timeout and is retried with
+   exponential backoff on connection errors and 5xx responses.
+   fetchMany() queries many life expectancies at once with at most
+   concurrency requests in flight. Concurrent requests for the same
+   WPA path are coalesced into a single request by singleFlight.
+   If breaker ( a LECircuitBreaker ) is set, requests fail right away
+   while its circuit is open instead of waiting for their timeouts.
+   A provider error in outageErrors means WPA couldn't be reached
+   '''
+
+   connectError = "Can't connect to the Internet"
+   openError = "WPA is unavailable"
+   outageErrors = ( connectError, openError )
+
+   def __init__( self, url="http://api.population.io/1.0", concurrency=8,
+                 timeout=5.0, retries=3, backoff=0.5, singleFlight=None,
+                 breaker=None ):
+      self.url_ = url.rstrip( '/' )
+      self.concurrency_ = concurrency
+      self.timeout_ = timeout
+      self.retries_ = retries
+      self.backoff_ = backoff
+      self.session_ = requests.Session()
+      adapter = HTTPAdapter( pool_connections=1,
+                             pool_maxsize=concurrency )
+      self.session_.mount( 'http://', adapter )
+      self.session_.mount( 'https://', adapter )
+      self.pool_ = None
+      self.poolLock_ = threading.Lock()
+      self.singleFlight_ = singleFlight or LESingleFlight()
+      self.breaker_ = breaker
+
+   def url( self ):
+      return self.url_
+
+   def concurrency( self ):
+      return self.concurrency_
+
+   def singleFlight( self ):
+      return self.singleFlight_
+
+   def breaker( self ):
+      return self.breaker_
+
+   def stats( self ):
+      stats = self.singleFlight_.stats()
+      if self.breaker_ is not None:
+         stats[ 'breaker' ] = self.breaker_.stats()
+      return stats
+
+   def close( self ):
+      if self.pool_:
+         self.pool_.close()
+         self.pool_.join()
+         self.pool_ = None
+      self.session_.close()
+
+   def _get( self, path ):
+      '''
+      Returns a tuple with a verification boolean + the JSON response
+      or an error message
+      '''
+
+      # the path holds every parameter of the request
+      return self.singleFlight_.do( path, self._request, path )
+
+   def _request( self, path ):
+      if self.breaker_ is None:
+         return self._attempts( path )
+      if not self.breaker_.allow():
+         return ( False, self.openError )
+      start = time.time()
+      result = self._attempts( path )
+      if not result[ 0 ] and result[ 1 ] == self.connectError:
+         self.breaker_.failure()
+      else:
+         # WPA answered, even if it was an error
+         self.breaker_.success( time.time() - start )
+      return result
+
+   def _attempts( self, path ):
+      error = self.connectError
+      for attempt in xrange( self.retries_ + 1 ):
+         if attempt:
+            time.sleep( self.backoff_ * 2 ** ( attempt - 1 ) )
+         try:
+            resp = self.session_.get( url=self.url_ + path, timeout=self.timeout_ )
+         except requests.exceptions.RequestException:
+            # no connection to the internet or WPA didn't answer in time
+            error = self.connectError
+            continue
+         try:
+            body = resp.json()
+         except ValueError:
+            body = None
+         if resp.status_code >= 500:
+            # WPA answered, report its error if it keeps failing
+            error = self._error( resp, body )
+            continue
+         if body is None:
+            return ( False, "Invalid response from WPA" )
+         if not resp.ok:
+            return ( False, self._error( resp, body ) )
+         return ( True, body )
+      return ( False, error )
+
+   def _error( self, resp, body ):
+      '''
+      Returns the error message of a failed response, body is its JSON
+      '''
+
+      if isinstance( body, dict ) and 'detail' in body:
+         return body[ 'detail' ]
+      return "WPA returned %s" % resp.status_code
+
+   def remaining( self, lifeExp ):
+      '''
+      Returns the remaining life expectancy of an object of class LifeExpectancy
+      '''
+
+      ( v, body ) = self._get( "/life-expectancy/remaining/%s/%s/%s/%s" %
+                               ( lifeExp.gender(), lifeExp.country(),
+                                 lifeExp.date().isoformat(), lifeExp.age() ) )
+      if not v:
+         return ( False, body )
+      return ( True, body[ 'remaining_life_expectancy' ] )
+
+   def total( self, lifeExp ):
+      '''
+      Returns the total life expectancy of an object of class LifeExpectancy
+      based solely on its date of birth
+      '''
+
+      ( v, body ) = self._get( "/life-expectancy/total/%s/%s/%s" %
+                               ( lifeExp.gender(), lifeExp.country(),
+                                 lifeExp.dob().isoformat() ) )
+      if not v:
+         return ( False, body )
+      return ( True, body[ 'total_life_expectancy' ] )
+
+   def countries( self ):
+      ( v, body ) = self._get( "/countries" )
+      if not v:
+         return []
+      return body[ 'countries' ]
+
+   def fetch( self, lifeExp ):
+      '''
+      Returns the life expectancy float of lifeExp using the /total/ API
+      if the dob is in the future ( after setting the date to the dob ),
+      the /remaining/ API otherwise
+      '''
+
+      if lifeExp.dob() > datetime.date.today():
+         # set the date as the date of birth so that we will not recalculate
+         # it until the dob has passed
+         lifeExp.setDate( lifeExp.dob() )
+         return self.total( lifeExp )
+      return self.remaining( lifeExp )
+
+   def fetchMany( self, lifeExps ):
+      '''
+      Concurrent fetch() of every element of lifeExps,
+      returns the results in the same order
+      '''
+
+      if len( lifeExps ) < 2 or self.concurrency_ < 2:
+         return [ self.fetch( le ) for le in lifeExps ]
+      with self.poolLock_:
+         if not self.pool_:
+            self.pool_ = ThreadPool( self.concurrency_ )
+      return self.pool_.map( self.fetch, lifeExps )
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+import Queue
+import atexit
+import sys
+import threading
+import weakref
+
+from LEDataStore import LEDataStoreException
+
+# stores not closed yet, closed when the process exits
+_open = weakref.WeakSet()
+
+def _closeAll():
+   for dataStore in list( _open ):
+      try:
+         dataStore.close()
+      except LEDataStoreException as e:
+         sys.stderr.write( "LEWriteBehindDataStore: %s\n" % e )
+
+atexit.register( _closeAll )
+
+class LEWriteBehindDataStore( object ):
+   '''
+   Wraps a data store ( LEDataStore or LEIndexedDataStore ) so that
+   addLifeExpectancy() doesn't wait for the disk: life expectancies are
+   put in a bounded queue and a background thread writes them in batches
+   ( with addMany() if the data store has it ). Until they are written,
+   fetchLifeExpectancy() finds them in an in-memory overlay.
+   Pending writes are flushed when close() is called, e.g. at the end of a
+   with block, or when the process exits for the stores still open.
+   Life expectancies that fail to be written stay in the overlay and are
+   written again with the next batch, by flush() and by close(), which
+   raise LEDataStoreException if they still fail.
+   Every other method is the one of the wrapped data store.
+   '''
+
+   def __init__( self, dataStore, maxsize=10000, batchSize=256 ):
+      self.dataStore_ = dataStore
+      self.batchSize_ = batchSize
+      self.queue_ = Queue.Queue( maxsize )
+      self.lock_ = threading.Lock()
+      # LifeExpectancy.key() -> LifeExpectancy waiting to be written
+      self.overlay_ = {}
+      # LifeExpectancy objects whose write failed, to write again
+      self.failed_ = []
+      self.written_ = 0
+      self.errors_ = 0
+      self.closed_ = False
+      self.thread_ = threading.Thread( target=self._run )
+      self.thread_.daemon = True
+      self.thread_.start()
+      _open.add( self )
+
+   def __enter__( self ):
+      return self
+
+   def __exit__( self, *exc ):
+      self.close()
+
+   def __getattr__( self, name ):
+      return getattr( self.dataStore_, name )
+
+   def dataStore( self ):
+      return self.dataStore_
+
+   def fetchLifeExpectancy( self, lifeExp ):
+      with self.lock_:
+         pending = self.overlay_.get( lifeExp.key() )
+      if pending is not None:
+         return pending.lifeExpectancy()
+      return self.dataStore_.fetchLifeExpectancy( lifeExp )
+
+   def fetchMany( self, lifeExps ):
+      with self.lock_:
+         pending = [ self.overlay_.get( le.key() ) for le in lifeExps ]
+      missing = [ le for ( le, p ) in zip( lifeExps, pending ) if p is None ]
+      if hasattr( self.dataStore_, 'fetchMany' ):
+         fetched = iter( self.dataStore_.fetchMany( missing ) )
+      else:
+         fetched = iter( [ self.dataStore_.fetchLifeExpectancy( le ) for le in missing ] )
+      return [ p.lifeExpectancy() if p is not None else next( fetched )
+               for p in pending ]
+
+   def addMany( self, lifeExps ):
+      for lifeExp in lifeExps:
+         self.addLifeExpectancy( lifeExp )
+
+   def addLifeExpectancy( self, lifeExp ):
+      '''
+      Queues lifeExp to be written, blocks only if the queue is full
+      '''
+
+      if not lifeExp.lifeExpectancy():
+         raise LEDataStoreException( "life expectancy in %s is not set" % lifeExp )
+      if self.closed_:
+         raise LEDataStoreException( "data store is closed" )
+      with self.lock_:
+         # like the data stores, the first life expectancy stored wins
+         if lifeExp.key() in self.overlay_:
+            return
+         self.overlay_[ lifeExp.key() ] = lifeExp
+      self.queue_.put( lifeExp )
+
+   def _write( self, batch ):
+      '''
+      Helper method. Writes batch and the life expectancies that failed
+      before, returns the exception if the write fails: the life
+      expectancies then stay in the overlay to be written again
+      '''
+
+      with self.lock_:
+         ( batch, self.failed_ ) = ( self.failed_ + batch, [] )
+      if not batch:
+         return None
+      try:
+         if hasattr( self.dataStore_, 'addMany' ):
+            self.dataStore_.addMany( batch )
+         else:
+            for lifeExp in batch:
+               self.dataStore_.addLifeExpectancy( lifeExp )
+      except Exception as e:
+         self.errors_ += len( batch )
+         sys.stderr.write( "LEWriteBehindDataStore: failed to write %s life "
+                           "expectancies, will retry: %s\n" % ( len( batch ), e ) )
+         with self.lock_:
+            self.failed_.extend( batch )
+         return e
+      self.written_ += len( batch )
+      with self.lock_:
+         for lifeExp in batch:
+            self.overlay_.pop( lifeExp.key(), None )
+      return None
+
+   def _retry( self ):
+      '''
+      Helper method. Writes the life expectancies that failed, raises
+      LEDataStoreException if they fail again
+      '''
+
+      e = self._write( [] )
+      if e is not None:
+         raise LEDataStoreException( "failed to write %s life expectancies: %s" %
+                                     ( len( self.failed_ ), e ) )
+
+   def _run( self ):
+      stop = False
+      while True:
+         batch = [ self.queue_.get() ]
+         while len( batch ) < self.batchSize_:
+            try:
+               batch.append( self.queue_.get_nowait() )
+            except Queue.Empty:
+               break
+         # None is queued by close()
+         lifeExps = [ lifeExp for lifeExp in batch if lifeExp is not None ]
+         if lifeExps:
+            self._write( lifeExps )
+         for _ in lifeExps:
+            self.queue_.task_done()
+         for _ in xrange( len( batch ) - len( lifeExps ) ):
+            stop = True
+            self.queue_.task_done()
+         if stop and self.queue_.empty():
+            return
+
+   def flush( self ):
+      '''
+      Waits until every queued life expectancy is written, raises
+      LEDataStoreException if some can't be written
+      '''
+
+      self.queue_.join()
+      self._retry()
+
+   def close( self ):
+      '''
+      Flushes the pending writes and stops the background thread,
+      raises LEDataStoreException if some can't be written
+      '''
+
+      if self.closed_:
+         return
+      self.closed_ = True
+      _open.discard( self )
+      self.queue_.put( None )
+      self.thread_.join()
+      self._retry()
+
+   def pending( self ):
+      return len( self.overlay_ )
+
+   def written( self ):
+      return self.written_
+
+   def errors( self ):
+      return self.errors_
@@ -1,11 +1,30 @@
 #!/usr/bin/env python
 from LEUtils import LifeExpectancy, Person
 from LECache import LECache
-from LEDataStore import LEDataStore
-
-import requests
+from LEDataStore import LEDataStore, LEDataStoreSweeper
+from LEWriteBehindDataStore import LEWriteBehindDataStore
+from LEFilteredDataStore import LEFilteredDataStore
+from LESnapshot import LESnapshot
+from LEServer import LEServer
+from LEWPAFetcher import LEWPAFetcher
+from LELifeTable import LELifeTable
+from LECountries import LECountries
+from LEMetrics import LEMetrics
+from LEProfiler import LEProfiler
+from LETieredLookup import LETieredLookup, LECacheTier, LEDataStoreTier
+from LETieredLookup import LEProviderTier, LECurveTier, LEStaleTier
+from LECircuitBreaker import LECircuitBreaker
+
+from collections import OrderedDict
+import argparse
+import atexit
+import csv
+import json
+import multiprocessing
+import os
 import sys
 import time
+import zlib
 import datetime
 
 banner = """
@@ -26,7 +45,8 @@ def lifeExpectancyInput():
    gender = raw_input( "Gender: (Male|Female) " )
 
    try:
-      le = LifeExpectancy( country, dob, gender, datetime.date.today() )
+      with metrics.timer( 'validation' ):
+         le = LifeExpectancy( country, dob, gender, datetime.date.today() )
    except Exception as e:
       return( False, " Couldn't process your request because %s" % e.message )
 
@@ -38,25 +58,35 @@ def lifeExpectancyOutput( name, delta ):
            ( name, delta.years, delta.months, delta.days / 7, delta.days % 7 ) )
 
 
+# shared connection pooled client for the World Population API
+wpa = LEWPAFetcher()
+# source of the life expectancies missing from the cache and the data storage,
+# either wpa or a LELifeTable
+provider = wpa
+# latency of every stage of the requests and counters
+metrics = LEMetrics()
+# life expectancy floats returned by the provider, keyed on the request
+# parameters ( see LETieredLookup.providerRequestKey() ) so that people with
+# the same age share them even if their dobs are different
+requestCache = LECache( 100000 )
+# months of age between the points of the remaining life expectancy curves
+# people of the same country, gender and date are interpolated from,
+# 0 always queries the provider ( see LETieredLookup.LECurveTier )
+curveStep = 0
+# days an earlier life expectancy of a person can be served for while the
+# provider is unavailable, 0 never serves stale life expectancies, and the
+# seconds a lookup waits for the provider before serving them, None waits
+# for its timeouts ( see LETieredLookup.LEStaleTier )
+staleDays = 0
+latencyBudget = None
+
 def getRemainingLifeExpectancyFromWPA( lifeExp ):
    '''
    Returns the total life expectancy give an object of class LifeExpectancy
    Assumes the lifeExp has an age that is not zero
    '''
 
-   remLifeExpUrl = "http://api.population.io/1.0/life-expectancy/remaining"
-   paramsUrl = "/%s/%s/%s/%s" % ( lifeExp.gender(), lifeExp.country(),
-                                  lifeExp.date().isoformat(),
-                                  lifeExp.age() )
-   try:
-      resp = requests.get( url=remLifeExpUrl + paramsUrl )
-   except Exception as e:
-      # no connection to the internet
-      return ( False, "Can't connect to the Internet" )
-
-   if not resp.ok:
-      return ( False, resp.json()[ 'detail' ] )
-   return ( True, resp.json()[ 'remaining_life_expectancy' ] )
+   return wpa.remaining( lifeExp )
 
 def getTotalLifeExpectancyFromWPA( lifeExp ):
    '''
@@ -64,47 +94,67 @@ def getTotalLifeExpectancyFromWPA( lifeExp ):
    Assumes the date of birth is in the future
    '''
 
-   totalLifeExpUrl = "http://api.population.io/1.0/life-expectancy/total"
-   paramsUrl = "/%s/%s/%s" % ( lifeExp.gender(), lifeExp.country(),
-                                  lifeExp.dob().isoformat() )
-   try:
-      resp = requests.get( url= totalLifeExpUrl + paramsUrl )
-   except Exception as e:
-      # no connection to the internet
-      return ( False, "Can't connect to the Internet" )
-   if not resp.ok:
-      return ( False, resp.json()[ 'detail' ] )
-
-   return ( True, resp.json()[ 'total_life_expectancy' ] )
+   return wpa.total( lifeExp )
 
 def getCountriesFromWPA():
 
-   url = "http://api.population.io/1.0/countries"
-   try:
-      resp = requests.get( url=url )
-   except Exception as e:
-      # no connection to the internet
-      return []
-   if not resp.ok:
-      return []
-   return resp.json()[ 'countries' ]
+   return wpa.countries()
+
+def loadCountries( dataStorage ):
+   '''
+   Returns the LECountries of the provider. The WPA list is persisted
+   next to the data storage directory so that it is not fetched at every run
+   '''
+
+   if isinstance( provider, LELifeTable ):
+      return LECountries( provider.countries )
+   return LECountries( provider.countries,
+                       os.path.join( dataStorage.root(), 'lifeExpectancyCountries.json' ) )
+
+def loadCache( maxsize, dataStorage, path=None ):
+   '''
+   Returns a LECache warmed up with the most recently stored life expectancies
+   of today and the ones of today saved by the previous run in path
+   ( next to the data storage directory by default ). The cache is saved
+   to path when the process exits
+   '''
+
+   if path is None:
+      path = os.path.join( dataStorage.root(), 'lifeExpectancyCache.jsonl' )
+   today = datetime.date.today()
+   cache = LECache( maxsize )
+   with metrics.timer( 'cache_warmup' ):
+      if hasattr( dataStorage, 'recent' ):
+         cache.warm( dataStorage, today )
+      # the entries used by the previous run are the most recently used
+      cache.load( path, today )
+   atexit.register( cache.save, path )
+   return cache
 
 def checkCountry( country, countries ):
    '''
    Helper method checks if country is in the cached list of countries.
-   Prompts user to print the list of countries if the country passed
-   doesn't exist.
+   Returns the country as spelled in the list ( the check is case insensitive ).
+   If the country doesn't exist, suggests the closest ones, prompts user
+   to print the list of countries and returns None.
+   If the list of countries isn't available the country is returned unchecked.
    '''
-   
-   if country in countries:
-      return True
+
+   if not len( countries ):
+      return country
+   name = countries.lookup( country )
+   if name:
+      return name
 
    print "Country %s is invalid" % country
+   suggestions = countries.suggestions( country )
+   if suggestions:
+      print "Did you mean %s?" % " or ".join( suggestions )
    showCountries = raw_input( "Do you want to see a list "
                               "of valid countries? [yes|No] " )
    if showCountries.lower().startswith( 'y' ):
-      print ",".join( countries )
-   return False
+      print ",".join( countries.names() )
+   return None
 
 def exit():
    '''
@@ -117,17 +167,76 @@ def exit():
       return True
    return False
 
-def lifeExpectancy():
+def lookupTiers( cache, dataStorage, fetcher=None, providerCache=None ):
+   '''
+   Returns the LETieredLookup of the app: cache, then data storage, then
+   the curves of curveStep months, then fetcher ( provider by default )
+   through providerCache ( requestCache by default ), falling back on
+   the stale life expectancies of the last staleDays days
+   '''
+
+   if fetcher is None:
+      fetcher = provider
+   if providerCache is None:
+      providerCache = requestCache
+   providerTier = LEProviderTier( fetcher, providerCache, metrics )
+   tiers = [ LECacheTier( cache ), LEDataStoreTier( dataStorage ) ]
+   if curveStep:
+      tiers.append( LECurveTier( providerTier, step=curveStep, metrics=metrics ) )
+   if staleDays:
+      return LETieredLookup( tiers + [ LEStaleTier( providerTier, dataStorage,
+                                                    maxAge=staleDays,
+                                                    latencyBudget=latencyBudget,
+                                                    metrics=metrics ) ], metrics )
+   return LETieredLookup( tiers + [ providerTier ], metrics )
+
+# ( parameters, LETieredLookup ) of the last sharedLookup()
+_sharedLookup = None
+
+def sharedLookup( cache, dataStorage ):
+   '''
+   Returns the lookupTiers() of cache and dataStorage, built once and
+   reused as long as they, the provider and the tier settings don't change,
+   so that the stats and the curves of the tiers last across lookups
+   '''
+
+   global _sharedLookup
+   params = ( cache, dataStorage, provider, requestCache, curveStep, staleDays,
+              latencyBudget )
+   shared = _sharedLookup
+   if shared is None or any( a is not b for ( a, b ) in zip( shared[ 0 ], params ) ):
+      shared = ( params, lookupTiers( cache, dataStorage ) )
+      _sharedLookup = shared
+   return shared[ 1 ]
+
+def lookupLifeExpectancy( lifeExp, cache, dataStorage ):
+   '''
+   Sets the life expectancy of lifeExp looking it up first in the cache,
+   then in the data storage and lastly in the provider, see sharedLookup().
+   Returns a tuple with a verification boolean + the life expectancy
+   ( a relativedelta ) or an error message
+   '''
+
+   return sharedLookup( cache, dataStorage ).get( lifeExp )
+
+def lifeExpectancy( metricsPath=None, dataStorage=None, cachePath=None ):
+   '''
+   Interactive app, if metricsPath is set the metrics are exported
+   there after every request. Uses a LEDataStore unless dataStorage is set.
+   The cache is persisted in cachePath, see loadCache()
+   '''
 
    global banner
    print banner
 
-   # preemptively get countries from WPA
-   countries = getCountriesFromWPA()
-   # create a cache of 10 elements
-   cache = LECache( 10 )
    # create a backend data storage system
-   dataStorage = LEDataStore()
+   if dataStorage is None:
+      dataStorage = LEDataStore()
+   # create a cache of 10 elements
+   cache = loadCache( 10, dataStorage, cachePath )
+   lookup = sharedLookup( cache, dataStorage )
+   # preemptively get countries from the provider
+   countries = loadCountries( dataStorage )
 
    while True:
       # parse user input
@@ -139,64 +248,569 @@ def lifeExpectancy():
          continue
 
       # check the country, if invalid allow user to print list of countries
-      if not checkCountry( p.lifeExp().country(), countries ):
+      country = checkCountry( p.lifeExp().country(), countries )
+      if not country:
          if exit():
             sys.exit( 0 )
          continue
+      p.lifeExp().setCountry( country )
 
       # input is valid, fulfill request
+      ( v, delta ) = lookup.get( p.lifeExp() )
+      if not v:
+         print delta
+      else:
+         # prints the life expectancy to the user
+         lifeExpectancyOutput( p.name(), delta )
+      if metricsPath:
+         metrics.export( metricsPath )
+      if exit():
+         sys.exit( 0 )
 
-      # first check in the cache
-      cached = cache.get( p.lifeExp() )
-      if cached:
-         lifeExpectancyOutput( p.name(), cached.lifeExpectancy() )
-         if exit():
-            sys.exit( 0 )
-         continue
+batchFields = [ 'name', 'country', 'dob', 'gender', 'date',
+                'years', 'months', 'days', 'stale' ]
 
-      # check the data storage
-      delta = dataStorage.fetchLifeExpectancy( p.lifeExp() )
-      if delta:
-         p.lifeExp().setLifeExp( delta )
-         lifeExpectancyOutput( p.name(), p.lifeExp().lifeExpectancy() )
-         if exit():
-            sys.exit( 0 )
-         # store the latest query in the cache
-         cache.put( p.lifeExp() )
+def _batchRecords( inputFd, fmt ):
+   '''
+   Helper method. Lazily yields ( line number, record ) from a CSV or JSONL
+   stream, a record is a dict with country, dob, gender and an optional name
+   '''
+
+   if fmt == 'csv':
+      reader = csv.DictReader( inputFd )
+      for record in reader:
+         yield ( reader.line_num, record )
+      return
+
+   for ( lineNum, line ) in enumerate( inputFd, 1 ):
+      if not line.strip():
+         continue
+      try:
+         record = json.loads( line )
+      except ValueError as e:
+         yield ( lineNum, "invalid JSON: %s" % e )
          continue
+      if not isinstance( record, dict ):
+         yield ( lineNum, "record has to be a JSON object" )
+         continue
+      # json returns unicode, LifeExpectancy works with str
+      yield ( lineNum, dict( ( k, v.encode( 'utf-8' ) if isinstance( v, unicode ) else v )
+                             for ( k, v ) in record.iteritems() ) )
 
-      # if we don't have the life expectancy query locally
-      # get the life expectancy from the web
-      # there are 2 cases:
-      # 1) the dob is in the future, calculate an expected life expectancy
-      #    using the total life expectancy API
-      # 2) the dob is in the past, calculate the expected life expectancy
-      #    using the remaining life expectancy API
-
-      if p.lifeExp().dob() > datetime.date.today():
-         # set the date as the date of birth so that we will not recalculate
-         # it until the dob has passed
-         p.lifeExp().setDate( p.lifeExp().dob() )
-         ( v, lifeExpFloat ) = getTotalLifeExpectancyFromWPA( p.lifeExp() )
-      else:
-         ( v, lifeExpFloat ) = getRemainingLifeExpectancyFromWPA( p.lifeExp() )
-         
-      if not v:
-         print lifeExpFloat
-         if exit():
-            sys.exit( 0 )
+def _parseRecord( record, countries ):
+   '''
+   Helper method. Returns ( LifeExpectancy, None ) for a batch record,
+   ( None, error message ) if the record is invalid
+   '''
+
+   if not isinstance( record, dict ):
+      return ( None, record )
+   try:
+      with metrics.timer( 'validation' ):
+         le = LifeExpectancy( record.get( 'country' ), record.get( 'dob' ),
+                              record.get( 'gender' ), datetime.date.today() )
+   except Exception as e:
+      return ( None, "Couldn't process the record because %s" % e )
+   # an empty list means WPA wasn't reachable, let WPA validate the country
+   if len( countries ):
+      country = countries.lookup( le.country() )
+      if not country:
+         suggestions = countries.suggestions( le.country() )
+         return ( None, "Country %s is invalid%s" %
+                  ( le.country(), ", did you mean %s?" % " or ".join( suggestions )
+                    if suggestions else "" ) )
+      le.setCountry( country )
+   return ( le, None )
+
+def _batchResult( record, le, delta ):
+   result = { 'name': record.get( 'name' ), 'country': le.country(),
+              'dob': le.dob().isoformat(), 'gender': le.gender(),
+              'date': le.date().isoformat(), 'years': delta.years,
+              'months': delta.months, 'days': delta.days }
+   # derived from an earlier date while the provider was unavailable
+   if le.stale():
+      result[ 'stale' ] = True
+   return result
+
+def scoreRecords( records, lookup, countries ):
+   '''
+   Looks the life expectancies of a list of batch records up through lookup
+   ( a LETieredLookup ). Returns a list with a tuple for every record:
+   a verification boolean + the batch result or an error message
+   '''
+
+   parsed = [ _parseRecord( record, countries ) for record in records ]
+   valid = [ le for ( le, _ ) in parsed if le is not None ]
+   lookups = iter( lookup.getMany( valid ) )
+   results = []
+   for ( record, ( le, message ) ) in zip( records, parsed ):
+      if le is None:
+         results.append( ( False, message ) )
          continue
+      ( v, delta ) = next( lookups )
+      results.append( ( True, _batchResult( record, le, delta ) ) if v else ( False, delta ) )
+   return results
+
+def lifeExpectancyBatch( inputFd, outputFd, errorFd, fmt, cache, dataStorage,
+                         countries, fetcher=None, providerCache=None, chunkSize=256,
+                         progressFd=sys.stderr, progressEvery=1000,
+                         metricsPath=None ):
+   '''
+   Non interactive counterpart of lifeExpectancy(). Streams records from inputFd
+   through the cache, data storage and the provider, writing one result per record
+   to outputFd in the same format as the input and one JSON line per invalid record
+   to errorFd. countries is a LECountries. Records are read chunkSize at a time and
+   the queries of a chunk go through the tiers of lookupTiers() together, so
+   memory doesn't depend on the input size and the provider requests of a chunk
+   are sent concurrently through fetcher ( provider by default ). Identical requests
+   are sent once and their results are kept in providerCache ( requestCache by
+   default ).
+   If metricsPath is set the metrics are exported there with every progress report.
+   Returns a tuple with the number of processed and failed records
+   '''
 
-      # takes the float value retrieved from WPA and
-      # calculates the life expectancy
-      p.lifeExp().calculateLifeExp( lifeExpFloat )
-      # prints the life expectancy to the user
-      lifeExpectancyOutput( p.name(), p.lifeExp().lifeExpectancy() )
-      if exit():
-         sys.exit( 0 )
-      # add the life expectancy calculation to both the cache and the dataStorage
-      cache.put( p.lifeExp() )
-      dataStorage.addLifeExpectancy( p.lifeExp() )
+   lookup = lookupTiers( cache, dataStorage, fetcher, providerCache )
+   fetcher = lookup.tiers()[ -1 ].provider()
+   if fmt == 'csv':
+      writer = csv.DictWriter( outputFd, fieldnames=batchFields )
+      writer.writeheader()
+      writeResult = writer.writerow
+   else:
+      writeResult = lambda r: outputFd.write( json.dumps( r ) + "\n" )
+
+   counters = { 'processed': 0, 'errors': 0 }
+   def error( lineNum, message, record ):
+      counters[ 'errors' ] += 1
+      metrics.incr( 'errors' )
+      errorFd.write( json.dumps( { 'line': lineNum, 'error': message,
+                                   'record': record } ) + "\n" )
+
+   def parse( lineNum, record ):
+      '''
+      Returns a LifeExpectancy for record, None if the record is invalid
+      '''
+      ( le, message ) = _parseRecord( record, countries )
+      if le is None:
+         error( lineNum, message, record if isinstance( record, dict ) else None )
+      return le
+
+   def process( chunk ):
+      rows = [ ( lineNum, record, parse( lineNum, record ) )
+               for ( lineNum, record ) in chunk ]
+      valid = [ ( lineNum, record, le ) for ( lineNum, record, le ) in rows if le ]
+      results = lookup.getMany( [ le for ( _, _, le ) in valid ] )
+      for ( ( lineNum, record, le ), ( v, delta ) ) in zip( valid, results ):
+         if not v:
+            error( lineNum, delta, record )
+            continue
+         writeResult( _batchResult( record, le, delta ) )
+
+   start = time.time()
+   chunk = []
+   for ( lineNum, record ) in _batchRecords( inputFd, fmt ):
+      chunk.append( ( lineNum, record ) )
+      counters[ 'processed' ] += 1
+      if len( chunk ) >= chunkSize:
+         process( chunk )
+         chunk = []
+      if counters[ 'processed' ] % progressEvery == 0:
+         elapsed = time.time() - start
+         progressFd.write( "processed %s records, %s errors, %.1f records/s\n" %
+                           ( counters[ 'processed' ], counters[ 'errors' ],
+                             counters[ 'processed' ] / elapsed if elapsed else 0 ) )
+         outputFd.flush()
+         if metricsPath:
+            metrics.export( metricsPath )
+   process( chunk )
+
+   elapsed = time.time() - start
+   progressFd.write( "done: %s records, %s errors in %.2fs ( %.1f records/s ), "
+                     "hit ratios: %s, provider: %s\n" %
+                     ( counters[ 'processed' ], counters[ 'errors' ], elapsed,
+                       counters[ 'processed' ] / elapsed if elapsed else 0,
+                       ", ".join( "%s %.2f" % ( name, tier[ 'hitRatio' ] )
+                                  for ( name, tier ) in lookup.stats().items() ),
+                       ", ".join( "%s %s" % item
+                                  for item in sorted( fetcher.stats().items() ) ) ) )
+   outputFd.flush()
+   if metricsPath:
+      metrics.export( metricsPath )
+   return ( counters[ 'processed' ], counters[ 'errors' ] )
+
+def _batchWorker( tasks, results, dataStorageFactory, countries, fetcherFactory,
+                  cacheSize, profile=None ):
+   '''
+   Helper method. Body of a lifeExpectancyParallelBatch() worker process:
+   scores the lists of ( index, line number, record ) read from tasks with its
+   own cache and puts lists of ( index, result ) in results. The last list
+   it puts has the tier stats of the worker, its profile ( see
+   LEProfiler.data() ) and its metrics ( see LEMetrics.data() ) as index None.
+   If set, profile has the deterministic and interval arguments of the
+   LEProfiler of the worker
+   '''
+
+   # the worker inherits the metrics of the main process, only send its own
+   metrics.reset()
+   profiler = LEProfiler( *profile ).start() if profile else None
+   dataStorage = dataStorageFactory()
+   lookup = lookupTiers( LECache( cacheSize ), dataStorage,
+                         fetcherFactory() if fetcherFactory else None )
+   for task in iter( tasks.get, None ):
+      scored = scoreRecords( [ record for ( _, _, record ) in task ], lookup, countries )
+      rows = []
+      for ( ( index, lineNum, record ), ( v, result ) ) in zip( task, scored ):
+         if v:
+            rows.append( ( index, ( True, result ) ) )
+         else:
+            rows.append( ( index, ( False, lineNum, result,
+                                    record if isinstance( record, dict ) else None ) ) )
+      results.put( rows )
+   # atexit handlers don't run in multiprocessing workers
+   if hasattr( dataStorage, 'flush' ):
+      dataStorage.flush()
+   if profiler:
+      profiler.stop()
+   results.put( [ ( None, ( lookup.stats(), profiler.data() if profiler else None,
+                            metrics.data() ) ) ] )
+
+def _shard( record, workers ):
+   '''
+   Helper method. Returns the worker scoring a batch record: the records of
+   the same person always go to the same worker, so its cache and request
+   cache see them, while the people of a country are spread over all the
+   workers
+   '''
+
+   if not isinstance( record, dict ):
+      return 0
+   key = "|".join( str( record.get( field ) ).lower()
+                   for field in ( 'country', 'dob', 'gender' ) )
+   return ( zlib.crc32( key ) & 0xffffffff ) % workers
+
+def lifeExpectancyParallelBatch( inputFd, outputFd, errorFd, fmt, dataStorageFactory,
+                                 countries, workers, fetcherFactory=None,
+                                 cacheSize=10000, chunkSize=256,
+                                 progressFd=sys.stderr, progressEvery=1000,
+                                 profiler=None, metricsPath=None ):
+   '''
+   lifeExpectancyBatch() spread over workers processes.
+   Records are read chunkSize * workers at a time and partitioned on a hash
+   of their ( country, dob, gender ) key, so that a person is always scored
+   by the same worker, and a batch of a single country keeps all the
+   workers busy. Each worker
+   has its own LECache of cacheSize entries, the data storage returned by
+   dataStorageFactory() ( the data stores can be shared by processes ) and
+   the provider returned by fetcherFactory() ( provider by default ).
+   The results are written in the order of the input. If profiler is set
+   ( a running LEProfiler ) the workers are profiled the same way and
+   their profiles are merged into it. The metrics of the workers are merged
+   into metrics, which is exported to metricsPath at the end if it is set.
+   Returns a tuple with the number of processed and failed records
+   '''
+
+   if fmt == 'csv':
+      writer = csv.DictWriter( outputFd, fieldnames=batchFields )
+      writer.writeheader()
+      writeResult = writer.writerow
+   else:
+      writeResult = lambda r: outputFd.write( json.dumps( r ) + "\n" )
+
+   results = multiprocessing.Queue()
+   queues = [ multiprocessing.Queue() for _ in xrange( workers ) ]
+   processes = [ multiprocessing.Process( target=_batchWorker,
+                                          args=( queue, results, dataStorageFactory,
+                                                 countries, fetcherFactory, cacheSize,
+                                                 ( profiler.deterministic(),
+                                                   profiler.interval() )
+                                                 if profiler else None ) )
+                 for queue in queues ]
+   for process in processes:
+      process.daemon = True
+      process.start()
+
+   counters = { 'processed': 0, 'errors': 0 }
+   # records sent to every worker
+   loads = [ 0 ] * workers
+   def score( window ):
+      shards = [ [] for _ in xrange( workers ) ]
+      for ( index, lineNum, record ) in window:
+         worker = _shard( record, workers )
+         loads[ worker ] += 1
+         shards[ worker ].append( ( index, lineNum, record ) )
+      pending = 0
+      for ( queue, shard ) in zip( queues, shards ):
+         # chunkSize records per task so that a worker can start on a shard
+         # before the whole window is sent
+         for i in xrange( 0, len( shard ), chunkSize ):
+            queue.put( shard[ i:i + chunkSize ] )
+            pending += 1
+      scored = {}
+      for _ in xrange( pending ):
+         scored.update( results.get() )
+      for ( index, _, _ ) in window:
+         result = scored[ index ]
+         if result[ 0 ]:
+            writeResult( result[ 1 ] )
+            continue
+         ( _, lineNum, message, record ) = result
+         counters[ 'errors' ] += 1
+         errorFd.write( json.dumps( { 'line': lineNum, 'error': message,
+                                      'record': record } ) + "\n" )
+
+   start = time.time()
+   window = []
+   try:
+      for ( lineNum, record ) in _batchRecords( inputFd, fmt ):
+         window.append( ( counters[ 'processed' ], lineNum, record ) )
+         counters[ 'processed' ] += 1
+         if len( window ) >= chunkSize * workers:
+            score( window )
+            window = []
+         if counters[ 'processed' ] % progressEvery == 0:
+            elapsed = time.time() - start
+            progressFd.write( "processed %s records, %s errors, %.1f records/s\n" %
+                              ( counters[ 'processed' ], counters[ 'errors' ],
+                                counters[ 'processed' ] / elapsed if elapsed else 0 ) )
+            outputFd.flush()
+      score( window )
+
+      for queue in queues:
+         queue.put( None )
+      stats = []
+      for _ in processes:
+         ( workerStats, profile, workerMetrics ) = results.get()[ 0 ][ 1 ]
+         stats.append( workerStats )
+         metrics.merge( workerMetrics )
+         if profile:
+            profiler.merge( profile )
+   finally:
+      for process in processes:
+         process.join( 1 )
+         if process.is_alive():
+            process.terminate()
+
+   # tier -> [ hits, lookups ] over all the workers
+   tiers = OrderedDict()
+   for workerStats in stats:
+      for ( name, tier ) in workerStats.items():
+         counts = tiers.setdefault( name, [ 0, 0 ] )
+         counts[ 0 ] += tier[ 'hits' ]
+         counts[ 1 ] += tier[ 'hits' ] + tier[ 'misses' ] + tier[ 'errors' ]
+   elapsed = time.time() - start
+   progressFd.write( "done: %s records, %s errors in %.2fs ( %.1f records/s ), "
+                     "%s workers ( %s records ), hit ratios: %s\n" %
+                     ( counters[ 'processed' ], counters[ 'errors' ], elapsed,
+                       counters[ 'processed' ] / elapsed if elapsed else 0, workers,
+                       "/".join( str( load ) for load in loads ),
+                       ", ".join( "%s %.2f" % ( name, float( hits ) / lookups
+                                                if lookups else 0 )
+                                  for ( name, ( hits, lookups ) ) in tiers.items() ) ) )
+   outputFd.flush()
+   if metricsPath:
+      metrics.export( metricsPath )
+   return ( counters[ 'processed' ], counters[ 'errors' ] )
+
+def serve( address, dataStorage, cachePath=None ):
+   '''
+   Serves lookups over HTTP on address ( [HOST:]PORT, localhost by default )
+   until interrupted, with a cache of 100000 life expectancies persisted
+   in cachePath
+   '''
+
+   ( host, _, port ) = address.rpartition( ':' )
+   cache = loadCache( 100000, dataStorage, cachePath )
+   lookup = lookupTiers( cache, dataStorage )
+   countries = loadCountries( dataStorage )
+   def stats():
+      result = { 'tiers': lookup.stats(), 'cache': cache.stats(),
+                 'requestCache': requestCache.stats(), 'provider': provider.stats(),
+                 'countries': len( countries ) }
+      if hasattr( dataStorage, 'stats' ):
+         result[ 'dataStorage' ] = dataStorage.stats()
+      return result
+   server = LEServer( ( host or '127.0.0.1', int( port ) ),
+                      lambda records: scoreRecords( records, lookup, countries ),
+                      stats=stats, metrics=metrics )
+   print "Serving life expectancies on %s" % server.url()
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.server_close()
+
+def main():
+
+   parser = argparse.ArgumentParser( description="Life Expectancy App" )
+   parser.add_argument( '--batch', metavar='FILE',
+                        help="score the records of a CSV or JSONL FILE "
+                        "( - for stdin ) instead of running interactively" )
+   parser.add_argument( '--format', choices=[ 'csv', 'jsonl' ],
+                        help="format of the batch input, by default "
+                        "guessed from the file extension" )
+   parser.add_argument( '--output', default='-', metavar='FILE',
+                        help="where to write the batch results, stdout by default" )
+   parser.add_argument( '--errors', default=None, metavar='FILE',
+                        help="where to write the invalid records, stderr by default" )
+   parser.add_argument( '--workers', default=1, type=int,
+                        help="number of processes scoring the batch records" )
+   parser.add_argument( '--serve', metavar='[HOST:]PORT',
+                        help="serve lookups over HTTP instead of running "
+                        "interactively, see LEServer.py" )
+   parser.add_argument( '--concurrency', default=8, type=int,
+                        help="maximum number of concurrent WPA requests in batch mode" )
+   parser.add_argument( '--curve-step', default=0, type=int, metavar='MONTHS',
+                        help="interpolate the people of the same country, gender "
+                        "and date from their remaining life expectancy curve "
+                        "sampled every MONTHS months of age instead of querying "
+                        "every age" )
+   parser.add_argument( '--stale-days', default=0, type=int, metavar='DAYS',
+                        help="while WPA is unavailable, answer from the life "
+                        "expectancy stored for the same person at most DAYS days "
+                        "earlier, adjusted by the elapsed days and flagged as "
+                        "stale, and refresh it in the background" )
+   parser.add_argument( '--latency-budget', type=float, metavar='SECONDS',
+                        help="with --stale-days, serve the stale life expectancies "
+                        "if WPA doesn't answer within SECONDS seconds, a WPA "
+                        "request slower than that also counts as a failure of "
+                        "the circuit breaker" )
+   parser.add_argument( '--breaker-failures', default=5, type=int, metavar='N',
+                        help="stop querying WPA after N consecutive failed requests, "
+                        "0 disables the circuit breaker" )
+   parser.add_argument( '--breaker-reset', default=30.0, type=float, metavar='SECONDS',
+                        help="seconds before querying WPA again once the circuit "
+                        "breaker opened" )
+   parser.add_argument( '--life-table', metavar='FILE',
+                        help="compute the life expectancies offline from the "
+                        "country,gender,age,qx life table in FILE instead of "
+                        "querying WPA" )
+   parser.add_argument( '--metrics', metavar='FILE',
+                        help="export the latency of every stage and the counters "
+                        "to FILE, in the Prometheus text format if FILE ends "
+                        "with .prom, as JSON otherwise" )
+   parser.add_argument( '--write-behind', action='store_true',
+                        help="write the life expectancies to the data storage "
+                        "in a background thread" )
+   parser.add_argument( '--bloom-filter', action='store_true',
+                        help="answer the lookups of life expectancies that aren't "
+                        "in the data storage from a Bloom filter saved next to it, "
+                        "see LEFilteredDataStore.py" )
+   parser.add_argument( '--snapshot', metavar='FILE',
+                        help="look life expectancies up in a snapshot written by"
+                        " LESnapshot.py before the data storage" )
+   parser.add_argument( '--cache-file', metavar='FILE',
+                        help="file the cache is saved to at exit and loaded "
+                        "from at startup, lifeExpectancyCache.jsonl next to the "
+                        "data storage directory by default" )
+   parser.add_argument( '--profile', metavar='FILE',
+                        help="profile the run, batch workers included, and write "
+                        "the hottest functions to FILE, the stacks for flamegraph.pl "
+                        "to FILE.collapsed and the cProfile stats to FILE.pstats" )
+   parser.add_argument( '--profile-mode', choices=[ 'deterministic', 'sampling' ],
+                        default='deterministic',
+                        help="deterministic records every call with cProfile on "
+                        "top of sampling the stacks, sampling only samples them "
+                        "and barely slows the run down" )
+   parser.add_argument( '--retention', type=int, metavar='DAYS',
+                        help="periodically remove the stored life expectancies "
+                        "of reference dates older than DAYS days" )
+   args = parser.parse_args()
+
+   if not args.profile:
+      run( args )
+      return
+   profiler = LEProfiler( deterministic=args.profile_mode == 'deterministic' ).start()
+   try:
+      run( args, profiler )
+   finally:
+      profiler.stop()
+      profiler.save( args.profile )
+      sys.stderr.write( "profile of %s processes written to %s\n" %
+                        ( profiler.processes(), args.profile ) )
+
+def run( args, profiler=None ):
+   '''
+   Runs the app with the arguments parsed by main(), profiler is the
+   LEProfiler the batch workers are profiled with
+   '''
+
+   global provider, curveStep, staleDays, latencyBudget
+   curveStep = args.curve_step
+   staleDays = args.stale_days
+   latencyBudget = args.latency_budget
+
+   def breaker():
+      if not args.breaker_failures:
+         return None
+      return LECircuitBreaker( failureThreshold=args.breaker_failures,
+                               resetTimeout=args.breaker_reset,
+                               latencyBudget=args.latency_budget )
+
+   if args.life_table:
+      provider = LELifeTable( args.life_table )
+   else:
+      provider = LEWPAFetcher( concurrency=args.concurrency, breaker=breaker() )
+
+   def dataStorageFactory():
+      dataStorage = LEDataStore()
+      if args.write_behind:
+         dataStorage = LEWriteBehindDataStore( dataStorage )
+      if args.bloom_filter:
+         dataStorage = LEFilteredDataStore(
+            dataStorage, path=os.path.join( dataStorage.root(), 'lifeExpectancy.bloom' ) )
+      if args.snapshot:
+         dataStorage = LESnapshot( args.snapshot, dataStore=dataStorage )
+      return dataStorage
+
+   def fetcherFactory():
+      # the connections of a LEWPAFetcher can't be shared with the workers
+      if args.life_table:
+         return provider
+      return LEWPAFetcher( concurrency=args.concurrency, breaker=breaker() )
+
+   dataStorage = dataStorageFactory()
+   if args.retention is not None:
+      sweeper = LEDataStoreSweeper( dataStorage, retention=args.retention ).start()
+      # stop it before the interpreter shuts down under a running sweep
+      atexit.register( sweeper.stop )
+
+   if args.serve:
+      serve( args.serve, dataStorage, args.cache_file )
+      return
+
+   if not args.batch:
+      lifeExpectancy( metricsPath=args.metrics, dataStorage=dataStorage,
+                      cachePath=args.cache_file )
+      return
+
+   fmt = args.format
+   if not fmt:
+      fmt = 'csv' if args.batch.lower().endswith( '.csv' ) else 'jsonl'
+
+   inputFd = sys.stdin if args.batch == '-' else open( args.batch, 'r' )
+   outputFd = sys.stdout if args.output == '-' else open( args.output, 'w' )
+   errorFd = sys.stderr if args.errors is None else open( args.errors, 'w' )
+   try:
+      if args.workers > 1:
+         ( _, errors ) = lifeExpectancyParallelBatch( inputFd, outputFd, errorFd, fmt,
+                                                      dataStorageFactory,
+                                                      loadCountries( dataStorage ),
+                                                      args.workers,
+                                                      fetcherFactory=fetcherFactory,
+                                                      profiler=profiler,
+                                                      metricsPath=args.metrics )
+      else:
+         ( _, errors ) = lifeExpectancyBatch( inputFd, outputFd, errorFd, fmt,
+                                              loadCache( 10000, dataStorage,
+                                                         args.cache_file ),
+                                              dataStorage,
+                                              loadCountries( dataStorage ),
+                                              metricsPath=args.metrics )
+   finally:
+      for fd in ( inputFd, outputFd, errorFd ):
+         if fd not in ( sys.stdin, sys.stdout, sys.stderr ):
+            fd.close()
+   sys.exit( 1 if errors else 0 )
 
 if __name__ == "__main__":
-   lifeExpectancy()
+   main()
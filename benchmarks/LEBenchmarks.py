@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the hot paths of the Life Expectancy App:
+LifeExpectancy construction, LECache, the data stores and the
+cache -> data storage -> provider pipeline with a mocked WPA.
+
+Every benchmark reports ops/s and the p50/p99 latency of a single
+operation in microseconds. The results can be saved as JSON and
+compared with a previous run:
+
+python benchmarks/LEBenchmarks.py --output before.json
+python benchmarks/LEBenchmarks.py --compare before.json
+'''
+import os
+import sys
+sys.path.insert( 0, os.path.abspath( os.path.join( os.path.dirname( __file__ ), '..' ) ) )
+
+import argparse
+import datetime
+import json
+import platform
+import random
+import shutil
+import StringIO
+import tempfile
+import time
+import timeit
+
+from LifeExpectancy.LEUtils import LifeExpectancy, LifeExpectancyArray, isDate
+import LifeExpectancy.LEUtils as utils
+from LifeExpectancy.LECache import LECache
+from LifeExpectancy.LEDataStore import LEDataStore
+from LifeExpectancy.LEIndexedDataStore import LEIndexedDataStore
+from LifeExpectancy.LESnapshot import LESnapshot
+from LifeExpectancy.LEFilteredDataStore import LEFilteredDataStore
+from LifeExpectancy.LECountries import LECountries
+import LifeExpectancy.LifeExpectancy as frontend
+
+countries = [ 'Italy', 'France', 'Germany', 'Spain', 'United Kingdom',
+              'United States', 'Brazil', 'India', 'China', 'Japan' ]
+
+def population( n, seed=0, today=None ):
+   '''
+   Returns n synthetic ( country, dob, gender ) tuples,
+   dobs are ISO strings of people aged 0 to 100
+   '''
+
+   rand = random.Random( seed )
+   today = today or datetime.date.today()
+   return [ ( rand.choice( countries ),
+              ( today - datetime.timedelta( days=rand.randint( 0, 36524 ) ) ).isoformat(),
+              rand.choice( [ 'male', 'female' ] ) ) for _ in xrange( n ) ]
+
+def lifeExpectancies( people, today=None, lifeExp=True ):
+   today = today or datetime.date.today()
+   result = []
+   for ( country, dob, gender ) in people:
+      le = LifeExpectancy( country, dob, gender, today )
+      if lifeExp:
+         le.calculateLifeExp( MockWPA.expectancy( le ) )
+      result.append( le )
+   return result
+
+class MockWPA( object ):
+   '''
+   Stand-in for LEWPAFetcher answering without any network access
+   '''
+
+   def __init__( self ):
+      self.requests_ = 0
+
+   @staticmethod
+   def expectancy( lifeExp ):
+      return max( 85.0 - ( lifeExp.date() - lifeExp.dob() ).days / 365.25, 1.0 )
+
+   def fetch( self, lifeExp ):
+      self.requests_ += 1
+      return ( True, self.expectancy( lifeExp ) )
+
+   def fetchMany( self, lifeExps ):
+      return [ self.fetch( le ) for le in lifeExps ]
+
+   def countries( self ):
+      return countries
+
+   def stats( self ):
+      return { 'requests': self.requests_ }
+
+def measure( name, fn, items, params=None ):
+   '''
+   Calls fn on every element of items, timing each call
+   '''
+
+   clock = timeit.default_timer
+   latencies = []
+   start = clock()
+   for item in items:
+      t = clock()
+      fn( item )
+      latencies.append( clock() - t )
+   total = clock() - start
+   latencies.sort()
+   percentile = lambda p: latencies[ min( int( len( latencies ) * p ), len( latencies ) - 1 ) ]
+   return { 'name': name,
+            'params': params or {},
+            'ops': len( latencies ),
+            'opsPerSec': len( latencies ) / total if total else 0,
+            'p50us': percentile( 0.50 ) * 1e6,
+            'p99us': percentile( 0.99 ) * 1e6 }
+
+def benchConstruction( n, seed ):
+   today = datetime.date.today()
+   people = population( n, seed )
+   results = [ measure( 'LifeExpectancy()',
+                        lambda p: LifeExpectancy( p[ 0 ], p[ 1 ], p[ 2 ], today ),
+                        people ) ]
+   les = lifeExpectancies( people, lifeExp=False )
+   results.append( measure( 'LifeExpectancy.calculateLifeExp',
+                            lambda le: le.calculateLifeExp( 42.42 ), les ) )
+   return results
+
+def isDateStrptime( d ):
+   '''
+   isDate before the fast path, used as reference
+   '''
+   try:
+      d = datetime.datetime.strptime( d, '%Y-%m-%d' )
+      return ( True, datetime.date( d.year, d.month, d.day ) )
+   except Exception:
+      return ( False, "date is invalid" )
+
+def benchDateParsing( n, seed ):
+   '''
+   isDate against the strptime reference, with the memoized dates
+   cleared ( cold ) and filled ( warm ), on valid and invalid dates
+   '''
+
+   rand = random.Random( seed )
+   dobs = [ dob for ( _, dob, _ ) in population( n, seed ) ]
+   invalid = [ "%04d-%02d-%02d" % ( rand.randint( 1900, 2017 ), rand.randint( 1, 13 ),
+                                    rand.randint( 28, 32 ) ) for _ in xrange( n ) ]
+   for d in dobs + invalid:
+      assert isDate( d ) == isDateStrptime( d ), d
+
+   results = []
+   for ( kind, dates ) in [ ( 'valid', dobs ), ( 'mixed', invalid ) ]:
+      results.append( measure( 'isDate strptime', isDateStrptime, dates,
+                               { 'size': kind } ) )
+      utils._parsedDates.clear()
+      results.append( measure( 'isDate cold', isDate, dates, { 'size': kind } ) )
+      results.append( measure( 'isDate warm', isDate, dates, { 'size': kind } ) )
+   return results
+
+def objectBytes( obj ):
+   size = sys.getsizeof( obj )
+   if hasattr( obj, '__dict__' ):
+      size += sys.getsizeof( obj.__dict__ )
+   return size
+
+def benchMemory( n, seed ):
+   '''
+   Bytes per record of LifeExpectancy objects ( including their Age,
+   relativedelta and dates, not the shared country and gender strings )
+   and of LifeExpectancyArray, and the cost of converting between the two
+   '''
+
+   les = lifeExpectancies( population( n, seed ) )
+   objects = sum( objectBytes( le ) + objectBytes( le.age() ) +
+                  objectBytes( le.lifeExpectancy() ) + objectBytes( le.dob() ) +
+                  objectBytes( le.date() ) for le in les )
+   packed = LifeExpectancyArray()
+   results = [ measure( 'LifeExpectancyArray.append', packed.append, les ),
+               measure( 'LifeExpectancyArray[]', packed.__getitem__,
+                        xrange( len( packed ) ) ) ]
+   results[ 0 ][ 'params' ] = { 'objectBytesPerRecord': objects / float( n ),
+                                'arrayBytesPerRecord': packed.nbytes() / float( n ) }
+   return results
+
+def benchCache( n, seed, sizes ):
+   results = []
+   for size in sizes:
+      les = lifeExpectancies( population( size, seed ) )
+      cache = LECache( size )
+      results.append( measure( 'LECache.put', cache.put, les, { 'size': size } ) )
+      rand = random.Random( seed )
+      hits = [ rand.choice( les ) for _ in xrange( n ) ]
+      results.append( measure( 'LECache.get hit', cache.get, hits, { 'size': size } ) )
+      misses = lifeExpectancies( population( n, seed + 1 ), lifeExp=False )
+      results.append( measure( 'LECache.get miss', cache.get, misses, { 'size': size } ) )
+   return results
+
+def benchDataStore( n, seed ):
+   results = []
+   les = lifeExpectancies( population( n, seed ) )
+   misses = lifeExpectancies( population( n, seed + 1 ), lifeExp=False )
+   root = tempfile.mkdtemp()
+   try:
+      for ( name, store ) in [ ( 'LEDataStore', LEDataStore( root=root ) ),
+                               ( 'LEIndexedDataStore', LEIndexedDataStore( root=root ) ) ]:
+         results.append( measure( name + '.addLifeExpectancy cold',
+                                  store.addLifeExpectancy, les ) )
+         results.append( measure( name + '.addLifeExpectancy warm',
+                                  store.addLifeExpectancy, les ) )
+         results.append( measure( name + '.fetchLifeExpectancy hit',
+                                  store.fetchLifeExpectancy, les ) )
+         results.append( measure( name + '.fetchLifeExpectancy miss',
+                                  store.fetchLifeExpectancy, misses ) )
+      path = os.path.join( root, 'lifeExpectancy.snap' )
+      LESnapshot.export( LEDataStore( root=root ), path )
+      snapshot = LESnapshot( path )
+      results.append( measure( 'LESnapshot.fetchLifeExpectancy hit',
+                               snapshot.fetchLifeExpectancy, les ) )
+      results.append( measure( 'LESnapshot.fetchLifeExpectancy miss',
+                               snapshot.fetchLifeExpectancy, misses ) )
+      snapshot.close()
+      for store in [ LEDataStore( root=root ), LEIndexedDataStore( root=root ) ]:
+         name = 'Filtered ' + store.__class__.__name__
+         filtered = measure( name + ' build', LEFilteredDataStore, [ store ] )
+         filtered[ 'opsPerSec' ] *= n
+         results.append( filtered )
+         filtered = LEFilteredDataStore( store )
+         results.append( measure( name + '.fetchLifeExpectancy hit',
+                                  filtered.fetchLifeExpectancy, les ) )
+         result = measure( name + '.fetchLifeExpectancy miss',
+                           filtered.fetchLifeExpectancy, misses )
+         result[ 'params' ] = filtered.stats()
+         results.append( result )
+   finally:
+      shutil.rmtree( root )
+   return results
+
+def benchPipeline( n, seed ):
+   '''
+   The tiers of lookupLifeExpectancy() over a population with repeated people,
+   so that the cache, the data storage and the provider are all exercised
+   '''
+
+   today = datetime.date.today()
+   people = population( n / 4 or 1, seed )
+   rand = random.Random( seed )
+   queries = [ rand.choice( people ) for _ in xrange( n ) ]
+   root = tempfile.mkdtemp()
+   ( provider, requestCache ) = ( frontend.provider, frontend.requestCache )
+   frontend.provider = MockWPA()
+   frontend.requestCache = LECache( 100000 )
+   try:
+      cache = LECache( 1000 )
+      lookup = frontend.lookupTiers( cache, LEDataStore( root=root ) )
+      result = measure( 'lookupLifeExpectancy',
+                        lambda p: lookup.get( LifeExpectancy( p[ 0 ], p[ 1 ], p[ 2 ], today ) ),
+                        queries )
+      result[ 'params' ] = { 'cache': cache.stats(),
+                             'tiers': lookup.stats(),
+                             'provider': frontend.provider.stats() }
+      return [ result ]
+   finally:
+      ( frontend.provider, frontend.requestCache ) = ( provider, requestCache )
+      shutil.rmtree( root )
+
+def benchCurves( n, seed, chunkSize=256 ):
+   '''
+   Records/s and provider requests of lookups of n people of the same
+   country, gender and date sent in chunks like a batch, without curves
+   ( size 0 ) and with curves sampled every month of age ( size 1 )
+   '''
+
+   today = datetime.date.today()
+   people = [ ( 'Italy', dob, 'female' ) for ( _, dob, _ ) in population( n, seed ) ]
+   chunks = [ people[ i:i + chunkSize ] for i in xrange( 0, n, chunkSize ) ]
+   ( provider, requestCache, curveStep ) = ( frontend.provider, frontend.requestCache,
+                                             frontend.curveStep )
+   results = []
+   try:
+      for step in [ 0, 1 ]:
+         root = tempfile.mkdtemp()
+         frontend.provider = MockWPA()
+         frontend.requestCache = LECache( 100000 )
+         frontend.curveStep = step
+         try:
+            lookup = frontend.lookupTiers( LECache( 1000 ), LEDataStore( root=root ) )
+            result = measure( 'lookupTiers curves',
+                              lambda chunk: lookup.getMany(
+                                 [ LifeExpectancy( c, dob, g, today )
+                                   for ( c, dob, g ) in chunk ] ),
+                              chunks, params={ 'size': step } )
+            result[ 'opsPerSec' ] *= float( n ) / len( chunks )
+            result[ 'params' ][ 'providerRequests' ] = frontend.provider.requests_
+            results.append( result )
+         finally:
+            shutil.rmtree( root )
+   finally:
+      ( frontend.provider, frontend.requestCache, frontend.curveStep ) = (
+         provider, requestCache, curveStep )
+   return results
+
+def benchParallelBatch( n, seed, workerCounts ):
+   '''
+   Records/s of lifeExpectancyParallelBatch() on n JSONL records with a
+   cold data store for every number of workers, and the speedup over
+   the first one, for people of many countries and of a single one.
+   The share of the records sent to the busiest worker tells how evenly
+   the records are spread, the speedup can't beat 1 / share
+   '''
+
+   results = []
+   for ( name, people ) in [
+      ( 'lifeExpectancyParallelBatch', population( n, seed ) ),
+      ( 'lifeExpectancyParallelBatch single country',
+        [ ( 'Italy', dob, gender ) for ( _, dob, gender ) in population( n, seed ) ] ) ]:
+      records = [ { 'country': country, 'dob': dob, 'gender': gender }
+                  for ( country, dob, gender ) in people ]
+      data = "".join( json.dumps( record ) + "\n" for record in records )
+      first = None
+      for workers in workerCounts:
+         loads = [ 0 ] * workers
+         for record in records:
+            loads[ frontend._shard( record, workers ) ] += 1
+         root = tempfile.mkdtemp()
+         try:
+            start = timeit.default_timer()
+            frontend.lifeExpectancyParallelBatch(
+               StringIO.StringIO( data ), StringIO.StringIO(), StringIO.StringIO(),
+               'jsonl', lambda: LEDataStore( root=root ), LECountries( MockWPA().countries ),
+               workers, fetcherFactory=MockWPA, progressFd=StringIO.StringIO() )
+            elapsed = timeit.default_timer() - start
+         finally:
+            shutil.rmtree( root )
+         opsPerSec = n / elapsed
+         first = first or opsPerSec
+         results.append( { 'name': name,
+                           'params': { 'size': workers,
+                                       'speedup': opsPerSec / first,
+                                       'busiestShare': max( loads ) / float( n ) },
+                           'ops': n, 'opsPerSec': opsPerSec,
+                           'p50us': None, 'p99us': None } )
+   return results
+
+def compare( results, previous, threshold ):
+   '''
+   Prints the ops/s change of every benchmark present in both runs,
+   returns the names of the ones slower than threshold
+   '''
+
+   key = lambda r: ( r[ 'name' ], json.dumps( r[ 'params' ].get( 'size' ) ) )
+   before = dict( ( key( r ), r ) for r in previous[ 'results' ] )
+   regressions = []
+   for r in results:
+      old = before.get( key( r ) )
+      if not old or not old[ 'opsPerSec' ]:
+         continue
+      change = r[ 'opsPerSec' ] / old[ 'opsPerSec' ] - 1
+      flag = ''
+      if change < -threshold:
+         flag = ' REGRESSION'
+         regressions.append( r[ 'name' ] )
+      print "%-45s %+7.1f%%%s" % ( "%s %s" % ( r[ 'name' ], r[ 'params' ].get( 'size', '' ) ),
+                                  change * 100, flag )
+   return regressions
+
+def main():
+   parser = argparse.ArgumentParser( description="Life Expectancy App benchmarks" )
+   parser.add_argument( '-n', type=int, default=10000,
+                        help="operations per benchmark" )
+   parser.add_argument( '--cache-sizes', default='10,1000,100000',
+                        help="comma separated LECache sizes" )
+   parser.add_argument( '--workers', default='1,2,4,8',
+                        help="comma separated numbers of batch worker processes" )
+   parser.add_argument( '--seed', type=int, default=0 )
+   parser.add_argument( '--output', metavar='FILE',
+                        help="save the results as JSON in FILE" )
+   parser.add_argument( '--compare', metavar='FILE',
+                        help="compare with the JSON results of a previous run" )
+   parser.add_argument( '--threshold', type=float, default=0.1,
+                        help="ops/s drop reported as a regression" )
+   args = parser.parse_args()
+
+   sizes = [ int( size ) for size in args.cache_sizes.split( ',' ) ]
+   results = ( benchDateParsing( args.n, args.seed ) +
+               benchConstruction( args.n, args.seed ) +
+               benchMemory( args.n, args.seed ) +
+               benchCache( args.n, args.seed, sizes ) +
+               benchDataStore( args.n, args.seed ) +
+               benchPipeline( args.n, args.seed ) +
+               benchCurves( args.n, args.seed ) +
+               benchParallelBatch( args.n, args.seed,
+                                   [ int( w ) for w in args.workers.split( ',' ) ] ) )
+
+   print "%-45s %12s %10s %10s" % ( 'benchmark', 'ops/s', 'p50 us', 'p99 us' )
+   for r in results:
+      if r[ 'p50us' ] is None:
+         print "%-45s %12.0f %10s %10s" % (
+            "%s %s" % ( r[ 'name' ], r[ 'params' ].get( 'size', '' ) ),
+            r[ 'opsPerSec' ], '-', '-' )
+      else:
+         print "%-45s %12.0f %10.2f %10.2f" % (
+            "%s %s" % ( r[ 'name' ], r[ 'params' ].get( 'size', '' ) ),
+            r[ 'opsPerSec' ], r[ 'p50us' ], r[ 'p99us' ] )
+      if 'providerRequests' in r[ 'params' ]:
+         print "%-45s %12d" % ( '  provider requests', r[ 'params' ][ 'providerRequests' ] )
+      if 'falsePositiveRate' in r[ 'params' ]:
+         print "%-45s %12.5f" % ( '  false positive rate',
+                                  r[ 'params' ][ 'falsePositiveRate' ] )
+      if 'speedup' in r[ 'params' ]:
+         print "%-45s %12.2f" % ( '  speedup', r[ 'params' ][ 'speedup' ] )
+      if 'busiestShare' in r[ 'params' ]:
+         print "%-45s %12.2f" % ( '  records of the busiest worker',
+                                  r[ 'params' ][ 'busiestShare' ] )
+      if 'objectBytesPerRecord' in r[ 'params' ]:
+         print "%-45s %12.1f" % ( '  LifeExpectancy bytes/record',
+                                  r[ 'params' ][ 'objectBytesPerRecord' ] )
+         print "%-45s %12.1f" % ( '  LifeExpectancyArray bytes/record',
+                                  r[ 'params' ][ 'arrayBytesPerRecord' ] )
+
+   report = { 'time': time.time(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'n': args.n, 'seed': args.seed,
+              'results': results }
+   if args.output:
+      with open( args.output, 'w' ) as fd:
+         json.dump( report, fd, indent=1 )
+
+   if args.compare:
+      with open( args.compare, 'r' ) as fd:
+         previous = json.load( fd )
+      print
+      if compare( results, previous, args.threshold ):
+         sys.exit( 1 )
+
+if __name__ == "__main__":
+   main()
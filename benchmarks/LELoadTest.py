@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+Load test of the HTTP lookup service ( LifeExpectancy.py --serve ).
+Clients threads send single GET lookups or batched POST lookups of
+people drawn from a synthetic population and the throughput and the
+latency percentiles of the requests are reported.
+
+Without --url a local server answered by a mocked WPA is started:
+
+python benchmarks/LELoadTest.py --clients 16 --requests 5000
+python benchmarks/LELoadTest.py --url http://127.0.0.1:8080 --batch-size 100
+'''
+import os
+import sys
+sys.path.insert( 0, os.path.abspath( os.path.join( os.path.dirname( __file__ ), '..' ) ) )
+
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import threading
+import timeit
+
+import requests
+
+from LEBenchmarks import MockWPA, population
+from LifeExpectancy.LECache import LECache
+from LifeExpectancy.LECountries import LECountries
+from LifeExpectancy.LEDataStore import LEDataStore
+from LifeExpectancy.LEServer import LEServer
+import LifeExpectancy.LifeExpectancy as frontend
+
+def localServer( root ):
+   '''
+   Starts a LEServer on a random port answered by MockWPA
+   '''
+
+   cache = LECache( 100000 )
+   lookup = frontend.lookupTiers( cache, LEDataStore( root=root ), MockWPA(),
+                                  LECache( 100000 ) )
+   countries = LECountries( MockWPA().countries )
+   return LEServer( ( '127.0.0.1', 0 ),
+                    lambda records: frontend.scoreRecords( records, lookup, countries ),
+                    stats=lambda: { 'tiers': lookup.stats(), 'cache': cache.stats() },
+                    metrics=frontend.metrics ).start()
+
+def client( url, people, requestsCount, batchSize, seed, latencies, errors ):
+   rand = random.Random( seed )
+   session = requests.Session()
+   for _ in xrange( requestsCount ):
+      if batchSize:
+         body = [ dict( zip( [ 'country', 'dob', 'gender' ], rand.choice( people ) ) )
+                  for _ in xrange( batchSize ) ]
+         start = timeit.default_timer()
+         resp = session.post( url, data=json.dumps( body ) )
+      else:
+         params = dict( zip( [ 'country', 'dob', 'gender' ], rand.choice( people ) ) )
+         start = timeit.default_timer()
+         resp = session.get( url, params=params )
+      latencies.append( timeit.default_timer() - start )
+      if resp.status_code != 200:
+         errors.append( resp.status_code )
+
+def main():
+   parser = argparse.ArgumentParser( description="Load test of the lookup service" )
+   parser.add_argument( '--url', help="server to test, e.g. http://127.0.0.1:8080, "
+                        "a local server with a mocked WPA by default" )
+   parser.add_argument( '--clients', type=int, default=8,
+                        help="concurrent client threads" )
+   parser.add_argument( '--requests', type=int, default=2000,
+                        help="total number of requests" )
+   parser.add_argument( '--batch-size', type=int, default=0,
+                        help="people per POST request, 0 sends single GET requests" )
+   parser.add_argument( '--people', type=int, default=10000,
+                        help="size of the population the people are drawn from" )
+   parser.add_argument( '--seed', type=int, default=0 )
+   parser.add_argument( '--output', metavar='FILE',
+                        help="save the results as JSON in FILE" )
+   args = parser.parse_args()
+
+   root = None
+   server = None
+   url = args.url
+   if not url:
+      root = tempfile.mkdtemp()
+      server = localServer( root )
+      url = server.url()
+
+   people = population( args.people, args.seed )
+   latencies = []
+   errors = []
+   threads = [ threading.Thread( target=client,
+                                 args=( url.rstrip( '/' ) + '/lifeExpectancy', people,
+                                        args.requests // args.clients, args.batch_size,
+                                        args.seed + i, latencies, errors ) )
+               for i in xrange( args.clients ) ]
+   start = timeit.default_timer()
+   try:
+      for thread in threads:
+         thread.start()
+      for thread in threads:
+         thread.join()
+      elapsed = timeit.default_timer() - start
+      stats = requests.get( url.rstrip( '/' ) + '/stats' ).json()
+   finally:
+      if server:
+         server.stop()
+         shutil.rmtree( root )
+
+   latencies.sort()
+   percentile = lambda p: latencies[ min( int( len( latencies ) * p ), len( latencies ) - 1 ) ]
+   report = { 'clients': args.clients, 'batchSize': args.batch_size,
+              'requests': len( latencies ), 'errors': len( errors ),
+              'requestsPerSec': len( latencies ) / elapsed,
+              'recordsPerSec': len( latencies ) * ( args.batch_size or 1 ) / elapsed,
+              'p50ms': percentile( 0.50 ) * 1e3, 'p99ms': percentile( 0.99 ) * 1e3,
+              'maxms': latencies[ -1 ] * 1e3, 'server': stats }
+   print "%s requests from %s clients in %.2fs, %s errors" % (
+      report[ 'requests' ], args.clients, elapsed, report[ 'errors' ] )
+   print "%.0f requests/s, %.0f records/s" % ( report[ 'requestsPerSec' ],
+                                               report[ 'recordsPerSec' ] )
+   print "latency p50 %.2fms, p99 %.2fms, max %.2fms" % (
+      report[ 'p50ms' ], report[ 'p99ms' ], report[ 'maxms' ] )
+   if args.output:
+      with open( args.output, 'w' ) as fd:
+         json.dump( report, fd, indent=1 )
+   if errors:
+      sys.exit( 1 )
+
+if __name__ == "__main__":
+   main()
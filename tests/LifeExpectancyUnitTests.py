@@ -1,13 +1,50 @@
 #!/usr/bin/env python
 import os
 import shutil
+import sys
 import tempfile
 import unittest
 import datetime
+import gc
+import weakref
 import context
 from LifeExpectancy.LEUtils import LifeExpectancy, LifeExpectancyException
+from LifeExpectancy.LEUtils import batchLifeExpectancy, isDate
+from LifeExpectancy.LEUtils import LifeExpectancyArray
 from LifeExpectancy.LECache import LECache
 from LifeExpectancy.LEDataStore import LEDataStore, LEDataStoreException
+from LifeExpectancy.LEDataStore import LEDataStoreSweeper
+from LifeExpectancy.LEIndexedDataStore import LEIndexedDataStore
+from LifeExpectancy.LifeExpectancy import lifeExpectancyBatch, lifeExpectancyParallelBatch
+from LifeExpectancy.LifeExpectancy import lookupTiers, scoreRecords
+import LifeExpectancy.LifeExpectancy as frontend
+from LifeExpectancy.LEServer import LEServer, LERequestHandler
+from LifeExpectancy.LEWPAFetcher import LEWPAFetcher
+from LifeExpectancy.LESingleFlight import LESingleFlight
+from LifeExpectancy.LELifeTable import LELifeTable, LELifeTableException
+from LifeExpectancy.LECountries import LECountries
+from LifeExpectancy.LEMetrics import LEMetrics
+from LifeExpectancy.LEProfiler import LEProfiler
+from LifeExpectancy.LEWriteBehindDataStore import LEWriteBehindDataStore
+from LifeExpectancy.LESnapshot import LESnapshot
+from LifeExpectancy.LEFilteredDataStore import LEBloomFilter, LEFilteredDataStore
+from LifeExpectancy.LETieredLookup import LETieredLookup, LECacheTier
+from LifeExpectancy.LETieredLookup import LEDataStoreTier, LEProviderTier, LECurveTier
+from LifeExpectancy.LETieredLookup import LEStaleTier
+from LifeExpectancy.LECircuitBreaker import LECircuitBreaker
+
+import BaseHTTPServer
+import httplib
+import SocketServer
+import json
+import multiprocessing
+import pickle
+import pstats
+import requests
+import socket
+import StringIO
+import threading
+import time
 
 import datetime
 from dateutil.relativedelta import relativedelta as relativedelta
@@ -70,6 +107,55 @@ class LifeExpectancyTest( unittest.TestCase ):
 
       self.assertNotEqual( le, le2 )
 
+      # equal life expectancies share the same key and hash
+      le3 = LifeExpectancy( self.country, self.dob1, self.gender, self.today_ )
+      self.assertEqual( le.key(), ( self.country, le.dob(), self.gender, self.today_ ) )
+      self.assertEqual( hash( le ), hash( le3 ) )
+      self.assertEqual( len( set( [ le, le2, le3 ] ) ), 2 )
+
+   def testIsDate( self ):
+      '''
+      isDate accepts and rejects the same strings as strptime
+      '''
+
+      def reference( d ):
+         try:
+            d = datetime.datetime.strptime( d, '%Y-%m-%d' )
+            return ( True, datetime.date( d.year, d.month, d.day ) )
+         except Exception:
+            return ( False, "date is invalid" )
+
+      for d in [ "1987-03-28", "2000-02-29", "1900-02-29", "1987-3-28", "1987-03-8",
+                 "0000-01-01", "0001-01-01", "9999-12-31", "1987-13-01", "1987-00-10",
+                 "1987-03-32", "1987/03/28", " 1987-03-28", "1987-03-28 ", "87-03-28",
+                 "+987-03-28", "1987-+3-28", "", "foo" ]:
+         self.assertEqual( isDate( d ), reference( d ), d )
+         # memoized results are the same
+         self.assertEqual( isDate( d ), reference( d ), d )
+
+   def testLifeExpectancyArray( self ):
+      '''
+      LifeExpectancyArray converts back to equal LifeExpectancy objects
+      '''
+
+      les = [ LifeExpectancy( self.country, self.dob1, self.gender, self.today_ ),
+              LifeExpectancy( 'USA', self.dob2, 'female', self.tomorrow_ ),
+              LifeExpectancy( 'USA', self.dob2, 'female' ) ]
+      les[ 0 ].calculateLifeExp( 80.537 )
+      les[ 1 ].calculateLifeExp( 0 )
+      packed = LifeExpectancyArray( les )
+      self.assertEqual( len( packed ), 3 )
+      self.assertEqual( packed.countries(), [ self.country, 'USA' ] )
+      self.assertEqual( packed.nbytes(), 3 * 13 )
+      for ( le, unpacked ) in zip( les, packed ):
+         self.assertEqual( unpacked, le )
+         self.assertEqual( str( unpacked.age() ), str( le.age() ) )
+         self.assertEqual( unpacked.lifeExpectancy(), le.lifeExpectancy() )
+
+      # objects don't carry a __dict__
+      self.assertFalse( hasattr( les[ 0 ], '__dict__' ) )
+      self.assertFalse( hasattr( les[ 0 ].age(), '__dict__' ) )
+
    def testLifeExpectancySetLifeExp( self ):
       '''
       tests LifeExpectancy's calculateLifeExp method
@@ -89,6 +175,40 @@ class LifeExpectancyTest( unittest.TestCase ):
       delta2 = le.lifeExpectancy()
       self.assertTrue( delta2.months > 0 or delta2.days > 0 )
 
+   def testBatchLifeExpectancy( self ):
+      '''
+      tests that batchLifeExpectancy matches LifeExpectancy one person at a time
+      '''
+
+      dobs = [ self.dob1, self.dob2, "2000-02-29", "1999-01-31",
+               "1999-03-31", "2030-05-05" ]
+      dates = [ self.today_, self.today_, "2001-02-28", "1999-02-28",
+                "2000-02-29", self.today_ ]
+      lifeExps = [ 80.0, 80.537, 0.0, 0.537, 90.99, 1.0 ]
+      genders = [ 'Male', 'female', 'male', 'FEMALE', 'male', 'female' ]
+      result = batchLifeExpectancy( dobs, genders, [ self.country ] * len( dobs ),
+                                    lifeExps, dates )
+
+      for i in xrange( len( dobs ) ):
+         le = LifeExpectancy( self.country, dobs[ i ], genders[ i ], dates[ i ] )
+         le.calculateLifeExp( lifeExps[ i ] )
+         self.assertEqual( str( le.age() ), "%sy%sm%sd" % ( result[ 'ageYears' ][ i ],
+                                                          result[ 'ageMonths' ][ i ],
+                                                          result[ 'ageDays' ][ i ] ) )
+         self.assertEqual( le.lifeExpectancyJson(),
+                           { 'years': result[ 'years' ][ i ],
+                             'months': result[ 'months' ][ i ],
+                             'days': result[ 'days' ][ i ] } )
+         self.assertEqual( result[ 'genders' ][ i ], le.gender() )
+
+      with self.assertRaisesRegexp( LifeExpectancyException,
+                                    "gender has to be.*male" ):
+         batchLifeExpectancy( [ self.dob1 ], [ 'foo' ], [ self.country ], [ 1.0 ] )
+
+      with self.assertRaisesRegexp( LifeExpectancyException,
+                                    "date is invalid" ):
+         batchLifeExpectancy( [ "1331-33-33" ], [ 'male' ], [ self.country ], [ 1.0 ] )
+
 class LECacheUnitTest( unittest.TestCase ):
 
    @classmethod
@@ -122,7 +242,7 @@ class LECacheUnitTest( unittest.TestCase ):
       # the cached element should be equal to the original one
       self.assertEqual( leCached, self.les[ 0 ] )
       # check that the position of the cached element has been updated
-      self.assertEqual( cache.cache_.index( leCached ), 0 )
+      self.assertEqual( cache.entries().index( leCached ), 0 )
 
       # now check a non existent element
       le = LifeExpectancy( "Italy", "1987-03-28", "female", datetime.date.today() )
@@ -132,7 +252,7 @@ class LECacheUnitTest( unittest.TestCase ):
       le.calculateLifeExp( 90 )
       cache.put( le )
       # assert that the new element is first
-      self.assertEqual( cache.cache_[ 0 ], le )
+      self.assertEqual( cache.entries()[ 0 ], le )
       leCopy = LifeExpectancy( le.country(), le.dob(), le.gender(), le.date() )
       # now try to get the element, it should exist
       leCached = cache.get( leCopy )
@@ -147,8 +267,106 @@ class LECacheUnitTest( unittest.TestCase ):
       # out self.les[ 1 ] since we moved self.les[ 0 ] previously
       self.assertEqual( cache.get( self.les[ 1 ] ), None )
       # self.les[ 2 ] should be last
-      self.assertEqual( cache.cache_[ -1 ], self.les[ 2 ] )
+      self.assertEqual( cache.entries()[ -1 ], self.les[ 2 ] )
+
+   def testLECacheStats( self ):
+      '''
+      test LECache's hit, miss, eviction and ttl bookkeeping
+      '''
+
+      now = [ 0 ]
+      cache = LECache( 2, ttl=10, clock=lambda: now[ 0 ] )
+      for le in self.les[ :3 ]:
+         cache.put( le )
+      self.assertEqual( len( cache ), 2 )
+      self.assertEqual( cache.evictions(), 1 )
+
+      self.assertEqual( cache.get( self.les[ 0 ] ), None )
+      self.assertEqual( cache.get( self.les[ 1 ] ), self.les[ 1 ] )
+      self.assertEqual( cache.hits(), 1 )
+      self.assertEqual( cache.misses(), 1 )
+
+      # entries older than the ttl are dropped on lookup
+      now[ 0 ] = 10
+      self.assertEqual( cache.get( self.les[ 2 ] ), None )
+      self.assertEqual( cache.expirations(), 1 )
+      self.assertEqual( cache.stats()[ 'size' ], 1 )
+
+
+   def testLECachePersistence( self ):
+      '''
+      test saving and loading LECache and warming it up from the data stores
+      '''
+
+      rootDir = tempfile.mkdtemp()
+      try:
+         path = os.path.join( rootDir, 'cache.jsonl' )
+         cache = LECache( self.maxsize )
+         for le in self.les:
+            cache.put( le )
+         cache.get( self.les[ 0 ] )
+         # values that aren't LifeExpectancy objects are not saved
+         cache.putKey( ( 'remaining', 'male' ), 42.0 )
+         self.assertEqual( cache.save( path ), self.maxsize - 1 )
+
+         loaded = LECache( self.maxsize )
+         self.assertEqual( loaded.load( path ), self.maxsize - 1 )
+         self.assertEqual( loaded.entries(), cache.entries()[ 1: ] )
+         self.assertEqual( [ le.lifeExpectancy() for le in loaded.entries() ],
+                           [ le.lifeExpectancy() for le in cache.entries()[ 1: ] ] )
+
+         # only the most recently used entries fit in a smaller cache
+         small = LECache( 3 )
+         self.assertEqual( small.load( path ), 3 )
+         self.assertEqual( small.entries(), cache.entries()[ 1:4 ] )
+         # other reference dates, expired and corrupted entries are skipped
+         self.assertEqual( LECache( 10 ).load( path, datetime.date( 2000, 1, 1 ) ), 0 )
+         now = [ 0 ]
+         ttlCache = LECache( 10, ttl=5, clock=lambda: now[ 0 ] )
+         ttlCache.put( self.les[ 0 ] )
+         ttlCache.save( path )
+         with open( path, 'a' ) as fd:
+            fd.write( '{"country": "Ita' )
+         now[ 0 ] = 4
+         self.assertEqual( LECache( 10, clock=lambda: now[ 0 ] ).load( path ), 1 )
+         now[ 0 ] = 5
+         self.assertEqual( LECache( 10, clock=lambda: now[ 0 ] ).load( path ), 0 )
+         self.assertEqual( LECache( 10 ).load( path + '.missing' ), 0 )
+
+         # warm up from the most recently written life expectancies
+         for store in [ LEDataStore( root=rootDir ), LEIndexedDataStore( root=rootDir ) ]:
+            for le in self.les:
+               store.addLifeExpectancy( le )
+               if isinstance( store, LEDataStore ):
+                  # make sure the modification times differ
+                  lifeExpFile = os.path.join( store._lifeExpPath( le ), le.gender() )
+                  os.utime( lifeExpFile, ( 0, 1000 + self.les.index( le ) ) )
+            warm = LECache( 3 )
+            self.assertEqual( warm.warm( store ), 3 )
+            self.assertEqual( warm.entries(), self.les[ :-4:-1 ] )
+            self.assertEqual( warm.get( self.les[ -1 ] ).lifeExpectancy(),
+                              self.les[ -1 ].lifeExpectancy() )
+            self.assertEqual( LECache( 3 ).warm( store, datetime.date( 2000, 1, 1 ) ), 0 )
+      finally:
+         shutil.rmtree( rootDir )
+
+def dataStoreWorker( root, seed, errors ):
+   '''
+   Adds and fetches the same life expectancies as the other workers
+   '''
 
+   try:
+      ds = LEDataStore( root=root, directory='concurrent' )
+      today = datetime.date( 2017, 1, 1 )
+      for i in xrange( 200 ):
+         dob = datetime.date( 1950 + ( i + seed ) % 20, 1 + i % 12, 1 )
+         le = LifeExpectancy( 'Italy', dob, [ 'male', 'female' ][ i % 2 ], today )
+         le.calculateLifeExp( 30.5 )
+         ds.addLifeExpectancy( le )
+         if ds.fetchLifeExpectancy( le ) != le.lifeExpectancy():
+            errors.put( "%s: %s" % ( le, ds.fetchLifeExpectancy( le ) ) )
+   except Exception as e:
+      errors.put( repr( e ) )
 
 class LEDataStoreUnitTest( unittest.TestCase ):
 
@@ -206,6 +424,1800 @@ class LEDataStoreUnitTest( unittest.TestCase ):
       
       self.assertEqual( ds2.fetchLifeExpectancy( self.le2_ ), self.le2_.lifeExpectancy() )
 
+   def testLEDataStoreCompact( self ):
+      '''
+      Test compaction and usage reporting
+      '''
+
+      ds = LEDataStore( root=self.rootDir_, directory='compact' )
+      dates = [ datetime.date( 2015, 6, 1 ), datetime.date( 2016, 1, 2 ),
+                datetime.date( 2016, 3, 1 ), datetime.date( 2016, 3, 9 ),
+                datetime.date( 2016, 3, 10 ), self.today_ ]
+      for date in dates:
+         for gender in [ 'male', 'female' ]:
+            le = LifeExpectancy( 'Italy', '1987-03-28', gender, date )
+            le.calculateLifeExp( 50 )
+            ds.addLifeExpectancy( le )
+
+      self.assertEqual( ds.dates(), dates )
+      usage = ds.usage()
+      self.assertEqual( ( usage[ 'dates' ], usage[ 'entries' ] ), ( 6, 12 ) )
+      self.assertTrue( usage[ 'bytes' ] > 0 )
+
+      # removes the 2015 year, the 2016/1 month and the 2016/3/1 and 2016/3/9 days
+      self.assertEqual( ds.compact( '2016-03-10' ), 4 )
+      self.assertEqual( ds.dates(), dates[ 4: ] )
+      self.assertEqual( ds.usage()[ 'entries' ], 4 )
+
+      # by default everything before today is removed
+      self.assertEqual( LEDataStoreSweeper( ds ).sweep(), 1 )
+      self.assertEqual( ds.dates(), [ self.today_ ] )
+      self.assertEqual( ds.fetchLifeExpectancy( le ), le.lifeExpectancy() )
+
+   def testLEDataStoreSweeperErrors( self ):
+      '''
+      Test that the sweeper survives a failed sweep and stops cleanly
+      '''
+
+      class FlakyStore( object ):
+         def __init__( self ):
+            self.calls = 0
+         def compact( self, olderThan ):
+            self.calls += 1
+            if self.calls == 1:
+               raise OSError( "disk error" )
+            return 1
+
+      ds = FlakyStore()
+      sweeper = LEDataStoreSweeper( ds, interval=0.01 )
+      stderr = sys.stderr
+      sys.stderr = StringIO.StringIO()
+      try:
+         sweeper.start()
+         while ds.calls < 3:
+            time.sleep( 0.01 )
+         sweeper.stop()
+      finally:
+         ( sys.stderr, errors ) = ( stderr, sys.stderr.getvalue() )
+      self.assertFalse( sweeper.thread_.is_alive() )
+      self.assertEqual( sweeper.errors(), 1 )
+      self.assertEqual( sweeper.removed(), ds.calls - 1 )
+      self.assertTrue( 'disk error' in errors )
+
+   def testLEDataStoreCorruptFile( self ):
+      '''
+      Test that a truncated file is a miss and gets written again
+      '''
+
+      ds = LEDataStore( root=self.rootDir_, directory='corrupt' )
+      le = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+      le.calculateLifeExp( 50 )
+      lifeExpPath = ds._lifeExpPath( le )
+      os.makedirs( lifeExpPath )
+      with open( os.path.join( lifeExpPath, 'male' ), 'w' ) as fd:
+         fd.write( '{"years": 50, "mon' )
+      # an interrupted write
+      with open( os.path.join( lifeExpPath, '.male.tmp' ), 'w' ) as fd:
+         fd.write( '{"ye' )
+
+      self.assertEqual( ds.fetchLifeExpectancy( le ), None )
+      ds.addLifeExpectancy( le )
+      self.assertEqual( ds.fetchLifeExpectancy( le ), le.lifeExpectancy() )
+      self.assertEqual( ds.usage()[ 'entries' ], 1 )
+
+   def testLEDataStoreConcurrentProcesses( self ):
+      '''
+      Test several processes writing and reading the same life expectancies
+      '''
+
+      errors = multiprocessing.Queue()
+      workers = [ multiprocessing.Process( target=dataStoreWorker,
+                                           args=( self.rootDir_, seed, errors ) )
+                  for seed in xrange( 8 ) ]
+      for worker in workers:
+         worker.start()
+      for worker in workers:
+         worker.join()
+      self.assertEqual( [ w.exitcode for w in workers ], [ 0 ] * len( workers ) )
+      self.assertTrue( errors.empty(), errors.get() if not errors.empty() else '' )
+
+      ds = LEDataStore( root=self.rootDir_, directory='concurrent' )
+      keys = set( ( 1950 + ( i + seed ) % 20, 1 + i % 12, i % 2 )
+                  for i in xrange( 200 ) for seed in xrange( 8 ) )
+      usage = ds.usage()
+      self.assertEqual( ( usage[ 'dates' ], usage[ 'entries' ] ), ( 1, len( keys ) ) )
+      for ( dirpath, _, filenames ) in os.walk( ds.directory() ):
+         for filename in filenames:
+            # no temporary file is left and every file is complete
+            self.assertFalse( filename.startswith( '.' ) )
+            with open( os.path.join( dirpath, filename ), 'r' ) as fd:
+               self.assertEqual( json.load( fd )[ 'years' ], 30 )
+
+class LEWriteBehindDataStoreUnitTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+      self.today_ = datetime.date.today()
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def testLEWriteBehindDataStore( self ):
+      '''
+      Test that queued writes are visible before and after being written
+      '''
+
+      release = threading.Event()
+      class SlowDataStore( LEDataStore ):
+         def addLifeExpectancy( self, lifeExp ):
+            release.wait()
+            LEDataStore.addLifeExpectancy( self, lifeExp )
+
+      store = SlowDataStore( root=self.rootDir_, directory='le' )
+      ds = LEWriteBehindDataStore( store, batchSize=4 )
+      les = []
+      for x in xrange( 10 ):
+         le = LifeExpectancy( 'Italy', self.today_ - relativedelta( days=x ),
+                              'male', self.today_ )
+         le.calculateLifeExp( 50 + x )
+         ds.addLifeExpectancy( le )
+         les.append( le )
+
+      with self.assertRaisesRegexp( LEDataStoreException,
+                                    "life expectancy.*is not set" ):
+         ds.addLifeExpectancy( LifeExpectancy( 'USA', '1991-01-28', 'female',
+                                               self.today_ ) )
+
+      # nothing is on disk yet but every write is visible
+      self.assertEqual( store.fetchLifeExpectancy( les[ -1 ] ), None )
+      self.assertEqual( [ ds.fetchLifeExpectancy( le ) for le in les ],
+                        [ le.lifeExpectancy() for le in les ] )
+      missing = LifeExpectancy( 'USA', '1991-01-28', 'female', self.today_ )
+      self.assertEqual( ds.fetchMany( les[ :2 ] + [ missing ] ),
+                        [ les[ 0 ].lifeExpectancy(), les[ 1 ].lifeExpectancy(), None ] )
+      self.assertTrue( ds.pending() > 0 )
+      # methods of the wrapped data store are available
+      self.assertEqual( ds.directory(), store.directory() )
+
+      release.set()
+      ds.close()
+      self.assertEqual( ( ds.pending(), ds.written(), ds.errors() ), ( 0, 10, 0 ) )
+      self.assertEqual( [ store.fetchLifeExpectancy( le ) for le in les ],
+                        [ le.lifeExpectancy() for le in les ] )
+      with self.assertRaisesRegexp( LEDataStoreException, "closed" ):
+         ds.addLifeExpectancy( les[ 0 ] )
+
+   def testLEWriteBehindDataStoreBatches( self ):
+      '''
+      Test batched writes through addMany
+      '''
+
+      store = LEIndexedDataStore( root=self.rootDir_ )
+      ds = LEWriteBehindDataStore( store )
+      les = []
+      for x in xrange( 100 ):
+         le = LifeExpectancy( 'Italy', self.today_ - relativedelta( days=x ),
+                              'female', self.today_ )
+         le.calculateLifeExp( 30 + x / 10.0 )
+         ds.addLifeExpectancy( le )
+         les.append( le )
+      ds.flush()
+      self.assertEqual( ds.written(), 100 )
+      self.assertEqual( store.fetchMany( les ), [ le.lifeExpectancy() for le in les ] )
+      ds.close()
+      store.close()
+
+   def testLEWriteBehindDataStoreClose( self ):
+      '''
+      Test that a closed store isn't kept alive until the process exits
+      '''
+
+      store = LEDataStore( root=self.rootDir_, directory='le' )
+      le = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+      le.calculateLifeExp( 40 )
+      with LEWriteBehindDataStore( store ) as ds:
+         ds.addLifeExpectancy( le )
+      self.assertEqual( store.fetchLifeExpectancy( le ), le.lifeExpectancy() )
+      ref = weakref.ref( ds )
+      del ds
+      gc.collect()
+      self.assertEqual( ref(), None )
+
+   def testLEWriteBehindDataStoreErrors( self ):
+      '''
+      Test that life expectancies whose write fails are kept and written again
+      '''
+
+      failures = [ 1 ]
+      class FlakyDataStore( LEDataStore ):
+         def addLifeExpectancy( self, lifeExp ):
+            if failures[ 0 ]:
+               failures[ 0 ] -= 1
+               raise IOError( "disk error" )
+            LEDataStore.addLifeExpectancy( self, lifeExp )
+
+      store = FlakyDataStore( root=self.rootDir_, directory='le' )
+      ds = LEWriteBehindDataStore( store )
+      les = []
+      for x in xrange( 5 ):
+         le = LifeExpectancy( 'Italy', self.today_ - relativedelta( days=x ),
+                              'male', self.today_ )
+         le.calculateLifeExp( 50 + x )
+         les.append( le )
+      stderr = sys.stderr
+      sys.stderr = StringIO.StringIO()
+      try:
+         # fails once in the background, written again by flush()
+         ds.addMany( les )
+         ds.flush()
+         self.assertEqual( ( ds.pending(), ds.written() ), ( 0, 5 ) )
+         self.assertTrue( ds.errors() > 0 )
+         self.assertEqual( [ store.fetchLifeExpectancy( le ) for le in les ],
+                           [ le.lifeExpectancy() for le in les ] )
+
+         # keeps failing: flush() raises and the writes stay visible
+         failures[ 0 ] = 1000
+         le = LifeExpectancy( 'USA', '1991-01-28', 'female', self.today_ )
+         le.calculateLifeExp( 40 )
+         ds.addLifeExpectancy( le )
+         with self.assertRaisesRegexp( LEDataStoreException, "failed to write 1 " ):
+            ds.flush()
+         self.assertEqual( ds.fetchLifeExpectancy( le ), le.lifeExpectancy() )
+         self.assertEqual( ds.pending(), 1 )
+         failures[ 0 ] = 0
+         ds.close()
+      finally:
+         sys.stderr = stderr
+      self.assertEqual( store.fetchLifeExpectancy( le ), le.lifeExpectancy() )
+      self.assertEqual( ds.pending(), 0 )
+
+class LEIndexedDataStoreUnitTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+      self.today_ = datetime.date.today()
+      self.les_ = []
+      for x in xrange( 1, 11 ):
+         le = LifeExpectancy( 'Italy', "19%02d-%02d-%02d" % ( 50 + x, x, x ),
+                              'male' if x % 2 else 'female', self.today_ )
+         le.calculateLifeExp( 30 + x * 1.1 )
+         self.les_.append( le )
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def testLEIndexedDataStoreLifeExpectancy( self ):
+      '''
+      Test fetch and add lifeExpectancy methods, single and bulk
+      '''
+
+      ds = LEIndexedDataStore( root=self.rootDir_ )
+      self.assertEqual( ds.fetchLifeExpectancy( self.les_[ 0 ] ), None )
+      ds.addLifeExpectancy( self.les_[ 0 ] )
+      self.assertEqual( ds.fetchLifeExpectancy( self.les_[ 0 ] ),
+                        self.les_[ 0 ].lifeExpectancy() )
+
+      with self.assertRaisesRegexp( LEDataStoreException,
+                                    "life expectancy.*is not set" ):
+         ds.addLifeExpectancy( LifeExpectancy( 'USA', '1991-01-28', 'female',
+                                               self.today_ ) )
+
+      ds.addMany( self.les_[ 1:5 ] )
+      fetched = ds.fetchMany( self.les_ )
+      self.assertEqual( fetched[ :5 ], [ le.lifeExpectancy() for le in self.les_[ :5 ] ] )
+      self.assertEqual( fetched[ 5: ], [ None ] * 5 )
+      ds.close()
+
+      # the data survives reopening the file
+      ds2 = LEIndexedDataStore( root=self.rootDir_ )
+      self.assertEqual( ds2.fetchLifeExpectancy( self.les_[ 4 ] ),
+                        self.les_[ 4 ].lifeExpectancy() )
+      ds2.close()
+
+   def testLEIndexedDataStoreCompact( self ):
+      '''
+      Test compaction and usage reporting
+      '''
+
+      ds = LEIndexedDataStore( root=self.rootDir_ )
+      old = LifeExpectancy( 'Italy', '1987-03-28', 'male', '2016-03-10' )
+      old.calculateLifeExp( 50 )
+      ds.addMany( self.les_ + [ old ] )
+      self.assertEqual( ds.dates(), [ datetime.date( 2016, 3, 10 ), self.today_ ] )
+      self.assertEqual( ds.usage()[ 'entries' ], len( self.les_ ) + 1 )
+      self.assertEqual( ds.compact(), 1 )
+      self.assertEqual( ds.usage()[ 'dates' ], 1 )
+      self.assertEqual( ds.fetchLifeExpectancy( old ), None )
+      ds.close()
+
+   def testLEIndexedDataStoreImport( self ):
+      '''
+      Test importing a LEDataStore directory tree
+      '''
+
+      tree = LEDataStore( root=self.rootDir_, directory='le' )
+      for le in self.les_:
+         tree.addLifeExpectancy( le )
+
+      ds = LEIndexedDataStore( root=self.rootDir_ )
+      self.assertEqual( ds.importDirectory( tree.directory() ), len( self.les_ ) )
+      self.assertEqual( ds.fetchMany( self.les_ ),
+                        [ le.lifeExpectancy() for le in self.les_ ] )
+      # importing again doesn't duplicate anything
+      self.assertEqual( ds.importDirectory( tree.directory() ), 0 )
+      # a missing directory isn't created
+      missing = os.path.join( self.rootDir_, 'missing' )
+      self.assertRaises( LEDataStoreException, ds.importDirectory, missing )
+      self.assertFalse( os.path.exists( missing ) )
+      ds.close()
+
+class LEFilteredDataStoreUnitTest( unittest.TestCase ):
+
+   class DataStore( LEDataStore ):
+      '''
+      Counts the lookups that reach the data store
+      '''
+      fetched = 0
+      def fetchLifeExpectancy( self, lifeExp ):
+         self.fetched += 1
+         return LEDataStore.fetchLifeExpectancy( self, lifeExp )
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+      self.today_ = datetime.date.today()
+      self.les_ = [ LifeExpectancy( 'Italy', datetime.date( 1950, 1, 1 ) +
+                                    datetime.timedelta( days=i ), 'male', self.today_ )
+                    for i in xrange( 1000 ) ]
+      for le in self.les_:
+         le.calculateLifeExp( 30.5 )
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def testLEBloomFilter( self ):
+      '''
+      Test no false negatives, the false positive rate, growth and merging
+      '''
+
+      bloom = LEBloomFilter( capacity=1000, errorRate=0.01 )
+      for i in xrange( 5000 ):
+         self.assertTrue( bloom.add( 'key%s' % i ) or 'key%s' % i in bloom )
+      self.assertFalse( bloom.add( 'key0' ) )
+      self.assertTrue( all( 'key%s' % i in bloom for i in xrange( 5000 ) ) )
+      # 1000 + 2000 + 4000 strings
+      self.assertEqual( bloom.stages(), 3 )
+      falsePositives = sum( 'other%s' % i in bloom for i in xrange( 20000 ) )
+      self.assertTrue( falsePositives / 20000.0 < 0.01 )
+      self.assertTrue( 0 < bloom.falsePositiveRate() < 0.01 )
+
+      path = os.path.join( self.rootDir_, 'le.bloom' )
+      bloom.save( path )
+      loaded = LEBloomFilter.load( path )
+      self.assertEqual( ( len( loaded ), loaded.stages() ), ( len( bloom ), 3 ) )
+      self.assertTrue( all( 'key%s' % i in loaded for i in xrange( 5000 ) ) )
+      other = LEBloomFilter( capacity=1000, errorRate=0.01 )
+      other.add( 'other' )
+      other.update( loaded )
+      self.assertTrue( 'other' in other and 'key4999' in other )
+      with self.assertRaises( ValueError ):
+         other.update( LEBloomFilter( capacity=10 ) )
+      with open( path, 'wb' ) as fd:
+         fd.write( 'LEBLOOM1' + 'x' * 10 )
+      with self.assertRaisesRegexp( LEDataStoreException, "not a valid Bloom filter" ):
+         LEBloomFilter.load( path )
+
+   def testLEBloomFilterMerge( self ):
+      '''
+      Test that merging the filters of two processes keeps the false
+      positive rate under the error rate
+      '''
+
+      ( a, b ) = ( LEBloomFilter( capacity=1000, errorRate=0.01 ),
+                   LEBloomFilter( capacity=1000, errorRate=0.01 ) )
+      for i in xrange( 450 ):
+         a.add( 'a%s' % i )
+         b.add( 'b%s' % i )
+      a.update( b )
+      # about 900 strings in the first stage, not 450
+      self.assertTrue( 850 < len( a ) <= 1000 )
+      for i in xrange( 1000 ):
+         a.add( 'c%s' % i )
+      self.assertEqual( a.stages(), 2 )
+      self.assertTrue( all( '%s%s' % ( p, i ) in a for p in 'ab' for i in xrange( 450 ) ) )
+      falsePositives = sum( 'other%s' % i in a for i in xrange( 20000 ) )
+      self.assertTrue( falsePositives / 20000.0 < 0.01 )
+      self.assertTrue( a.falsePositiveRate() < 0.01 )
+
+   def testLEFilteredDataStore( self ):
+      '''
+      Test that misses don't reach the data store and the filter is
+      built, kept current, saved and merged
+      '''
+
+      ds = self.DataStore( root=self.rootDir_ )
+      for le in self.les_[ :100 ]:
+         ds.addLifeExpectancy( le )
+      path = os.path.join( self.rootDir_, 'le.bloom' )
+      filtered = LEFilteredDataStore( ds, path=path, capacity=1000, errorRate=0.01 )
+      # built from the data store
+      self.assertEqual( len( filtered.bloomFilter() ), 100 )
+      for le in self.les_[ :100 ]:
+         self.assertEqual( filtered.fetchLifeExpectancy( le ), le.lifeExpectancy() )
+      self.assertEqual( ds.fetched, 100 )
+      for le in self.les_[ 100: ]:
+         self.assertEqual( filtered.fetchLifeExpectancy( le ), None )
+      stats = filtered.stats()
+      self.assertEqual( ds.fetched, 100 + stats[ 'falsePositives' ] )
+      self.assertEqual( stats[ 'filtered' ] + stats[ 'falsePositives' ], 900 )
+      self.assertTrue( stats[ 'falsePositiveRate' ] < 0.05 )
+
+      # kept current
+      filtered.addMany( self.les_[ 100:200 ] )
+      filtered.addLifeExpectancy( self.les_[ 200 ] )
+      results = filtered.fetchMany( self.les_[ 150:250 ] )
+      self.assertEqual( results[ :51 ], [ le.lifeExpectancy() for le in self.les_[ 150:201 ] ] )
+      self.assertEqual( results[ 51: ], [ None ] * 49 )
+      # delegated to the data store
+      self.assertEqual( filtered.usage()[ 'entries' ], 201 )
+
+      # another process adds to the same data store and saves its filter
+      ds2 = LEDataStore( root=self.rootDir_ )
+      filtered2 = LEFilteredDataStore( ds2, path=path, capacity=1000, errorRate=0.01 )
+      filtered2.addLifeExpectancy( self.les_[ 500 ] )
+      filtered2.flush()
+      filtered.save()
+      loaded = LEFilteredDataStore( self.DataStore( root=self.rootDir_ ), path=path,
+                                    capacity=1000, errorRate=0.01 )
+      self.assertEqual( loaded.dataStore().fetched, 0 )
+      for le in self.les_[ :201 ] + [ self.les_[ 500 ] ]:
+         self.assertEqual( loaded.fetchLifeExpectancy( le ), le.lifeExpectancy() )
+
+      # a filter of a different size is built again
+      rebuilt = LEFilteredDataStore( ds, path=path, capacity=10 )
+      self.assertEqual( rebuilt.bloomFilter().capacity(), 10 )
+      for le in self.les_[ :201 ] + [ self.les_[ 500 ] ]:
+         self.assertEqual( rebuilt.fetchLifeExpectancy( le ), le.lifeExpectancy() )
+
+class LESnapshotUnitTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def testLESnapshot( self ):
+      '''
+      Test exporting a data store and looking the life expectancies up
+      '''
+
+      ds = LEDataStore( root=self.rootDir_ )
+      les = []
+      for ( i, country ) in enumerate( [ 'Italy', 'France', 'United Kingdom' ] ):
+         for date in [ datetime.date( 2016, 12, 31 ), datetime.date( 2017, 1, 1 ) ]:
+            for gender in [ 'male', 'female' ]:
+               le = LifeExpectancy( country, datetime.date( 1950 + i, 2, 3 ), gender, date )
+               le.calculateLifeExp( 30 + i + ( gender == 'female' ) / 2.0 )
+               ds.addLifeExpectancy( le )
+               les.append( le )
+
+      path = os.path.join( self.rootDir_, 'le.snap' )
+      self.assertEqual( LESnapshot.export( ds, path ), len( les ) )
+      snapshot = LESnapshot( path )
+      self.assertEqual( len( snapshot ), len( les ) )
+      for le in les:
+         self.assertEqual( snapshot.fetchLifeExpectancy( le ), le.lifeExpectancy() )
+
+      # unknown country, dob, gender and date
+      missing = [ LifeExpectancy( 'Spain', '1950-02-03', 'male', '2017-01-01' ),
+                  LifeExpectancy( 'Italy', '1950-02-04', 'male', '2017-01-01' ),
+                  LifeExpectancy( 'Italy', '1950-02-03', 'male', '2017-01-02' ),
+                  LifeExpectancy( 'France', '1950-02-03', 'male', '2017-01-01' ) ]
+      self.assertEqual( snapshot.fetchMany( missing ), [ None ] * 4 )
+      with self.assertRaisesRegexp( LEDataStoreException, "read only" ):
+         snapshot.addLifeExpectancy( les[ 0 ] )
+      snapshot.close()
+
+      # misses and writes go to the data store
+      snapshot = LESnapshot( path, dataStore=ds )
+      missing[ 0 ].calculateLifeExp( 40 )
+      snapshot.addLifeExpectancy( missing[ 0 ] )
+      self.assertEqual( snapshot.fetchLifeExpectancy( missing[ 0 ] ),
+                        missing[ 0 ].lifeExpectancy() )
+      self.assertEqual( snapshot.usage()[ 'entries' ], len( les ) + 1 )
+      snapshot.close()
+
+      # LEIndexedDataStore exports the same snapshot
+      ids = LEIndexedDataStore( root=self.rootDir_ )
+      ids.importDirectory( ds.directory() )
+      other = os.path.join( self.rootDir_, 'other.snap' )
+      self.assertEqual( LESnapshot.export( ids, other ), len( les ) + 1 )
+      ids.close()
+      with open( path, 'rb' ) as fd:
+         header = fd.read( 8 )
+      self.assertEqual( header, 'LESNAP01' )
+      with open( os.path.join( self.rootDir_, 'invalid.snap' ), 'wb' ) as fd:
+         fd.write( 'x' * 64 )
+      with self.assertRaisesRegexp( LEDataStoreException, "not a life expectancy" ):
+         LESnapshot( fd.name )
+
+class LifeExpectancyBatchUnitTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+      self.ds_ = LEDataStore( root=self.rootDir_, directory='le' )
+      self.today_ = datetime.date.today()
+      self.le_ = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+      self.le_.calculateLifeExp( 80.123 )
+      self.ds_.addLifeExpectancy( self.le_ )
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def testLifeExpectancyBatch( self ):
+      '''
+      Test the batch mode with JSONL and CSV input, life expectancies are
+      in the data storage so WPA is never queried
+      '''
+
+      delta = self.le_.lifeExpectancy()
+      for ( fmt, data ) in [
+         ( 'jsonl', '{"name": "Jacopo", "country": "italy", "dob": "1987-03-28", '
+                    '"gender": "Male"}\n'
+                    '{"name": "Foo", "country": "Mars", "dob": "1987-03-28", '
+                    '"gender": "male"}\n'
+                    'not json\n' ),
+         ( 'csv', 'name,country,dob,gender\n'
+                  'Jacopo,Italy,1987-03-28,Male\n'
+                  'Foo,Mars,1987-03-28,male\n'
+                  'Bar,Italy,1987-33-28,male\n' ) ]:
+         output = StringIO.StringIO()
+         errors = StringIO.StringIO()
+         ( processed, failed ) = lifeExpectancyBatch(
+            StringIO.StringIO( data ), output, errors, fmt, LECache( 10 ),
+            self.ds_, LECountries( lambda: [ 'Italy' ] ),
+            progressFd=StringIO.StringIO() )
+         self.assertEqual( ( processed, failed ), ( 3, 2 ) )
+
+         lines = output.getvalue().splitlines()
+         if fmt == 'jsonl':
+            result = json.loads( lines[ 0 ] )
+            self.assertEqual( len( lines ), 1 )
+         else:
+            self.assertEqual( len( lines ), 2 )
+            result = dict( zip( lines[ 0 ].split( ',' ), lines[ 1 ].split( ',' ) ) )
+         self.assertEqual( result[ 'name' ], 'Jacopo' )
+         self.assertEqual( [ int( result[ k ] ) for k in [ 'years', 'months', 'days' ] ],
+                           [ delta.years, delta.months, delta.days ] )
+
+         errorLines = [ json.loads( l ) for l in errors.getvalue().splitlines() ]
+         self.assertEqual( [ e[ 'line' ] for e in errorLines ], [ 2, 3 ] if fmt == 'jsonl'
+                           else [ 3, 4 ] )
+         self.assertTrue( 'Mars' in errorLines[ 0 ][ 'error' ] )
+         self.assertEqual( result[ 'country' ], 'Italy' )
+
+   def testLifeExpectancyBatchStale( self ):
+      '''
+      Test that the batch mode serves stale life expectancies while
+      the provider is unavailable
+      '''
+
+      class DownFetcher( object ):
+         outageErrors = ( "WPA is unavailable", )
+         def fetch( self, lifeExp ):
+            return self.fetchMany( [ lifeExp ] )[ 0 ]
+         def fetchMany( self, lifeExps ):
+            return [ ( False, "WPA is unavailable" ) for le in lifeExps ]
+         def stats( self ):
+            return { 'breaker': { 'state': 'open' } }
+
+      old = LifeExpectancy( 'Italy', '1990-01-01', 'male',
+                            self.today_ - relativedelta( days=3 ) )
+      old.calculateLifeExp( 50.0 )
+      self.ds_.addLifeExpectancy( old )
+      data = ( '{"name": "A", "country": "Italy", "dob": "1990-01-01", "gender": "male"}\n'
+               '{"name": "B", "country": "Italy", "dob": "1991-01-01", "gender": "male"}\n'
+               '{"name": "C", "country": "Italy", "dob": "1987-03-28", "gender": "male"}\n' )
+      staleDays = frontend.staleDays
+      frontend.staleDays = 30
+      try:
+         output = StringIO.StringIO()
+         errors = StringIO.StringIO()
+         ( processed, failed ) = lifeExpectancyBatch(
+            StringIO.StringIO( data ), output, errors, 'jsonl', LECache( 10 ),
+            self.ds_, LECountries( lambda: [ 'Italy' ] ), fetcher=DownFetcher(),
+            providerCache=LECache( 10 ), progressFd=StringIO.StringIO() )
+      finally:
+         frontend.staleDays = staleDays
+      self.assertEqual( ( processed, failed ), ( 3, 1 ) )
+      results = [ json.loads( l ) for l in output.getvalue().splitlines() ]
+      self.assertEqual( [ r[ 'name' ] for r in results ], [ 'A', 'C' ] )
+      delta = relativedelta( old.date() + old.lifeExpectancy(), self.today_ )
+      self.assertEqual( [ results[ 0 ][ k ] for k in [ 'years', 'months', 'days' ] ],
+                        [ delta.years, delta.months, delta.days ] )
+      self.assertTrue( results[ 0 ][ 'stale' ] )
+      self.assertFalse( 'stale' in results[ 1 ] )
+      self.assertEqual( json.loads( errors.getvalue() )[ 'error' ], "WPA is unavailable" )
+
+   def testLookupLifeExpectancy( self ):
+      '''
+      Test that lookups of the same cache and data storage share their tiers
+      '''
+
+      cache = LECache( 10 )
+      for _ in xrange( 2 ):
+         le = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+         self.assertEqual( frontend.lookupLifeExpectancy( le, cache, self.ds_ ),
+                           ( True, self.le_.lifeExpectancy() ) )
+      lookup = frontend.sharedLookup( cache, self.ds_ )
+      self.assertEqual( [ ( tier[ 'hits' ], tier[ 'misses' ] )
+                          for tier in lookup.stats().values()[ :2 ] ],
+                        [ ( 1, 1 ), ( 1, 0 ) ] )
+      self.assertFalse( frontend.sharedLookup( LECache( 10 ), self.ds_ ) is lookup )
+
+   def testLifeExpectancyBatchProviderCache( self ):
+      '''
+      Test that identical provider requests are sent once and reused
+      across people and runs. People share a request when they have the
+      same country, gender and age on the query date: at a fixed date the
+      age almost identifies the dob, only the dobs clipped to the end of a
+      shorter month share one, so few requests are saved over the cache
+      of the life expectancies
+      '''
+
+      class CountingFetcher( object ):
+         def __init__( self ):
+            self.fetched = []
+         def fetchMany( self, lifeExps ):
+            self.fetched.extend( lifeExps )
+            return [ ( True, 42.5 ) for le in lifeExps ]
+         def stats( self ):
+            return {}
+
+      class FixedDate( datetime.date ):
+         @classmethod
+         def today( cls ):
+            return datetime.date( 2017, 3, 10 )
+
+      class FixedDatetime( object ):
+         date = FixedDate
+
+      fetcher = CountingFetcher()
+      providerCache = LECache( 10 )
+      # on 2017-03-10 the dobs from 1991-01-28 to 1991-01-31 are all
+      # 26 years, 1 month and 10 days old, 1991-01-27 is a day older
+      data = ( 'name,country,dob,gender\n'
+               'A,USA,1991-01-28,male\nB,USA,1991-01-29,male\n'
+               'C,USA,1991-01-30,male\nD,USA,1991-01-31,male\n'
+               'E,USA,1991-01-28,female\nF,USA,1991-01-27,male\n' )
+      frontend.datetime = FixedDatetime
+      try:
+         for run in xrange( 2 ):
+            output = StringIO.StringIO()
+            ( processed, failed ) = lifeExpectancyBatch(
+               StringIO.StringIO( data ), output, StringIO.StringIO(), 'csv',
+               LECache( 10 ), LEDataStore( root=self.rootDir_, directory='le%s' % run ),
+               LECountries( lambda: [] ), fetcher=fetcher, providerCache=providerCache,
+               progressFd=StringIO.StringIO() )
+            self.assertEqual( ( processed, failed ), ( 6, 0 ) )
+            self.assertEqual( len( output.getvalue().splitlines() ), 7 )
+      finally:
+         frontend.datetime = datetime
+      # one request for the four men of the same age, one for the older
+      # man and one for the woman, the second run is answered by providerCache
+      self.assertEqual( sorted( ( le.gender(), str( le.age() ) ) for le in fetcher.fetched ),
+                        [ ( 'female', '26y1m10d' ),
+                          ( 'male', '26y1m10d' ),
+                          ( 'male', '26y1m11d' ) ] )
+      self.assertEqual( providerCache.hits(), 3 )
+
+   def testLifeExpectancyParallelBatch( self ):
+      '''
+      Test that the parallel batch writes the same results in the same
+      order as the sequential one
+      '''
+
+      class Fetcher( object ):
+         def fetchMany( self, lifeExps ):
+            return [ ( True, 40 + len( le.country() ) + le.age().y_ / 10.0 )
+                     for le in lifeExps ]
+         def fetch( self, lifeExp ):
+            return self.fetchMany( [ lifeExp ] )[ 0 ]
+         def stats( self ):
+            return {}
+
+      countries = [ 'Italy', 'France', 'Spain', 'Germany', 'USA' ]
+      lines = [ 'name,country,dob,gender' ]
+      for i in xrange( 500 ):
+         lines.append( '%s,%s,19%02d-%02d-01,%s' % ( i, countries[ i % 5 ], i % 90,
+                                                    1 + i % 12, [ 'male', 'female' ][ i % 2 ] ) )
+      lines[ 10 ] = '9,Mars,1987-03-28,male'
+      lines[ 20 ] = '19,Italy,1987-33-28,male'
+      data = "\n".join( lines ) + "\n"
+
+      outputs = []
+      for ( i, workers ) in enumerate( [ 1, 3 ] ):
+         output = StringIO.StringIO()
+         errors = StringIO.StringIO()
+         root = os.path.join( self.rootDir_, str( i ) )
+         os.mkdir( root )
+         if workers == 1:
+            result = lifeExpectancyBatch(
+               StringIO.StringIO( data ), output, errors, 'csv', LECache( 10 ),
+               LEDataStore( root=root ), LECountries( lambda: countries ),
+               fetcher=Fetcher(), providerCache=LECache( 100 ),
+               progressFd=StringIO.StringIO() )
+         else:
+            progress = StringIO.StringIO()
+            result = lifeExpectancyParallelBatch(
+               StringIO.StringIO( data ), output, errors, 'csv',
+               lambda: LEDataStore( root=root ), LECountries( lambda: countries ),
+               workers, fetcherFactory=Fetcher, chunkSize=16, progressFd=progress )
+            self.assertTrue( '3 workers' in progress.getvalue() )
+            # every worker stored its life expectancies in the shared data store,
+            # the records repeat every 180 lines
+            self.assertEqual( LEDataStore( root=root ).usage()[ 'entries' ], 180 )
+         self.assertEqual( result, ( 500, 2 ) )
+         self.assertEqual( [ json.loads( l )[ 'line' ] for l in errors.getvalue().splitlines() ],
+                           [ 11, 21 ] )
+         outputs.append( output.getvalue() )
+      self.assertEqual( outputs[ 0 ], outputs[ 1 ] )
+      self.assertEqual( len( outputs[ 1 ].splitlines() ), 499 )
+
+   def testLifeExpectancyParallelBatchShards( self ):
+      '''
+      Test that the people of a single country are spread over the workers
+      and that the metrics of the workers are merged and exported
+      '''
+
+      class Fetcher( object ):
+         def fetchMany( self, lifeExps ):
+            return [ ( True, 40.0 ) for le in lifeExps ]
+         def fetch( self, lifeExp ):
+            return self.fetchMany( [ lifeExp ] )[ 0 ]
+         def stats( self ):
+            return {}
+
+      people = [ '{"country": "Italy", "dob": "%s", "gender": "male"}' %
+                 ( datetime.date( 1950, 1, 1 ) + datetime.timedelta( days=i ) ).isoformat()
+                 for i in xrange( 300 ) ]
+      # the same person is scored by the same worker, so it is a cache hit
+      data = "\n".join( people + people[ :100 ] ) + "\n"
+      metricsPath = os.path.join( self.rootDir_, 'metrics.json' )
+      before = [ frontend.metrics.counter( c ) for c in [ 'cache_hits', 'datastore_misses' ] ]
+      progress = StringIO.StringIO()
+      result = lifeExpectancyParallelBatch(
+         StringIO.StringIO( data ), StringIO.StringIO(), StringIO.StringIO(), 'jsonl',
+         lambda: LEDataStore( root=self.rootDir_ ), LECountries( lambda: [ 'Italy' ] ),
+         3, fetcherFactory=Fetcher, chunkSize=16, progressFd=progress,
+         metricsPath=metricsPath )
+      self.assertEqual( result, ( 400, 0 ) )
+      loads = progress.getvalue().split( '3 workers ( ' )[ 1 ].split( ' records' )[ 0 ]
+      loads = [ int( load ) for load in loads.split( '/' ) ]
+      self.assertEqual( sum( loads ), 400 )
+      self.assertTrue( min( loads ) > 80 )
+      with open( metricsPath ) as fd:
+         counters = json.load( fd )[ 'counters' ]
+      self.assertEqual( [ counters[ c ] - n for ( c, n ) in
+                          zip( [ 'cache_hits', 'datastore_misses' ], before ) ], [ 100, 300 ] )
+
+class LETieredLookupUnitTest( unittest.TestCase ):
+
+   class Provider( object ):
+      '''
+      Answers 50 years for everyone but Mars
+      '''
+      def __init__( self ):
+         self.fetched = []
+      def fetch( self, lifeExp ):
+         return self.fetchMany( [ lifeExp ] )[ 0 ]
+      def fetchMany( self, lifeExps ):
+         self.fetched.extend( lifeExps )
+         return [ ( False, "unknown country" ) if le.country() == 'Mars'
+                  else ( True, 50.0 ) for le in lifeExps ]
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+      self.today_ = datetime.date.today()
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def testLETieredLookup( self ):
+      '''
+      Test lookups through cache, data store and provider with promotion
+      '''
+
+      for ds in [ LEDataStore( root=self.rootDir_ ), LEIndexedDataStore( root=self.rootDir_ ) ]:
+         cache = LECache( 10 )
+         provider = self.Provider()
+         lookup = LETieredLookup( [ LECacheTier( cache ), LEDataStoreTier( ds ),
+                                    LEProviderTier( provider, LECache( 10 ) ) ] )
+         le = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+         ( v, delta ) = lookup.get( le )
+         self.assertTrue( v )
+         self.assertEqual( delta, le.lifeExpectancy() )
+         # promoted to the cache and the data store
+         self.assertEqual( cache.get( le ), le )
+         self.assertEqual( ds.fetchLifeExpectancy( le ), delta )
+         self.assertEqual( lookup.get( LifeExpectancy( 'Italy', '1987-03-28', 'male',
+                                                       self.today_ ) ), ( True, delta ) )
+
+         # only the data store has it
+         cache2 = LECache( 10 )
+         lookup2 = LETieredLookup( [ LECacheTier( cache2 ), LEDataStoreTier( ds ),
+                                     LEProviderTier( provider, LECache( 10 ) ) ] )
+         les = [ LifeExpectancy( country, '1987-03-28', 'male', self.today_ )
+                 for country in [ 'Italy', 'Mars', 'France', 'France', 'Italy' ] ]
+         results = lookup2.getMany( les )
+         self.assertEqual( [ v for ( v, _ ) in results ], [ True, False, True, True, True ] )
+         self.assertEqual( results[ 0 ][ 1 ], delta )
+         self.assertEqual( results[ 1 ][ 1 ], "unknown country" )
+         self.assertEqual( les[ 2 ].lifeExpectancy(), les[ 3 ].lifeExpectancy() )
+         # France is requested once, Mars isn't stored
+         self.assertEqual( [ le.country() for le in provider.fetched ],
+                           [ 'Italy', 'Mars', 'France' ] )
+         self.assertEqual( ds.fetchLifeExpectancy( les[ 1 ] ), None )
+         self.assertEqual( cache2.get( les[ 2 ] ), les[ 2 ] )
+         self.assertEqual( ds.fetchLifeExpectancy( les[ 2 ] ), les[ 2 ].lifeExpectancy() )
+
+         stats = lookup2.stats()
+         self.assertEqual( stats.keys(), [ 'cache', 'datastore', 'provider' ] )
+         self.assertEqual( stats[ 'cache' ][ 'misses' ], 5 )
+         self.assertEqual( ( stats[ 'datastore' ][ 'hits' ],
+                             stats[ 'datastore' ][ 'hitRatio' ] ), ( 2, 0.4 ) )
+         self.assertEqual( ( stats[ 'provider' ][ 'hits' ], stats[ 'provider' ][ 'errors' ] ),
+                           ( 2, 1 ) )
+
+         # without a provider a miss is an error
+         lookup3 = LETieredLookup( [ LECacheTier( LECache( 10 ) ) ] )
+         self.assertFalse( lookup3.get( les[ 2 ] )[ 0 ] )
+         self.assertFalse( lookup3.getMany( les[ :1 ] )[ 0 ][ 0 ] )
+         self.assertEqual( lookup3.stats()[ 'cache' ][ 'misses' ], 2 )
+
+   def testLECurveTier( self ):
+      '''
+      Test groups of people answered from their remaining life expectancy curve
+      '''
+
+      class Provider( object ):
+         '''
+         Linear in the age, interpolating it is exact
+         '''
+         def __init__( self ):
+            self.fetched = []
+         def fetch( self, lifeExp ):
+            return self.fetchMany( [ lifeExp ] )[ 0 ]
+         def fetchMany( self, lifeExps ):
+            self.fetched.extend( lifeExps )
+            return [ ( True, 100.0 - ( le.date() - le.dob() ).days / 365.25 )
+                     for le in lifeExps ]
+
+      provider = Provider()
+      providerTier = LEProviderTier( provider, LECache( 1000 ) )
+      curveTier = LECurveTier( providerTier )
+      lookup = LETieredLookup( [ curveTier, providerTier ] )
+      date = datetime.date( 2016, 6, 15 )
+      dobs = [ datetime.date( 1960, 1, 1 ) + datetime.timedelta( days=i * 7 )
+               for i in xrange( 500 ) ]
+      les = [ LifeExpectancy( 'Italy', dob, 'female', date ) for dob in dobs ]
+      results = lookup.getMany( les )
+      self.assertTrue( all( v for ( v, _ ) in results ) )
+      # one request per month of the age range instead of one per person
+      curve = curveTier.curves().getKey( ( 'Italy', 'female', date ) )
+      self.assertEqual( len( provider.fetched ), len( curve.values() ) )
+      self.assertTrue( len( provider.fetched ) < 120 )
+      for le in les:
+         exact = date + relativedelta( days=( 100.0 - ( date - le.dob() ).days / 365.25 )
+                                       * 365.25 )
+         self.assertTrue( abs( ( date + le.lifeExpectancy() - exact ).days ) <= 1 )
+
+      # covered by the curve
+      le = LifeExpectancy( 'Italy', '1965-05-05', 'female', date )
+      self.assertTrue( lookup.get( le )[ 0 ] )
+      self.assertEqual( len( provider.fetched ), len( curve.values() ) )
+      # a single lookup or a few far apart ages go to the provider
+      fetched = len( provider.fetched )
+      lookup.getMany( [ LifeExpectancy( 'Italy', '1930-01-01', 'female', date ),
+                        LifeExpectancy( 'Italy', '2000-01-01', 'female', date ),
+                        LifeExpectancy( 'France', '1965-05-05', 'female', date ) ] )
+      self.assertEqual( len( provider.fetched ), fetched + 3 )
+      self.assertEqual( [ le.dob().year for le in provider.fetched[ -3: ] ],
+                        [ 1930, 2000, 1965 ] )
+      stats = lookup.stats()
+      self.assertEqual( ( stats[ 'curve' ][ 'hits' ], stats[ 'curve' ][ 'misses' ] ),
+                        ( 501, 3 ) )
+
+      # the people of a group close to the curve extend it
+      more = [ LifeExpectancy( 'Italy', datetime.date( 1970, 1, 1 ) +
+                               datetime.timedelta( days=i ), 'female', date )
+               for i in xrange( 100 ) ]
+      fetched = len( provider.fetched )
+      self.assertTrue( all( v for ( v, _ ) in lookup.getMany( more ) ) )
+      extended = curveTier.curves().getKey( ( 'Italy', 'female', date ) )
+      self.assertEqual( ( extended.first(), extended.last() ),
+                        ( curve.first() - 8, curve.last() ) )
+      self.assertEqual( len( provider.fetched ) - fetched,
+                        len( extended.values() ) - len( curve.values() ) )
+
+      # small chunks of the same group go to the provider until their ages
+      # outnumber the points of the curve
+      spain = [ LifeExpectancy( 'Spain', datetime.date( 1980, 1, 1 ) +
+                                datetime.timedelta( days=i * 13 ), 'male', date )
+                for i in xrange( 300 ) ]
+      ( fetched, curved ) = ( len( provider.fetched ), [] )
+      for i in xrange( 10 ):
+         hits = lookup.stats()[ 'curve' ][ 'hits' ]
+         lookup.getMany( spain[ i::10 ] )
+         curved.append( lookup.stats()[ 'curve' ][ 'hits' ] - hits )
+      self.assertEqual( ( curved[ 0 ], curved[ -1 ] ), ( 0, 30 ) )
+      self.assertTrue( len( provider.fetched ) - fetched < 300 )
+
+class LEStaleTierUnitTest( unittest.TestCase ):
+
+   class Provider( object ):
+      '''
+      Answers 50 years for everyone, unless it is down or slower than delay
+      '''
+      outageErrors = ( "WPA is unavailable", )
+      def __init__( self ):
+         self.down = True
+         self.delay = 0
+         self.fetched = 0
+      def fetch( self, lifeExp ):
+         return self.fetchMany( [ lifeExp ] )[ 0 ]
+      def fetchMany( self, lifeExps ):
+         time.sleep( self.delay )
+         if self.down:
+            return [ ( False, "WPA is unavailable" ) ] * len( lifeExps )
+         self.fetched += len( lifeExps )
+         return [ ( True, 50.0 ) ] * len( lifeExps )
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+      self.today_ = datetime.date.today()
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def store( self, ds, dob, daysAgo ):
+      '''
+      Stores 40 years for dob daysAgo days ago
+      '''
+
+      le = LifeExpectancy( 'Italy', dob, 'male', self.today_ - relativedelta( days=daysAgo ) )
+      le.calculateLifeExp( 40.0 )
+      ds.addLifeExpectancy( le )
+      return le
+
+   def testFetchEarlier( self ):
+      '''
+      Test that the data stores return the latest earlier life expectancy
+      '''
+
+      for dataStore in [ LEDataStore, LEIndexedDataStore ]:
+         ds = dataStore( root=tempfile.mkdtemp( dir=self.rootDir_ ) )
+         le = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+         self.assertEqual( ds.fetchEarlier( le, 30 ), None )
+         old = self.store( ds, '1987-03-28', 20 )
+         recent = self.store( ds, '1987-03-28', 5 )
+         self.store( ds, '1987-03-29', 1 )
+         self.assertEqual( ds.fetchEarlier( le, 30 ),
+                           ( recent.date(), recent.lifeExpectancy() ) )
+         self.assertEqual( ds.fetchEarlier( recent, 30 ),
+                           ( old.date(), old.lifeExpectancy() ) )
+         self.assertEqual( ds.fetchEarlier( le, 4 ), None )
+
+   def testLEStaleTier( self ):
+      '''
+      Test serving stale life expectancies while the provider is down
+      and refreshing them once it is back
+      '''
+
+      for dataStore in [ LEDataStore, LEIndexedDataStore ]:
+         ds = dataStore( root=tempfile.mkdtemp( dir=self.rootDir_ ) )
+         provider = self.Provider()
+         metrics = LEMetrics()
+         cache = LECache( 10 )
+         tier = LEStaleTier( LEProviderTier( provider, LECache( 10 ) ), ds, maxAge=30,
+                             retryDelay=0.01, metrics=metrics )
+         lookup = LETieredLookup( [ LECacheTier( cache ), LEDataStoreTier( ds ), tier ],
+                                  metrics )
+         old = self.store( ds, '1987-03-28', 10 )
+         les = [ LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ ),
+                 LifeExpectancy( 'Italy', '1990-01-01', 'male', self.today_ ) ]
+         results = lookup.getMany( les )
+         # the same day of death, 10 days closer
+         delta = relativedelta( old.date() + old.lifeExpectancy(), self.today_ )
+         self.assertEqual( results, [ ( True, delta ), ( False, "WPA is unavailable" ) ] )
+         self.assertTrue( les[ 0 ].stale() )
+         self.assertEqual( les[ 0 ].lifeExpectancy(), delta )
+         self.assertFalse( les[ 1 ].stale() )
+         # stale life expectancies aren't promoted
+         self.assertEqual( len( cache ), 0 )
+         self.assertEqual( ds.fetchLifeExpectancy( les[ 0 ] ), None )
+         self.assertEqual( metrics.counter( 'stale_served' ), 1 )
+         self.assertEqual( tier.pending(), 1 )
+         self.assertEqual( lookup.stats()[ 'provider' ][ 'hits' ], 1 )
+
+         # refreshed in the background once the provider is back
+         provider.down = False
+         tier.wait()
+         self.assertEqual( tier.pending(), 0 )
+         self.assertEqual( metrics.counter( 'stale_refreshed' ), 1 )
+         fresh = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+         self.assertEqual( lookup.get( fresh ), ( True, ds.fetchLifeExpectancy( fresh ) ) )
+         self.assertFalse( fresh.stale() )
+         self.assertEqual( provider.fetched, 1 )
+
+   def testLEStaleTierLatencyBudget( self ):
+      '''
+      Test serving stale life expectancies when the provider is slow
+      '''
+
+      ds = LEDataStore( root=self.rootDir_ )
+      provider = self.Provider()
+      provider.down = False
+      provider.delay = 0.5
+      tier = LEStaleTier( LEProviderTier( provider, LECache( 10 ) ), ds, maxAge=30,
+                          latencyBudget=0.05 )
+      old = self.store( ds, '1987-03-28', 3 )
+      le = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+      start = time.time()
+      self.assertEqual( tier.get( le ),
+                        ( True, relativedelta( old.date() + old.lifeExpectancy(),
+                                               self.today_ ) ) )
+      self.assertTrue( time.time() - start < 0.4 )
+      self.assertTrue( le.stale() )
+      # without an earlier life expectancy the provider is waited for
+      le = LifeExpectancy( 'Italy', '1990-01-01', 'male', self.today_ )
+      self.assertEqual( tier.get( le ), ( True, le.lifeExpectancy() ) )
+      self.assertFalse( le.stale() )
+      fresh = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+      fresh.calculateLifeExp( 50.0 )
+      self.assertEqual( le.lifeExpectancy(), fresh.lifeExpectancy() )
+      tier.wait()
+      self.assertEqual( ds.fetchLifeExpectancy( fresh ), fresh.lifeExpectancy() )
+
+   def testLEStaleTierBatchResult( self ):
+      '''
+      Test that only the stale batch results are flagged
+      '''
+
+      ds = LEDataStore( root=self.rootDir_ )
+      self.store( ds, '1987-03-28', 3 )
+      provider = self.Provider()
+      tier = LEStaleTier( LEProviderTier( provider, LECache( 10 ) ), ds, retryDelay=0.01 )
+      lookup = LETieredLookup( [ LEDataStoreTier( ds ), tier ] )
+      results = scoreRecords( [ { 'country': 'Italy', 'dob': '1987-03-28', 'gender': 'male' } ],
+                              lookup, LECountries( lambda: [ 'Italy' ] ) )
+      self.assertTrue( results[ 0 ][ 1 ][ 'stale' ] )
+      provider.down = False
+      results = scoreRecords( [ { 'country': 'Italy', 'dob': '1990-01-01', 'gender': 'male' } ],
+                              lookup, LECountries( lambda: [ 'Italy' ] ) )
+      self.assertFalse( 'stale' in results[ 0 ][ 1 ] )
+      tier.wait()
+
+class LECircuitBreakerUnitTest( unittest.TestCase ):
+
+   def testLECircuitBreaker( self ):
+      '''
+      Test the transitions of the circuit breaker
+      '''
+
+      now = [ 0.0 ]
+      breaker = LECircuitBreaker( failureThreshold=2, resetTimeout=10, latencyBudget=1.0,
+                                  clock=lambda: now[ 0 ] )
+      self.assertEqual( breaker.state(), 'closed' )
+      breaker.failure()
+      breaker.success( 0.1 )
+      breaker.failure()
+      self.assertTrue( breaker.allow() )
+      # too slow
+      breaker.success( 2.0 )
+      self.assertEqual( breaker.state(), 'open' )
+      self.assertFalse( breaker.allow() )
+      now[ 0 ] = 10.0
+      self.assertEqual( breaker.state(), 'half-open' )
+      # a single trial
+      self.assertTrue( breaker.allow() )
+      self.assertFalse( breaker.allow() )
+      breaker.failure()
+      self.assertEqual( breaker.state(), 'open' )
+      now[ 0 ] = 20.0
+      self.assertTrue( breaker.allow() )
+      breaker.success( 0.1 )
+      self.assertEqual( breaker.state(), 'closed' )
+      stats = breaker.stats()
+      self.assertEqual( ( stats[ 'opened' ], stats[ 'slow' ], stats[ 'rejected' ],
+                          stats[ 'failures' ], stats[ 'successes' ] ), ( 2, 1, 2, 4, 2 ) )
+
+class LEServerUnitTest( unittest.TestCase ):
+
+   class Provider( object ):
+      '''
+      Answers 50 years, Slow waits for release
+      '''
+      def __init__( self ):
+         self.release = threading.Event()
+      def fetch( self, lifeExp ):
+         if lifeExp.country() == 'Slow':
+            self.release.wait()
+         return ( True, 50.0 )
+      def fetchMany( self, lifeExps ):
+         return [ self.fetch( le ) for le in lifeExps ]
+      def stats( self ):
+         return {}
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+      self.provider_ = self.Provider()
+      cache = LECache( 100 )
+      lookup = lookupTiers( cache, LEDataStore( root=self.rootDir_ ), self.provider_,
+                            LECache( 100 ) )
+      countries = LECountries( lambda: [ 'Italy', 'Slow' ] )
+      self.server_ = LEServer( ( '127.0.0.1', 0 ),
+                               lambda records: scoreRecords( records, lookup, countries ),
+                               stats=lambda: { 'cache': cache.stats() },
+                               metrics=LEMetrics(), maxBody=4096 ).start()
+      self.url_ = self.server_.url() + '/lifeExpectancy'
+
+   def tearDown( self ):
+      self.provider_.release.set()
+      self.server_.stop()
+      shutil.rmtree( self.rootDir_ )
+
+   def testLEServer( self ):
+      '''
+      Test single and batched lookups, errors and stats
+      '''
+
+      le = LifeExpectancy( 'Italy', '1987-03-28', 'male', datetime.date.today() )
+      le.calculateLifeExp( 50.0 )
+      delta = le.lifeExpectancy()
+      resp = requests.get( self.url_, params={ 'country': 'italy', 'dob': '1987-03-28',
+                                               'gender': 'male', 'name': 'Jacopo' } )
+      self.assertEqual( resp.status_code, 200 )
+      self.assertEqual( resp.json(), { 'name': 'Jacopo', 'country': 'Italy',
+                                       'dob': '1987-03-28', 'gender': 'male',
+                                       'date': le.date().isoformat(),
+                                       'years': delta.years, 'months': delta.months,
+                                       'days': delta.days } )
+      resp = requests.post( self.url_, json={ 'country': 'Mars', 'dob': '1987-03-28',
+                                              'gender': 'male' } )
+      self.assertEqual( resp.status_code, 400 )
+      self.assertTrue( 'Mars' in resp.json()[ 'error' ] )
+
+      resp = requests.post( self.url_, json=[
+         { 'country': 'Italy', 'dob': '1987-03-28', 'gender': 'male' },
+         { 'country': 'Italy', 'dob': '1987-33-28', 'gender': 'male' }, 42,
+         { 'country': 'Italy', 'dob': '1990-01-01', 'gender': 'female' } ] )
+      self.assertEqual( resp.status_code, 200 )
+      results = resp.json()
+      self.assertEqual( len( results ), 4 )
+      self.assertEqual( results[ 0 ][ 'years' ], delta.years )
+      self.assertTrue( 'error' in results[ 1 ] and 'error' in results[ 2 ] )
+      self.assertEqual( results[ 3 ][ 'gender' ], 'female' )
+
+      self.assertEqual( requests.post( self.url_, data='[' ).status_code, 400 )
+      self.assertEqual( requests.post( self.url_, data='[' * 5000 ).status_code, 413 )
+      self.assertEqual( requests.get( self.server_.url() + '/nope' ).status_code, 404 )
+      # the second lookup of Italy 1987-03-28 was a cache hit
+      self.assertEqual( requests.get( self.server_.url() + '/stats' ).json(),
+                        { 'cache': { 'size': 2, 'maxsize': 100, 'hits': 1, 'misses': 2,
+                                     'evictions': 0, 'expirations': 0 } } )
+      metrics = requests.get( self.server_.url() + '/metrics' ).text
+      self.assertTrue( 'lifeexpectancy_server_records_total 6' in metrics )
+
+   def testLEServerErrors( self ):
+      '''
+      Test invalid Content-Length headers and failing lookups
+      '''
+
+      for length in [ '-1', 'abc' ]:
+         conn = httplib.HTTPConnection( *self.server_.server_address[ :2 ], timeout=5 )
+         try:
+            conn.putrequest( 'POST', '/lifeExpectancy' )
+            conn.putheader( 'Content-Length', length )
+            conn.endheaders()
+            resp = conn.getresponse()
+            self.assertEqual( resp.status, 400 )
+            self.assertTrue( 'Content-Length' in json.loads( resp.read() )[ 'error' ] )
+         finally:
+            conn.close()
+
+      def score( records ):
+         raise IOError( "disk error" )
+      server = LEServer( ( '127.0.0.1', 0 ), score ).start()
+      try:
+         for resp in [ requests.get( server.url() + '/lifeExpectancy',
+                                     params={ 'country': 'Italy' } ),
+                       requests.post( server.url() + '/lifeExpectancy',
+                                      json=[ { 'country': 'Italy' } ] ) ]:
+            self.assertEqual( resp.status_code, 500 )
+            self.assertTrue( 'disk error' in resp.json()[ 'error' ] )
+      finally:
+         server.stop()
+
+      # a response that fails once started isn't followed by a 500
+      endHeaders = LERequestHandler.end_headers
+      def brokenEndHeaders( handler ):
+         endHeaders( handler )
+         raise IOError( "broken pipe" )
+      LERequestHandler.end_headers = brokenEndHeaders
+      try:
+         sock = socket.create_connection( self.server_.server_address[ :2 ], timeout=5 )
+         sock.sendall( "GET /stats HTTP/1.1\r\nHost: localhost\r\n\r\n" )
+         data = ''
+         while True:
+            chunk = sock.recv( 4096 )
+            if not chunk:
+               break
+            data += chunk
+         sock.close()
+      finally:
+         LERequestHandler.end_headers = endHeaders
+      self.assertTrue( data.startswith( 'HTTP/1.1 200' ) )
+      self.assertEqual( data.count( 'HTTP/1.1' ), 1 )
+
+   def testLEServerConcurrentClients( self ):
+      '''
+      Test that a client waiting on the provider doesn't block the others
+      '''
+
+      slow = threading.Thread( target=requests.get, args=( self.url_, ),
+                               kwargs={ 'params': { 'country': 'Slow', 'dob': '1987-03-28',
+                                                    'gender': 'male' } } )
+      slow.start()
+      resp = requests.get( self.url_, params={ 'country': 'Italy', 'dob': '1987-03-28',
+                                               'gender': 'male' }, timeout=5 )
+      self.assertEqual( resp.status_code, 200 )
+      self.assertTrue( slow.is_alive() )
+      self.provider_.release.set()
+      slow.join()
+
+class WPAStandInHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+   '''
+   Local stand-in for the World Population API.
+   Italy answers, Mars is an invalid country, Flaky fails once with a 503,
+   Down always fails with a 503, Odd is rejected with a list as error body
+   and Slow answers after the fetcher timeout
+   '''
+
+   def do_GET( self ):
+      server = self.server
+      with server.lock:
+         server.requests += 1
+         server.inFlight += 1
+         server.maxInFlight = max( server.maxInFlight, server.inFlight )
+      try:
+         parts = self.path.split( '/' )
+         country = parts[ 5 ] if len( parts ) > 5 else None
+         time.sleep( server.delay )
+         if country == 'Mars':
+            self.reply( 400, { 'detail': "Mars is an invalid value" } )
+         elif country == 'Flaky' and self.path not in server.seen:
+            server.seen.add( self.path )
+            self.reply( 503, {} )
+         elif country == 'Down':
+            self.reply( 503, { 'detail': "WPA is down" } )
+         elif country == 'Odd':
+            self.reply( 400, [ "Odd is odd" ] )
+         elif country == 'Slow':
+            time.sleep( 0.5 )
+            self.reply( 200, { 'remaining_life_expectancy': 1.0 } )
+         elif parts[ 3 ] == 'total':
+            self.reply( 200, { 'total_life_expectancy': 85.5 } )
+         else:
+            self.reply( 200, { 'remaining_life_expectancy': 40.5 } )
+      finally:
+         with server.lock:
+            server.inFlight -= 1
+
+   def reply( self, status, body ):
+      data = json.dumps( body )
+      self.send_response( status )
+      self.send_header( 'Content-Type', 'application/json' )
+      self.send_header( 'Content-Length', str( len( data ) ) )
+      self.end_headers()
+      self.wfile.write( data )
+
+   def log_message( self, *args ):
+      pass
+
+class WPAStandInServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+   daemon_threads = True
+
+   def __init__( self, delay=0 ):
+      BaseHTTPServer.HTTPServer.__init__( self, ( '127.0.0.1', 0 ), WPAStandInHandler )
+      self.lock = threading.Lock()
+      self.delay = delay
+      self.requests = 0
+      self.inFlight = 0
+      self.maxInFlight = 0
+      self.seen = set()
+      self.thread = threading.Thread( target=self.serve_forever )
+      self.thread.daemon = True
+      self.thread.start()
+
+   def url( self ):
+      return "http://127.0.0.1:%s/1.0" % self.server_address[ 1 ]
+
+   def stop( self ):
+      self.shutdown()
+      self.server_close()
+
+class LEWPAFetcherUnitTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.today_ = datetime.date.today()
+
+   def testLEWPAFetcher( self ):
+      '''
+      Test answers, errors, retries and timeouts against a stand-in WPA
+      '''
+
+      server = WPAStandInServer()
+      fetcher = LEWPAFetcher( url=server.url(), timeout=0.2, retries=1, backoff=0 )
+      try:
+         le = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+         self.assertEqual( fetcher.fetch( le ), ( True, 40.5 ) )
+         ( v, msg ) = fetcher.fetch( LifeExpectancy( 'Mars', '1987-03-28', 'male',
+                                                     self.today_ ) )
+         self.assertFalse( v )
+         self.assertTrue( 'Mars' in msg )
+         # the 503 is retried
+         self.assertEqual( fetcher.fetch( LifeExpectancy( 'Flaky', '1987-03-28',
+                                                          'male', self.today_ ) ),
+                           ( True, 40.5 ) )
+         # WPA answered, the last error is returned rather than a connection error
+         self.assertEqual( fetcher.fetch( LifeExpectancy( 'Down', '1987-03-28',
+                                                          'male', self.today_ ) ),
+                           ( False, "WPA is down" ) )
+         self.assertEqual( fetcher.fetch( LifeExpectancy( 'Odd', '1987-03-28',
+                                                          'male', self.today_ ) ),
+                           ( False, "WPA returned 400" ) )
+         self.assertEqual( fetcher.fetch( LifeExpectancy( 'Slow', '1987-03-28',
+                                                          'male', self.today_ ) ),
+                           ( False, "Can't connect to the Internet" ) )
+         # dob in the future uses the /total/ API
+         future = LifeExpectancy( 'Italy', self.today_ + relativedelta( years=1 ),
+                                  'male', self.today_ )
+         self.assertEqual( fetcher.fetch( future ), ( True, 85.5 ) )
+         self.assertEqual( future.date(), future.dob() )
+      finally:
+         fetcher.close()
+         server.stop()
+
+   def testLEWPAFetcherFetchMany( self ):
+      '''
+      Test that fetchMany keeps the order and bounds the requests in flight
+      '''
+
+      server = WPAStandInServer( delay=0.02 )
+      fetcher = LEWPAFetcher( url=server.url(), concurrency=4, backoff=0 )
+      try:
+         les = [ LifeExpectancy( 'Mars' if x % 3 == 0 else 'Italy',
+                                 self.today_ - relativedelta( days=x ),
+                                 'female', self.today_ ) for x in xrange( 20 ) ]
+         results = fetcher.fetchMany( les )
+         self.assertEqual( [ v for ( v, _ ) in results ],
+                           [ x % 3 != 0 for x in xrange( 20 ) ] )
+         self.assertEqual( server.requests, 20 )
+         self.assertTrue( 1 < server.maxInFlight <= 4 )
+      finally:
+         fetcher.close()
+         server.stop()
+
+   def testLEWPAFetcherCoalescing( self ):
+      '''
+      Test that identical concurrent queries share a single WPA request
+      '''
+
+      server = WPAStandInServer( delay=0.2 )
+      fetcher = LEWPAFetcher( url=server.url(), concurrency=8, backoff=0 )
+      try:
+         les = [ LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+                 for x in xrange( 8 ) ]
+         self.assertEqual( fetcher.fetchMany( les ), [ ( True, 40.5 ) ] * 8 )
+         flights = fetcher.singleFlight()
+         self.assertEqual( flights.executed() + flights.coalesced(), 8 )
+         self.assertTrue( flights.coalesced() > 0 )
+         self.assertEqual( server.requests, flights.executed() )
+      finally:
+         fetcher.close()
+         server.stop()
+
+   def testLEWPAFetcherBreaker( self ):
+      '''
+      Test that an open circuit fails requests without querying WPA
+      '''
+
+      server = WPAStandInServer()
+      now = [ 0.0 ]
+      breaker = LECircuitBreaker( failureThreshold=2, resetTimeout=10,
+                                  clock=lambda: now[ 0 ] )
+      fetcher = LEWPAFetcher( url=server.url(), timeout=0.1, retries=0, backoff=0,
+                              breaker=breaker )
+      try:
+         le = LifeExpectancy( 'Italy', '1987-03-28', 'male', self.today_ )
+         # WPA answering an error isn't an outage
+         self.assertFalse( fetcher.fetch( LifeExpectancy( 'Mars', '1987-03-28', 'male',
+                                                          self.today_ ) )[ 0 ] )
+         for days in xrange( 2 ):
+            self.assertEqual( fetcher.fetch( LifeExpectancy( 'Down', '1987-03-28', 'male',
+                                                             self.today_ - relativedelta( days=days ) ) ),
+                              ( False, "WPA is down" ) )
+         self.assertEqual( breaker.state(), 'closed' )
+         for days in xrange( 2 ):
+            self.assertEqual( fetcher.fetch( LifeExpectancy( 'Slow', '1987-03-28', 'male',
+                                                             self.today_ - relativedelta( days=days ) ) ),
+                              ( False, "Can't connect to the Internet" ) )
+         self.assertEqual( fetcher.stats()[ 'breaker' ][ 'state' ], 'open' )
+         requests = server.requests
+         self.assertEqual( fetcher.fetch( le ), ( False, "WPA is unavailable" ) )
+         self.assertEqual( server.requests, requests )
+         now[ 0 ] = 10.0
+         self.assertEqual( fetcher.fetch( le ), ( True, 40.5 ) )
+         self.assertEqual( breaker.state(), 'closed' )
+      finally:
+         fetcher.close()
+         server.stop()
+
+class LESingleFlightUnitTest( unittest.TestCase ):
+
+   def testLESingleFlight( self ):
+      '''
+      Test that concurrent calls for a key share the leader's result or exception
+      '''
+
+      flights = LESingleFlight()
+      release = threading.Event()
+      calls = []
+      def slow( value ):
+         calls.append( value )
+         release.wait()
+         if value == 'error':
+            raise ValueError( value )
+         return value
+
+      results = []
+      errors = []
+      def worker( key ):
+         try:
+            results.append( flights.do( key, slow, key ) )
+         except ValueError as e:
+            errors.append( str( e ) )
+
+      threads = [ threading.Thread( target=worker, args=( key, ) )
+                  for key in [ 'a' ] * 5 + [ 'error' ] * 3 ]
+      for t in threads:
+         t.start()
+      while flights.coalesced() < 6:
+         time.sleep( 0.01 )
+      release.set()
+      for t in threads:
+         t.join()
+
+      self.assertEqual( sorted( calls ), [ 'a', 'error' ] )
+      self.assertEqual( results, [ 'a' ] * 5 )
+      self.assertEqual( errors, [ 'error' ] * 3 )
+      self.assertEqual( flights.stats(), { 'executed': 2, 'coalesced': 6,
+                                           'inFlight': 0 } )
+
+class LELifeTableUnitTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+      self.path_ = os.path.join( self.rootDir_, 'lifeTable.csv' )
+      with open( self.path_, 'w' ) as fd:
+         fd.write( "country,gender,age,qx\n"
+                   "Italy,male,0,0\nItaly,male,1,0\nItaly,male,2,0.5\n"
+                   "Italy,female,0,0.1\nItaly,female,1,1\n" )
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def testLELifeTable( self ):
+      '''
+      Test life expectancies computed from a life table
+      '''
+
+      table = LELifeTable( self.path_ )
+      self.assertEqual( table.countries(), [ 'Italy' ] )
+      # the last age is the end of the table, deaths are uniform within a year
+      self.assertEqual( table.expectancy( 'Italy', 'male', 0 ), ( True, 2.5 ) )
+      self.assertEqual( table.expectancy( 'Italy', 'male', 1 ), ( True, 1.5 ) )
+      self.assertEqual( table.expectancy( 'Italy', 'male', 0.5 ), ( True, 2.0 ) )
+      self.assertEqual( table.expectancy( 'Italy', 'male', 2.5 ), ( True, 0.25 ) )
+      self.assertEqual( table.expectancy( 'Italy', 'male', 7 ), ( True, 0.0 ) )
+      self.assertAlmostEqual( table.expectancy( 'Italy', 'female', 0 )[ 1 ],
+                              0.95 + 0.45 )
+
+      today = datetime.date.today()
+      le = LifeExpectancy( 'Italy', today - relativedelta( years=1 ), 'male', today )
+      ( v, remaining ) = table.fetch( le )
+      self.assertTrue( v )
+      self.assertAlmostEqual( remaining, 1.5, places=2 )
+      future = LifeExpectancy( 'Italy', today + relativedelta( days=1 ), 'male', today )
+      self.assertEqual( table.fetch( future ), ( True, 2.5 ) )
+      ( v, msg ) = table.fetch( LifeExpectancy( 'Mars', '1987-03-28', 'male', today ) )
+      self.assertFalse( v )
+      self.assertTrue( 'Mars' in msg )
+
+      with open( self.path_, 'a' ) as fd:
+         fd.write( "Italy,male,4,0.1\n" )
+      with self.assertRaisesRegexp( LELifeTableException, "missing ages" ):
+         LELifeTable( self.path_ )
+
+class LECountriesUnitTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+      self.path_ = os.path.join( self.rootDir_, 'countries.json' )
+      self.fetches_ = []
+      self.now_ = 1000
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def fetch( self ):
+      self.fetches_.append( self.now_ )
+      return [ u'Italy', u'United Kingdom', u'USA' ]
+
+   def countries( self ):
+      return LECountries( self.fetch, self.path_, ttl=100,
+                          clock=lambda: self.now_ )
+
+   def testLECountries( self ):
+      '''
+      Test lookups, suggestions, persistence and refreshes of the countries
+      '''
+
+      countries = self.countries()
+      self.assertEqual( self.fetches_, [ 1000 ] )
+      self.assertEqual( countries.lookup( 'united KINGDOM' ), 'United Kingdom' )
+      self.assertTrue( 'usa' in countries )
+      self.assertFalse( 'Mars' in countries )
+      self.assertEqual( countries.suggestions( 'Itly' ), [ 'Italy' ] )
+      self.assertEqual( countries.names(), [ 'Italy', 'USA', 'United Kingdom' ] )
+
+      # the persisted list is used without fetching
+      self.now_ = 1050
+      countries = self.countries()
+      self.assertEqual( self.fetches_, [ 1000 ] )
+      self.assertEqual( countries.fetched(), 1000 )
+
+      # a stale list is used while it is refreshed in background
+      self.now_ = 1100
+      countries = self.countries()
+      self.assertEqual( countries.lookup( 'italy' ), 'Italy' )
+      countries.refreshInBackground().join()
+      self.assertEqual( self.fetches_, [ 1000, 1100 ] )
+      self.assertEqual( self.countries().fetched(), 1100 )
+
+      # a failed fetch keeps the current list
+      countries = LECountries( lambda: [], self.path_, ttl=0 )
+      countries.refreshInBackground().join()
+      self.assertEqual( len( countries ), 3 )
+      self.assertEqual( len( LECountries( lambda: [] ) ), 0 )
+
+   def testLECountriesRetryInterval( self ):
+      '''
+      Test that lookups of a stale list don't refresh it again before
+      retryInterval while the fetch keeps failing
+      '''
+
+      self.countries()
+      fetches = []
+      def fail():
+         fetches.append( self.now_ )
+         return []
+      self.now_ = 1200
+      countries = LECountries( fail, self.path_, ttl=100, retryInterval=60,
+                               clock=lambda: self.now_ )
+      for _ in xrange( 1000 ):
+         self.assertEqual( countries.lookup( 'italy' ), 'Italy' )
+      countries.refreshInBackground().join()
+      self.assertEqual( fetches, [ 1200 ] )
+      self.now_ = 1260
+      countries.lookup( 'italy' )
+      countries.refreshInBackground().join()
+      for _ in xrange( 1000 ):
+         countries.lookup( 'italy' )
+      self.assertEqual( fetches, [ 1200, 1260 ] )
+      self.assertEqual( countries.fetched(), 1000 )
+
+   def testLECountriesFirstFetchFails( self ):
+      '''
+      Test that a list whose first fetch failed is refreshed in the
+      background once retryInterval has passed
+      '''
+
+      results = [ [], [ u'Italy' ] ]
+      fetches = []
+      def fetch():
+         fetches.append( self.now_ )
+         return results.pop( 0 )
+      countries = LECountries( fetch, self.path_, ttl=100, retryInterval=60,
+                               clock=lambda: self.now_ )
+      self.assertEqual( len( countries ), 0 )
+      self.assertEqual( countries.lookup( 'italy' ), None )
+      self.assertEqual( fetches, [ 1000 ] )
+      self.now_ = 1060
+      # callers check the length before looking up a country
+      self.assertEqual( len( countries ), 0 )
+      for _ in xrange( 500 ):
+         if fetches == [ 1000, 1060 ] and countries.fetched():
+            break
+         time.sleep( 0.01 )
+      self.assertEqual( fetches, [ 1000, 1060 ] )
+      self.assertEqual( len( countries ), 1 )
+      self.assertEqual( countries.lookup( 'italy' ), 'Italy' )
+      self.assertEqual( countries.fetched(), 1060 )
+
+def profiledWork( n ):
+   '''
+   Spends its time computing life expectancies
+   '''
+
+   today = datetime.date( 2017, 1, 1 )
+   for _ in xrange( n * 1000 ):
+      LifeExpectancy( 'Italy', '1980-01-01', 'male', today ).calculateLifeExp( 40.5 )
+
+def profilerWorker( results ):
+   profiler = LEProfiler( interval=0.001 ).start()
+   profiledWork( 5 )
+   profiler.stop()
+   results.put( profiler.data() )
+
+class LEProfilerUnitTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.rootDir_ = tempfile.mkdtemp()
+
+   def tearDown( self ):
+      shutil.rmtree( self.rootDir_ )
+
+   def testLEProfiler( self ):
+      '''
+      Test profiling threads, merging the profile of another process and
+      the reports
+      '''
+
+      profiler = LEProfiler( interval=0.001 )
+      with profiler:
+         thread = threading.Thread( target=profiledWork, args=( 5, ) )
+         thread.start()
+         profiledWork( 5 )
+         thread.join()
+      self.assertTrue( profiler.samples() > 0 )
+      results = multiprocessing.Queue()
+      process = multiprocessing.Process( target=profilerWorker, args=( results, ) )
+      process.start()
+      profiler.merge( results.get() )
+      process.join()
+      self.assertEqual( profiler.processes(), 2 )
+
+      # every call of both threads and of the other process
+      calls = [ stats[ 0 ] for ( ( _, _, name ), stats ) in profiler.stats().stats.items()
+                if name == 'profiledWork' ]
+      self.assertEqual( calls, [ 3 ] )
+      hot = [ frame for ( frame, _, _ ) in profiler.hotFunctions() ]
+      self.assertTrue( any( f.startswith( 'calculateLifeExp (LEUtils.py:' ) for f in hot ) )
+
+      path = os.path.join( self.rootDir_, 'profile.txt' )
+      profiler.save( path )
+      with open( path ) as fd:
+         report = fd.read()
+      self.assertTrue( 'in 2 processes' in report )
+      self.assertTrue( 'Deterministic profile' in report )
+      with open( path + '.collapsed' ) as fd:
+         lines = fd.read().splitlines()
+      self.assertEqual( sum( int( l.rpartition( ' ' )[ 2 ] ) for l in lines ),
+                        profiler.samples() )
+      self.assertTrue( any( 'profiledWork (LifeExpectancyUnitTests.py:' in l.split( ';' )[ -2 ]
+                            for l in lines if ';' in l ) )
+      self.assertTrue( pstats.Stats( path + '.pstats' ).total_calls > 0 )
+
+      # sampling only
+      os.remove( path + '.pstats' )
+      profiler = LEProfiler( deterministic=False, interval=0.001 )
+      with profiler:
+         profiledWork( 5 )
+      profiler.save( path )
+      self.assertTrue( profiler.samples() > 0 )
+      self.assertEqual( profiler.stats(), None )
+      self.assertFalse( os.path.exists( path + '.pstats' ) )
+
+   def testLEProfilerParallelBatch( self ):
+      '''
+      Test that the profiles of the batch workers are aggregated
+      '''
+
+      class Fetcher( object ):
+         def fetchMany( self, lifeExps ):
+            return [ ( True, 40.5 ) for le in lifeExps ]
+         def fetch( self, lifeExp ):
+            return ( True, 40.5 )
+
+      data = "".join( '{"country": "Italy", "dob": "19%02d-01-01", "gender": "male"}\n' % i
+                      for i in xrange( 100 ) )
+      profiler = LEProfiler().start()
+      lifeExpectancyParallelBatch(
+         StringIO.StringIO( data ), StringIO.StringIO(), StringIO.StringIO(), 'jsonl',
+         lambda: LEDataStore( root=self.rootDir_ ), LECountries( lambda: [ 'Italy' ] ),
+         2, fetcherFactory=Fetcher, progressFd=StringIO.StringIO(), profiler=profiler )
+      profiler.stop()
+      self.assertEqual( profiler.processes(), 3 )
+      # only the workers score records
+      calls = [ stats[ 1 ] for ( ( _, _, name ), stats ) in profiler.stats().stats.items()
+                if name == 'calculateLifeExp' ]
+      self.assertEqual( calls, [ 100 ] )
+
+class LEMetricsUnitTest( unittest.TestCase ):
+
+   def testLEMetricsMerge( self ):
+      '''
+      Test merging the metrics of another process
+      '''
+
+      metrics = LEMetrics()
+      metrics.observe( 'cache', 0.0005 )
+      metrics.incr( 'cache_hits' )
+      other = LEMetrics()
+      other.observe( 'cache', 0.0005 )
+      other.observe( 'provider', 0.5 )
+      other.incr( 'cache_hits', 2 )
+      metrics.merge( pickle.loads( pickle.dumps( other.data() ) ) )
+      snapshot = metrics.snapshot()
+      self.assertEqual( snapshot[ 'counters' ], { 'cache_hits': 3 } )
+      self.assertEqual( snapshot[ 'stages' ][ 'cache' ][ 'buckets' ][ '0.001' ], 2 )
+      self.assertEqual( snapshot[ 'stages' ][ 'provider' ][ 'count' ], 1 )
+      other.reset()
+      self.assertEqual( other.snapshot(), { 'stages': {}, 'counters': {} } )
+
+   def testLEMetrics( self ):
+      '''
+      Test histograms, counters and their exports
+      '''
+
+      metrics = LEMetrics()
+      metrics.observe( 'cache', 0.000005 )
+      metrics.observe( 'cache', 0.0005 )
+      metrics.observe( 'provider', 20 )
+      with metrics.timer( 'calculate' ):
+         pass
+      metrics.incr( 'cache_hits' )
+      metrics.incr( 'cache_hits', 2 )
+
+      snapshot = metrics.snapshot()
+      self.assertEqual( snapshot[ 'counters' ], { 'cache_hits': 3 } )
+      cache = snapshot[ 'stages' ][ 'cache' ]
+      self.assertEqual( cache[ 'count' ], 2 )
+      self.assertEqual( ( cache[ 'buckets' ][ '1e-05' ], cache[ 'buckets' ][ '0.001' ] ),
+                        ( 1, 1 ) )
+      self.assertEqual( snapshot[ 'stages' ][ 'provider' ][ 'buckets' ][ '+Inf' ], 1 )
+      self.assertEqual( snapshot[ 'stages' ][ 'calculate' ][ 'count' ], 1 )
+
+      prometheus = metrics.prometheus().splitlines()
+      self.assertTrue( 'lifeexpectancy_stage_seconds_bucket{stage="cache",le="0.001"} 2'
+                       in prometheus )
+      self.assertTrue( 'lifeexpectancy_stage_seconds_count{stage="provider"} 1'
+                       in prometheus )
+      self.assertTrue( 'lifeexpectancy_cache_hits_total 3' in prometheus )
+
+      rootDir = tempfile.mkdtemp()
+      try:
+         metrics.export( os.path.join( rootDir, 'metrics.json' ) )
+         with open( os.path.join( rootDir, 'metrics.json' ) ) as fd:
+            self.assertEqual( json.load( fd )[ 'counters' ], { 'cache_hits': 3 } )
+         metrics.export( os.path.join( rootDir, 'metrics.prom' ) )
+         with open( os.path.join( rootDir, 'metrics.prom' ) ) as fd:
+            self.assertEqual( fd.read().splitlines(), prometheus )
+      finally:
+         shutil.rmtree( rootDir )
+
 if __name__ == '__main__':
    unittest.main()
 